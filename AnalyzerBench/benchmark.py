@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Times each phase of analyze.py's process() on synthetic profiles of a few
+# different sizes (see synthprofile.py), and writes the results out as JSON.
+# Given the results of an earlier run, it also says which phases got slower,
+# and exits with an error if any of them slowed down by more than the
+# tolerance, so changes to the analyzer can be checked for regressions.
+#
+# Usage: benchmark.py [--scales small,medium] [--out results.json] [--baseline old.json]
+
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import analyze
+import synthprofile
+
+resultsFormatVersion = 1
+phases = ["read", "segmentMap", "symbolicate", "count", "report"]
+# Phases that take less time than this aren't checked for regressions, since
+# they're mostly noise
+minCheckedSeconds = 0.1
+
+scales = {
+    "small": {"segmentCount": 1, "functionCount": 200, "stackCount": 1000, "meanDepth": 6, "profileCount": 1},
+    "medium": {"segmentCount": 4, "functionCount": 2000, "stackCount": 20000, "meanDepth": 10, "profileCount": 2},
+    "large": {"segmentCount": 8, "functionCount": 6000, "stackCount": 100000, "meanDepth": 14, "profileCount": 2},
+}
+
+
+def resetAnalyzerCaches():
+    # Everything the analyzer keeps around between profiles, so each run starts cold
+    analyze.romMaps.clear()
+    analyze.binaryHashes.clear()
+    analyze.progbitsSections.clear()
+    analyze.addrToLineTables.clear()
+
+
+def runPhases(binaryPath, profilePaths):
+    """Runs process() one phase at a time, the way it would run with
+    default options. Returns how long each phase took, in seconds, and
+    the number of samples in the profiles and addresses symbolicated."""
+    timings = {}
+    resetAnalyzerCaches()
+    analyzer = analyze.Analyzer(binaryPath)
+    
+    startTime = time.perf_counter()
+    profiles = analyze.readProfiles(profilePaths)
+    timings["read"] = time.perf_counter() - startTime
+    
+    startTime = time.perf_counter()
+    analyzer.checkBinary()
+    analyzer.sampleRate = analyze.profilesSampleRate(profiles)
+    
+    for profile in profiles:
+        analyze.readCodeSegments(binaryPath, profile.codeSegments)
+        analyzer.addProfileAddrs(profile)
+    
+    timings["segmentMap"] = time.perf_counter() - startTime
+    
+    startTime = time.perf_counter()
+    addrCount = analyzer.symbolicate()
+    analyzer.removeUnsymbolicatedSamples(profiles)
+    timings["symbolicate"] = time.perf_counter() - startTime
+    
+    startTime = time.perf_counter()
+    analyzer.aggregate(analyze.mergeProfileSamples(profiles))
+    timings["count"] = time.perf_counter() - startTime
+    
+    startTime = time.perf_counter()
+    
+    with contextlib.redirect_stdout(io.StringIO()):
+        analyzer.printResults()
+    
+    timings["report"] = time.perf_counter() - startTime
+    
+    return timings, sum([sum(profile.rawSamples.values()) for profile in profiles]), addrCount
+
+
+def benchmarkScale(name, fixturesDir, repeatCount):
+    params = scales[name]
+    outDir = os.path.join(fixturesDir, name)
+    print(f"{name}: generating {params['profileCount']} profile(s) with {params['stackCount']} stacks each...")
+    binaryPath, profilePaths = synthprofile.makeFixture(outDir, **params)
+    runs = []
+    
+    for i in range(repeatCount):
+        timings, sampleCount, addrCount = runPhases(binaryPath, profilePaths)
+        runs.append(timings)
+        print(f"{name}: run {i + 1}: " + ", ".join([f"{phase} {timings[phase]:.3f}s" for phase in phases]))
+    
+    # The fastest of the runs is the one least disturbed by whatever else was going on
+    best = {phase: min([run[phase] for run in runs]) for phase in phases}
+    best["total"] = sum(best.values())
+    
+    return {"params": params,
+            "sampleCount": sampleCount,
+            "addressCount": addrCount,
+            "seconds": best,
+            "runs": runs}
+
+
+def compareResults(baseline, results, tolerance):
+    """Prints how each phase compares with the baseline. Returns the phases
+    that got slower by more than the tolerance, as (scale, phase) tuples."""
+    regressions = []
+    
+    for name, result in results["scales"].items():
+        if name not in baseline.get("scales", {}):
+            continue
+        
+        baseSeconds = baseline["scales"][name]["seconds"]
+        
+        for phase in phases + ["total"]:
+            if phase not in baseSeconds:
+                continue
+            
+            old, new = baseSeconds[phase], result["seconds"][phase]
+            change = (new - old) / old if old > 0 else 0
+            regressed = change > tolerance and max(old, new) >= minCheckedSeconds
+            print(f"  {name:8} {phase:12} {old:8.3f}s -> {new:8.3f}s  {change * 100:+7.1f}%"
+                  + ("  SLOWER" if regressed else ""))
+            
+            if regressed:
+                regressions.append((name, phase))
+    
+    return regressions
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Times each phase of analyze.py on synthetic profiles")
+    parser.add_argument("--scales", default="small,medium",
+                        help=f"Comma-separated sizes of profile to run, out of: {', '.join(scales.keys())} "
+                             "(default: small,medium)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Times to run each one, keeping the fastest time for each phase (default: 3)")
+    parser.add_argument("--out", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", default=None,
+                        help="Compare against the results in this JSON file, from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="How much slower a phase can get than in the baseline, as a fraction, before it "
+                             "counts as a regression (default: 0.25)")
+    parser.add_argument("--fixtures-dir", default=None,
+                        help="Where to write the synthetic binaries and profiles. They're written to a "
+                             "temporary directory and deleted afterwards if this isn't given.")
+    parser.add_argument("--cache", action="store_true",
+                        help="Let the analyzer use its cache of symbol and line tables, so the symbolicate "
+                             "phase measures a warm cache after the first run")
+    
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    scaleNames = [name.strip() for name in args.scales.split(",") if len(name.strip()) > 0]
+    
+    for name in scaleNames:
+        if name not in scales:
+            sys.stderr.write(f"Error: unknown scale '{name}', expected one of: {', '.join(scales.keys())}\n")
+            sys.exit(1)
+    
+    baseline = None
+    
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    
+    fixturesDir = args.fixtures_dir or tempfile.mkdtemp(prefix="profiler68-bench-")
+    # Keep the ROM map indexes and any cached tables with the fixtures
+    analyze.cacheDir = os.path.join(fixturesDir, "cache")
+    analyze.cacheEnabled = args.cache
+    results = {"formatVersion": resultsFormatVersion,
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "numpy": analyze.numpy is not None,
+               "cache": args.cache,
+               "scales": {}}
+    
+    try:
+        for name in scaleNames:
+            results["scales"][name] = benchmarkScale(name, fixturesDir, max(1, args.repeat))
+    finally:
+        if args.fixtures_dir is None:
+            shutil.rmtree(fixturesDir, ignore_errors=True)
+    
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    
+    if baseline is not None:
+        print(f"\nCompared with {args.baseline}:")
+        regressions = compareResults(baseline, results, args.tolerance)
+        
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} phase(s) got more than {args.tolerance * 100:.0f}% slower")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
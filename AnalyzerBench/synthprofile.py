@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+
+# Generates a synthetic application binary and profiles of it, so analyze.py
+# can be measured without a real app and an emulator to run it in. The binary
+# is a big-endian m68k ELF file laid out the way Retro68 lays them out: a code
+# section for each CODE segment, a symbol table and a DWARF 4 line table. The
+# profiles are written byte for byte the way SaveProfilingData_() writes them.
+# Their stacks come from walking a random call graph, some of them end in
+# routines from the model's ROM map, and their sample counts follow a Zipf
+# distribution, as in a real profile where a few hot spots get most of the time.
+#
+# Usage: synthprofile.py OUT_DIR [options]
+
+import sys
+import os
+import struct
+import random
+import argparse
+from dataclasses import dataclass, field
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import analyze
+from elfdwarf import (SHT_PROGBITS, SHT_SYMTAB, DW_LNS_copy, DW_LNS_advance_pc, DW_LNS_advance_line,
+                      DW_LNS_set_file, DW_LNE_end_sequence, DW_LNE_set_address)
+
+SHT_STRTAB = 3
+SHF_ALLOC = 0x2
+SHF_EXECINSTR = 0x4
+STB_GLOBAL = 1
+STT_FUNC = 2
+EM_68K = 4
+
+binaryName = "synth.gdb"
+functionSize = 0x100
+# Bytes of code for each line of source
+lineSize = 8
+linesPerFunction = 40
+functionsPerFile = 50
+# Addresses of 0 mean code was removed by the linker, so nothing can go there
+firstSectionAddr = 0x1000
+sectionAlignment = 0x100
+# Where the Memory Manager put the first CODE segment, and how far apart the rest are
+segmentHeapStart = 0x00110000
+segmentHeapGap = 0x1000
+# The most frames the profiler keeps for a stack
+maxStackDepth = 50
+maxCallees = 6
+romModel = "Macintosh SE"
+romBase = 0x00400000
+# How many of the ROM's routines the app calls
+romRoutineCount = 200
+# sizeof(ArenaEntry) in hashmap.c, as laid out for the 68k
+arenaEntrySize = 18
+
+
+@dataclass
+class SynthFunction:
+    name: str = ""
+    segmentId: int = 0
+    # Address in the binary
+    addr: int = 0
+    fileIndex: int = 0
+    firstLine: int = 0
+    callees: list = field(default_factory=list)
+    # Return address of each call, in the binary
+    returnAddrs: list = field(default_factory=list)
+
+
+@dataclass
+class SynthBinary:
+    path: str = ""
+    # Keyed by CODE segment ID, (section name, addr, size)
+    sections: dict = field(default_factory=dict)
+    functions: list = field(default_factory=list)
+    sourcePaths: list = field(default_factory=list)
+
+
+def uleb128(value):
+    result = bytearray()
+    
+    while value >= 0x80:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    
+    result.append(value)
+    
+    return bytes(result)
+
+
+def sleb128(value):
+    result = bytearray()
+    
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        
+        if (value == 0 and (byte & 0x40) == 0) or (value == -1 and (byte & 0x40) != 0):
+            result.append(byte)
+            return bytes(result)
+        
+        result.append(byte | 0x80)
+
+
+def alignUp(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class StringTable:
+    def __init__(self):
+        self.data = bytearray(b"\0")
+        self.offsets = {"": 0}
+    
+    def add(self, s):
+        if s not in self.offsets:
+            self.offsets[s] = len(self.data)
+            self.data += s.encode("utf-8") + b"\0"
+        
+        return self.offsets[s]
+
+
+def buildLineProgram(functions, sourcePaths):
+    """Returns a .debug_line section with a sequence for each function and a
+    row for every lineSize bytes of it, each one line further on"""
+    minInstructionLength = 2
+    lineBase = -5
+    lineRange = 14
+    opcodeBase = 13
+    header = bytearray([minInstructionLength, 1, 1, lineBase & 0xFF, lineRange, opcodeBase])
+    header += bytes([0, 1, 1, 1, 1, 0, 0, 0, 1, 0, 0, 1])
+    header += os.path.dirname(sourcePaths[0]).encode("utf-8") + b"\0\0"
+    
+    for path in sourcePaths:
+        header += os.path.basename(path).encode("utf-8") + b"\0" + uleb128(1) + uleb128(0) + uleb128(0)
+    
+    header += b"\0"
+    nextRowOpcode = (1 - lineBase) + lineRange * (lineSize // minInstructionLength) + opcodeBase
+    program = bytearray()
+    
+    for function in functions:
+        program += b"\0" + uleb128(5) + bytes([DW_LNE_set_address]) + struct.pack(">I", function.addr)
+        program += bytes([DW_LNS_set_file]) + uleb128(function.fileIndex + 1)
+        program += bytes([DW_LNS_advance_line]) + sleb128(function.firstLine - 1)
+        program += bytes([DW_LNS_copy])
+        program += bytes([nextRowOpcode]) * (functionSize // lineSize - 1)
+        program += bytes([DW_LNS_advance_pc]) + uleb128(lineSize // minInstructionLength)
+        program += b"\0" + uleb128(1) + bytes([DW_LNE_end_sequence])
+    
+    unit = struct.pack(">HI", 4, len(header)) + header + program
+    
+    return struct.pack(">I", len(unit)) + unit
+
+
+def writeELF(path, sections, symbols):
+    """Writes a big-endian 32-bit ELF file. sections is a list of (name, type,
+    flags, addr, data) tuples, and symbols a list of (name, value, size,
+    section index) tuples for functions. The symbol table and string tables
+    are added after the given sections."""
+    symbolNames = StringTable()
+    symtab = bytearray(16)
+    
+    for name, value, size, sectionIndex in symbols:
+        symtab += struct.pack(">IIIBBH", symbolNames.add(name), value, size, (STB_GLOBAL << 4) | STT_FUNC, 0,
+                              sectionIndex)
+    
+    symtabIndex = len(sections) + 1
+    sections = sections + [(".symtab", SHT_SYMTAB, 0, 0, bytes(symtab)),
+                           (".strtab", SHT_STRTAB, 0, 0, bytes(symbolNames.data))]
+    sectionNames = StringTable()
+    
+    for name, _, _, _, _ in sections:
+        sectionNames.add(name)
+    
+    sectionNames.add(".shstrtab")
+    sections.append((".shstrtab", SHT_STRTAB, 0, 0, bytes(sectionNames.data)))
+    
+    contents = bytearray(52)
+    headers = bytearray(40)
+    
+    for name, type, flags, addr, data in sections:
+        offset = len(contents)
+        contents += data
+        contents += bytes(alignUp(len(contents), 4) - len(contents))
+        link, info, entsize = (symtabIndex + 1, 1, 16) if type == SHT_SYMTAB else (0, 0, 0)
+        headers += struct.pack(">IIIIIIIIII", sectionNames.add(name), type, flags, addr, offset, len(data), link,
+                               info, 4, entsize)
+    
+    ident = b"\x7fELF" + bytes([1, 2, 1]) + bytes(9)
+    contents[:52] = ident + struct.pack(">HHIIIIIHHHHHH", 2, EM_68K, 1, sections[0][3], 0, len(contents), 0, 52, 0,
+                                        0, 40, len(sections) + 1, len(sections))
+    
+    with open(path, "wb") as f:
+        f.write(contents)
+        f.write(headers)
+
+
+def writeSourceFile(path, functions):
+    lines = []
+    
+    for function in functions:
+        while len(lines) < function.firstLine - 1:
+            lines.append("\n")
+        
+        lines.append(f"void {function.name}(void) {{\n")
+        
+        for i in range(1, functionSize // lineSize):
+            lines.append(f"    step({i});\n")
+        
+        lines.append("}\n")
+    
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def makeBinary(outDir, segmentCount, functionCount, rng):
+    """Writes a binary with functionCount functions split between
+    segmentCount code segments, and source files to go with it. Returns a
+    SynthBinary describing it, with a random call graph between its
+    functions starting from main."""
+    binary = SynthBinary(os.path.join(outDir, binaryName))
+    sourceDir = os.path.join(outDir, "src")
+    os.makedirs(sourceDir, exist_ok=True)
+    segmentStarts = [functionCount * i // segmentCount for i in range(segmentCount + 1)]
+    addr = firstSectionAddr
+    
+    for segmentIndex in range(segmentCount):
+        segmentId = segmentIndex + 1
+        
+        # Retro68 only uses .codeNNNNN sections for apps with more than one segment
+        sectionName = ".text" if segmentCount == 1 else f".code{segmentId:05}"
+        sectionStart = addr
+        
+        for i in range(segmentStarts[segmentIndex], segmentStarts[segmentIndex + 1]):
+            name = "main" if i == 0 else f"func{i:05}"
+            fileIndex = i // functionsPerFile
+            firstLine = (i % functionsPerFile) * linesPerFunction + 1
+            binary.functions.append(SynthFunction(name, segmentId, addr, fileIndex, firstLine))
+            addr += functionSize
+        
+        binary.sections[segmentId] = (sectionName, sectionStart, addr - sectionStart)
+        addr = alignUp(addr, sectionAlignment) + sectionAlignment
+    
+    for fileIndex in range((functionCount + functionsPerFile - 1) // functionsPerFile):
+        path = os.path.join(sourceDir, f"synth{fileIndex:04}.c")
+        binary.sourcePaths.append(path)
+        writeSourceFile(path, binary.functions[fileIndex * functionsPerFile:(fileIndex + 1) * functionsPerFile])
+    
+    # Mostly calls further down the graph, with the odd recursive call
+    for i, function in enumerate(binary.functions):
+        for _ in range(rng.randint(1, maxCallees)):
+            if rng.randrange(20) == 0:
+                callee = i
+            else:
+                callee = min(i + 1 + rng.randrange(max(1, functionCount // 8)), functionCount - 1)
+            
+            function.callees.append(callee)
+            function.returnAddrs.append(function.addr + 8 + 2 * rng.randrange(functionSize // 2 - 8))
+    
+    sections = []
+    
+    for segmentId, (name, sectionAddr, size) in sorted(binary.sections.items()):
+        sections.append((name, SHT_PROGBITS, SHF_ALLOC | SHF_EXECINSTR, sectionAddr, bytes(size)))
+    
+    sections.append((".debug_line", SHT_PROGBITS, 0, 0, buildLineProgram(binary.functions, binary.sourcePaths)))
+    symbols = [(function.name, function.addr, functionSize, function.segmentId) for function in binary.functions]
+    writeELF(binary.path, sections, symbols)
+    
+    return binary
+
+
+def pickROMRoutines(rng):
+    """Returns (start, end) ROM offsets of routines the app calls, leaving out
+    the VBL interrupt handler since the analyzer ignores samples in it"""
+    romMap = analyze.getROMMap(romModel)
+    routines = []
+    
+    for idx in range(len(romMap.sortedAddrs) - 1):
+        start, end = romMap.sortedAddrs[idx], romMap.sortedAddrs[idx + 1]
+        
+        if end - start >= 4 and analyze.romSymbolAtIndex(romMap, idx) != "VBLINT":
+            routines.append((start, end))
+    
+    return rng.sample(routines, min(romRoutineCount, len(routines)))
+
+
+def makeStacks(binary, stackCount, meanDepth, romRatio, rng):
+    """Returns stackCount different stacks, each innermost frame first, of
+    addresses in the binary or tuples of ("rom", offset) for ROM addresses"""
+    functions = binary.functions
+    romRoutines = pickROMRoutines(rng) if romRatio > 0 else []
+    stacks = {}
+    attempts = 0
+    
+    while len(stacks) < stackCount:
+        attempts += 1
+        
+        if attempts > stackCount * 100:
+            raise Exception(f"Couldn't make {stackCount} different stacks, try more functions or deeper stacks")
+        
+        returnAddrs = []
+        function = 0
+        
+        while len(returnAddrs) < maxStackDepth - 2 and rng.random() >= 1 / meanDepth:
+            callee = rng.randrange(len(functions[function].callees))
+            returnAddrs.append(functions[function].returnAddrs[callee])
+            function = functions[function].callees[callee]
+        
+        stack = [functions[function].addr + 2 * rng.randrange(functionSize // 2)]
+        
+        # Sometimes the sample lands in a ROM routine called by the function
+        if rng.random() < romRatio:
+            start, end = rng.choice(romRoutines)
+            stack.insert(0, ("rom", start + 2 * rng.randrange((end - start) // 2)))
+        
+        stack += reversed(returnAddrs)
+        stacks[tuple(stack)] = True
+    
+    return list(stacks.keys())
+
+
+def zipfCounts(stackCount, sampleCount, exponent, rng):
+    """Splits about sampleCount samples between the stacks so that the nth
+    most sampled stack gets a share proportional to 1/n^exponent, with every
+    stack sampled at least once. The ranks are shuffled, so which stacks are
+    hot has nothing to do with the order they were made in."""
+    weights = [1 / (rank ** exponent) for rank in range(1, stackCount + 1)]
+    scale = sampleCount / sum(weights)
+    counts = [max(1, round(weight * scale)) for weight in weights]
+    rng.shuffle(counts)
+    
+    return counts
+
+
+def hashKey(words):
+    # The same as hashKey in hashmap.c
+    hash = 0
+    
+    for word in words:
+        hash = (hash + word) & 0xFFFFFFFF
+        hash = (hash + (hash << 10)) & 0xFFFFFFFF
+        hash ^= hash >> 6
+    
+    hash = (hash + (hash << 3)) & 0xFFFFFFFF
+    hash ^= hash >> 11
+    hash = (hash + (hash << 15)) & 0xFFFFFFFF
+    
+    return hash
+
+
+def bucketCountForSize(sizeBytes):
+    # The same as BucketCountForSize in profiler.c
+    bucketCount = 128
+    
+    while bucketCount * 2 <= sizeBytes // 64 and bucketCount < 65536:
+        bucketCount *= 2
+    
+    return bucketCount
+
+
+def hashtableStats(stacks, counts, bufferSize):
+    """Works out what the profiler's hashtable would have recorded for these
+    stacks, as if each stack was first sampled in order and the rest of its
+    samples came after all of them had been seen"""
+    bucketCount = bucketCountForSize(bufferSize)
+    chains = {}
+    arenaUsed = 0
+    usedBucketCount = 0
+    maxChainLength = 0
+    probeCount = 0
+    # Each stack's bucket, and how many entries were already in its chain
+    entries = []
+    
+    for stack in stacks:
+        bucket = hashKey(stack) & (bucketCount - 1)
+        chainLength = chains.get(bucket, 0)
+        
+        # Looking up a new stack goes through the whole chain before adding it to the front
+        probeCount += chainLength
+        
+        if chainLength == 0:
+            usedBucketCount += 1
+        
+        chains[bucket] = chainLength + 1
+        entries.append((bucket, chainLength))
+        maxChainLength = max(maxChainLength, chainLength + 1)
+        arenaUsed += alignUp(arenaEntrySize + len(stack) * 4, 2)
+    
+    for (bucket, chainLength), count in zip(entries, counts):
+        # Entries added after it are in front of it in the chain
+        probeCount += (count - 1) * (chains[bucket] - chainLength)
+    
+    return {"bucketCount": bucketCount, "arenaUsed": arenaUsed, "arenaSize": bufferSize - bucketCount * 4,
+            "usedBucketCount": usedBucketCount, "maxChainLength": maxChainLength,
+            "lookupCount": sum(counts), "probeCount": probeCount}
+
+
+def writeSystemInfo(f, segmentRanges):
+    model = romModel.encode("mac_roman")
+    pstring = bytes([len(model)]) + model
+    f.write(pstring + bytes(len(pstring) % 2))
+    f.write(struct.pack(">IH", romBase, len(segmentRanges)))
+    
+    for segmentId, (addrStart, addrEnd) in sorted(segmentRanges.items()):
+        f.write(struct.pack(">HII", segmentId, addrStart, addrEnd))
+
+
+def writeProfile(path, segmentRanges, stacks, counts, version=2, sampleRate=1000, bufferSize=None):
+    """Writes a profile the way SaveProfilingData_() does. stacks are lists of
+    the addresses the profiler would have recorded, innermost frame first,
+    and counts how many times each was sampled. version 1 is the format
+    used when there isn't enough memory for the frame table."""
+    stackBytes = sum([alignUp(arenaEntrySize + len(stack) * 4, 2) for stack in stacks])
+    
+    if bufferSize is None:
+        bufferSize = stackBytes + stackBytes // 4 + 4096
+    
+    stats = hashtableStats(stacks, counts, bufferSize)
+    
+    with open(path, "wb") as f:
+        if version == 1:
+            writeSystemInfo(f, segmentRanges)
+            
+            for stack, count in zip(stacks, counts):
+                f.write(struct.pack(f">H{len(stack)}II", len(stack) * 4, *stack, count))
+            
+            return
+        
+        sampleCount = sum(counts)
+        f.write(struct.pack(">4sHH", analyze.profileMagic, 2,
+                            analyze.profileHeader.size + analyze.profileChainStats.size))
+        f.write(analyze.profileHeader.pack(sampleRate, sampleCount * 1000 // sampleRate, sampleCount, 0, 0, 0,
+                                           len(stacks), stats["bucketCount"], stats["arenaUsed"],
+                                           stats["arenaSize"]))
+        f.write(analyze.profileChainStats.pack(stats["usedBucketCount"], stats["maxChainLength"],
+                                               stats["lookupCount"], stats["probeCount"]))
+        writeSystemInfo(f, segmentRanges)
+        frameIndices = {}
+        
+        for stack in stacks:
+            for frame in stack:
+                frameIndices.setdefault(frame, len(frameIndices))
+        
+        f.write(b"FRMS" + struct.pack(f">II{len(frameIndices)}I", 4 + len(frameIndices) * 4, len(frameIndices),
+                                      *frameIndices.keys()))
+        body = bytearray(struct.pack(">I", len(stacks)))
+        
+        for stack, count in zip(stacks, counts):
+            body += uleb128(len(stack))
+            
+            for frame in stack:
+                body += uleb128(frameIndices[frame])
+            
+            body += uleb128(count)
+        
+        f.write(b"STKS" + struct.pack(">I", len(body)) + body)
+
+
+def makeProfile(path, binary, stacks, counts, loadOffset=0, version=2, sampleRate=1000):
+    """Writes a profile of the binary with the given stacks, as though its
+    CODE segments had been loaded one after the other, loadOffset bytes
+    further on than usual"""
+    segmentRanges = {}
+    addr = segmentHeapStart + loadOffset
+    
+    for segmentId, (_, _, size) in sorted(binary.sections.items()):
+        # The profiler skips the 4 byte header at the start of each CODE resource
+        segmentRanges[segmentId] = (addr + 4, addr + 4 + size)
+        addr = alignUp(addr + 4 + size + segmentHeapGap, 4)
+    
+    def globalAddr(frame):
+        # The analyzer takes 2 away from every address, since they're return addresses
+        if isinstance(frame, tuple):
+            return romBase + frame[1] + 2
+        
+        for segmentId, (_, sectionStart, size) in binary.sections.items():
+            if sectionStart <= frame < sectionStart + size:
+                return segmentRanges[segmentId][0] + frame - sectionStart + 2
+    
+    globalStacks = [[globalAddr(frame) for frame in stack] for stack in stacks]
+    writeProfile(path, segmentRanges, globalStacks, counts, version, sampleRate)
+
+
+def makeFixture(outDir, segmentCount=1, functionCount=500, stackCount=5000, meanDepth=8, romRatio=0.3,
+                zipfExponent=1.1, sampleCount=None, profileCount=1, version=2, seed=1):
+    """Writes a binary and profileCount profiles of it into outDir. Each
+    profile has its own stacks and loads the app at a different address.
+    Returns the path of the binary and a list of the profiles' paths."""
+    rng = random.Random(seed)
+    os.makedirs(outDir, exist_ok=True)
+    binary = makeBinary(outDir, segmentCount, functionCount, rng)
+    profilePaths = []
+    
+    if sampleCount is None:
+        sampleCount = stackCount * 20
+    
+    for i in range(profileCount):
+        stacks = makeStacks(binary, stackCount, meanDepth, romRatio, rng)
+        counts = zipfCounts(stackCount, sampleCount, zipfExponent, rng)
+        path = os.path.join(outDir, f"profile{i + 1}.dat")
+        makeProfile(path, binary, stacks, counts, i * 0x8000, version)
+        profilePaths.append(path)
+    
+    return binary.path, profilePaths
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Writes a synthetic binary, with source files and a line table, "
+                                                 "and profiles of it in the profiler's file format")
+    parser.add_argument("out_dir", help="Directory to write everything into")
+    parser.add_argument("--segments", type=int, default=1, help="Number of CODE segments (default: 1)")
+    parser.add_argument("--functions", type=int, default=500, help="Number of functions (default: 500)")
+    parser.add_argument("--stacks", type=int, default=5000, help="Unique stacks in each profile (default: 5000)")
+    parser.add_argument("--depth", type=float, default=8, help="Average stack depth (default: 8)")
+    parser.add_argument("--rom-ratio", type=float, default=0.3,
+                        help="Fraction of stacks that end in a ROM routine (default: 0.3)")
+    parser.add_argument("--zipf", type=float, default=1.1,
+                        help="Exponent of the Zipf distribution of stacks' sample counts (default: 1.1)")
+    parser.add_argument("--samples", type=int, default=None,
+                        help="Roughly how many samples in each profile (default: 20 per stack)")
+    parser.add_argument("--profiles", type=int, default=1, help="Number of profiles to write (default: 1)")
+    parser.add_argument("--format-version", type=int, choices=[1, 2], default=2,
+                        help="Profile format, 1 being the one used without enough memory for the compact format "
+                             "(default: 2)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+    
+    return parser.parse_args()
+
+
+def main():
+    args = parseArgs()
+    
+    if args.segments < 1 or args.functions < args.segments or args.stacks < 1 or args.depth < 1:
+        sys.stderr.write("Error: need at least one segment, function for each segment, stack, and frame per stack\n")
+        sys.exit(1)
+    
+    try:
+        binaryPath, profilePaths = makeFixture(args.out_dir, args.segments, args.functions, args.stacks, args.depth,
+                                               args.rom_ratio, args.zipf, args.samples, args.profiles,
+                                               args.format_version, args.seed)
+    except Exception as e:
+        sys.stderr.write(f"Error: {e}\n")
+        sys.exit(1)
+    
+    print(f"Binary: {binaryPath}")
+    
+    for path in profilePaths:
+        print(f"Profile: {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+// Stands in for the Mac's Types.h, with just what hashmap.c needs, so that it
+// can be built and benchmarked natively
+
+#ifndef TYPES_H
+#define TYPES_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+typedef uint8_t UInt8;
+typedef int8_t SInt8;
+typedef uint16_t UInt16;
+typedef int16_t SInt16;
+typedef uint32_t UInt32;
+typedef int32_t SInt32;
+typedef unsigned char Boolean;
+
+#ifndef true
+    #define true 1
+    #define false 0
+#endif
+
+#endif // TYPES_H
@@ -0,0 +1,255 @@
+//
+// Benchmarks hashmap.c natively, using synthetic stack samples that look like
+// the ones the profiler records: stacks of return addresses built by walking a
+// random call graph, with a few hot stacks sampled far more often than the
+// rest. This makes it possible to measure changes to the hashmap without
+// running anything in an emulator, although of course the timings are only
+// useful for comparing against each other.
+//
+// Usage: HashmapBench [sample count] [unique stack count] [bucket count]
+//
+// With no arguments it runs a few different sizes of profile, each with the
+// old fixed bucket count of 128 and with the count the profiler would pick.
+//
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+
+#include "hashmap.h"
+
+#define kFunctionCount 400
+#define kROMRoutineCount 60
+#define kMaxCallees 6
+#define kMaxStackDepth 48
+#define kAppCodeStart 0x00110000
+#define kFunctionSize 0x200
+#define kROMStart 0x40800000
+#define kROMRoutineSize 0x400
+#define kSampleBufferSize (8 * 1024 * 1024)
+
+typedef struct Stack {
+    UInt16 frameCount;
+    UInt32 frames[kMaxStackDepth + 2];
+} Stack;
+
+typedef struct Function {
+    int calleeCount;
+    int callees[kMaxCallees];
+    UInt32 returnAddrs[kMaxCallees];
+} Function;
+
+static UInt32 randomState = 12345;
+static Function functions[kFunctionCount];
+
+// xorshift32, so the same stacks are generated on every platform
+static UInt32 Random(void)
+{
+    randomState ^= randomState << 13;
+    randomState ^= randomState >> 17;
+    randomState ^= randomState << 5;
+    
+    return randomState;
+}
+
+static UInt32 RandomBelow(UInt32 n)
+{
+    return Random() % n;
+}
+
+static UInt32 FunctionAddr(int function)
+{
+    return kAppCodeStart + function * kFunctionSize;
+}
+
+static void BuildCallGraph(void)
+{
+    int i, j;
+    
+    for(i = 0; i < kFunctionCount; ++i) {
+        Function *function = &functions[i];
+        
+        function->calleeCount = 1 + RandomBelow(kMaxCallees);
+        
+        for(j = 0; j < function->calleeCount; ++j) {
+            // Mostly calls further down the graph, with the odd recursive call
+            if (RandomBelow(20) == 0) {
+                function->callees[j] = i;
+            } else {
+                function->callees[j] = i + 1 + RandomBelow(kFunctionCount / 8);
+                
+                if (function->callees[j] >= kFunctionCount) {
+                    function->callees[j] = kFunctionCount - 1 - RandomBelow(10);
+                }
+            }
+            
+            function->returnAddrs[j] = FunctionAddr(i) + 8 + 2 * RandomBelow(kFunctionSize / 2 - 8);
+        }
+    }
+}
+
+// Walks down from main, stopping at random. The stack ends up innermost frame
+// first, like the ones the profiler records: the PC, then the return addresses.
+static void MakeStack(Stack *stack)
+{
+    UInt32 returnAddrs[kMaxStackDepth];
+    int depth = 0, function = 0, i, callee;
+    
+    while(depth < kMaxStackDepth - 1 && RandomBelow(4) != 0) {
+        callee = RandomBelow(functions[function].calleeCount);
+        returnAddrs[depth++] = functions[function].returnAddrs[callee];
+        function = functions[function].callees[callee];
+    }
+    
+    stack->frameCount = 0;
+    
+    // Sometimes the sample lands in a ROM routine called by the function
+    if (RandomBelow(10) < 3) {
+        stack->frames[stack->frameCount++] = kROMStart + RandomBelow(kROMRoutineCount) * kROMRoutineSize
+                                             + 2 * RandomBelow(kROMRoutineSize / 2);
+        stack->frames[stack->frameCount++] = FunctionAddr(function) + 2 * RandomBelow(kFunctionSize / 2);
+    } else {
+        stack->frames[stack->frameCount++] = FunctionAddr(function) + 2 * RandomBelow(kFunctionSize / 2);
+    }
+    
+    for(i = depth - 1; i >= 0; --i) {
+        stack->frames[stack->frameCount++] = returnAddrs[i];
+    }
+}
+
+// Picks stacks so that the first few are sampled much more often than the
+// rest, as in a real profile where most time goes to a few hot spots
+static UInt32 PickStack(UInt32 stackCount)
+{
+    double u = (double)Random() / 4294967296.0;
+    
+    return (UInt32)(stackCount * u * u * u);
+}
+
+static double Seconds(clock_t start, clock_t end)
+{
+    return (double)(end - start) / CLOCKS_PER_SEC;
+}
+
+// The same as the profiler's BucketCountForSize
+static UInt32 BucketCountForSize(UInt32 sizeBytes)
+{
+    UInt32 bucketCount = 128;
+    
+    while(bucketCount * 2 <= sizeBytes / 64 && bucketCount < 65536) {
+        bucketCount *= 2;
+    }
+    
+    return bucketCount;
+}
+
+static int RunBenchmark(UInt32 sampleCount, UInt32 stackCount, UInt32 bucketCount)
+{
+    Stack *stacks;
+    UInt32 *order, i, *value, lookupCount;
+    UInt8 *mem;
+    HashTable table;
+    clock_t start, end;
+    double insertSeconds, lookupSeconds;
+    
+    stacks = (Stack *)malloc(stackCount * sizeof(Stack));
+    order = (UInt32 *)malloc(sampleCount * sizeof(UInt32));
+    mem = (UInt8 *)malloc(kSampleBufferSize);
+    
+    if (!stacks || !order || !mem) {
+        fprintf(stderr, "Error: out of memory\n");
+        return 1;
+    }
+    
+    randomState = 12345;
+    BuildCallGraph();
+    
+    for(i = 0; i < stackCount; ++i) {
+        MakeStack(&stacks[i]);
+    }
+    
+    for(i = 0; i < sampleCount; ++i) {
+        order[i] = PickStack(stackCount);
+    }
+    
+    if (hashtableInit(&table, mem, kSampleBufferSize, bucketCount) != kHashtableNoErr) {
+        fprintf(stderr, "Error: bucket count must be a power of two\n");
+        return 1;
+    }
+    
+    // Recording samples, as the profiler's timer does
+    start = clock();
+    
+    for(i = 0; i < sampleCount; ++i) {
+        Stack *stack = &stacks[order[i]];
+        
+        if (hashtableInsertOrLookup(&table, (UInt8 *)stack->frames, stack->frameCount * sizeof(UInt32), &value,
+                                    NULL) < 0) {
+            fprintf(stderr, "Error: sample buffer filled up\n");
+            return 1;
+        }
+        
+        (*value)++;
+    }
+    
+    end = clock();
+    insertSeconds = Seconds(start, end);
+    lookupCount = table.lookupCount;
+    
+    printf("%8u samples, %6u stacks, %6u buckets: ", sampleCount, table.entryCount, table.bucketCount);
+    printf("%6.1f ns/sample, load factor %5.2f, longest chain %3u, average chain %5.2f, "
+           "%5.2f compared/sample, %4.1f%% of stacks share a bucket",
+           insertSeconds * 1e9 / sampleCount,
+           (double)table.entryCount / table.bucketCount,
+           table.maxChainLength,
+           (double)table.entryCount / table.usedBucketCount,
+           (double)table.probeCount / lookupCount,
+           100.0 * (table.entryCount - table.usedBucketCount) / table.entryCount);
+    
+    // Looking up every stack once, as when saving
+    start = clock();
+    
+    for(i = 0; i < stackCount; ++i) {
+        if (!hashtableLookup(&table, (UInt8 *)stacks[i].frames, stacks[i].frameCount * sizeof(UInt32), &value)) {
+            fprintf(stderr, "\nError: stack %u is missing\n", i);
+            return 1;
+        }
+    }
+    
+    end = clock();
+    lookupSeconds = Seconds(start, end);
+    printf(", %6.1f ns/lookup\n", lookupSeconds * 1e9 / stackCount);
+    
+    free(stacks);
+    free(order);
+    free(mem);
+    
+    return 0;
+}
+
+int main(int argc, char *argv[])
+{
+    UInt32 sizes[] = {500, 5000, 50000};
+    UInt32 sampleCount = 2000000;
+    int i;
+    
+    if (argc > 1) {
+        sampleCount = strtoul(argv[1], NULL, 10);
+    }
+    
+    if (argc > 2) {
+        UInt32 stackCount = strtoul(argv[2], NULL, 10);
+        UInt32 bucketCount = (argc > 3) ? strtoul(argv[3], NULL, 10) : BucketCountForSize(kSampleBufferSize);
+        
+        return RunBenchmark(sampleCount, stackCount, bucketCount);
+    }
+    
+    for(i = 0; i < (int)(sizeof(sizes) / sizeof(sizes[0])); ++i) {
+        if (RunBenchmark(sampleCount, sizes[i], 128) != 0
+            || RunBenchmark(sampleCount, sizes[i], BucketCountForSize(kSampleBufferSize)) != 0) {
+            return 1;
+        }
+    }
+    
+    return 0;
+}
@@ -46,6 +46,13 @@ int main(void)
         return;
     }
     
+    err = EnableProfilerTimeline(64 * 1024, 10);
+    
+    if (err != noErr) {
+        printLog("Error: EnableProfilerTimeline failed! Error code: %d", err);
+        return;
+    }
+    
     startTime = TickCount();
     StartProfiler();
 
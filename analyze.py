@@ -4,20 +4,70 @@ import sys
 import os
 from pprint import pprint
 import bisect
-from subprocess import check_output
+from subprocess import check_output, Popen, PIPE
 import json
 from dataclasses import dataclass, field
 from collections import Counter
 import argparse
 import json
 import re
+import hashlib
+import pickle
+import tempfile
+import mmap
+import struct
+import array
+import time
+import atexit
+import glob
+import math
+import heapq
+import csv
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from elfdwarf import ELFFile, SHT_PROGBITS, SHF_EXECINSTR
+from flamegraph import formatCollapsedStacks, renderFlameGraph
+from pprof import PprofProfile
+from traps import isTrapWord, trapName
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 llvmSymbolizer = None
 readelfPath = None
+objdumpPath = None
+useReadelf = False
 functionNameMaxChars = 32
 filenameMaxChars = 14
 romMapsDir = os.path.join(os.path.dirname(__file__), "ROM Maps")
 showAddrs = False
+cacheEnabled = True
+cacheDir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "profiler68")
+cacheMaxBytes = 256 * 1024 * 1024
+# Bump this whenever the format of cached data changes so that old entries are ignored
+cacheFormatVersion = 2
+jobCount = os.cpu_count() or 1
+romIndexMagic = b"R68R"
+romIndexFormatVersion = 1
+# magic, version, .map file mtime (ns) and size, ROM size, symbol count, string table size
+romIndexHeader = struct.Struct("<4sIqqIII")
+profileMagic = b"P68K"
+# Version 2 profiles' header, after the magic number, version and header size
+profileHeader = struct.Struct(">IIIIHHIIII")
+# Hashtable chain statistics, which follow the header in profiles that have them
+profileChainStats = struct.Struct(">IIII")
+# Spill count and dropped sample count, which follow the chain statistics
+profileSpillStats = struct.Struct(">II")
+# Bits of the header's flags
+profileSpilledFlag = 1
+profileIncompleteFlag = 2
+# Bits of the flags in call counts
+callCountsTimedFlag = 1
+# Number of addresses written to llvm-symbolizer before reading back its
+# responses. Needs to stay small enough that a batch fits in the pipe's buffer.
+llvmSymbolizerBatchSize = 1000
 
 @dataclass
 class CodeAddrData:
@@ -45,43 +95,156 @@ class CodeSegment:
     sectionStart: int = 0
     sectionEnd: int = 0
 
-samples = {}
-totalSampleCount = 0
-allAddrData = {}
-codeSegments = {}
-romBase = None
-romSize = 0
-romMap = None
-inclusiveTally = {}
-exclusiveTally = {}
-functionSamples = {}
-samplesOutPath = None
+@dataclass
+class ROMMap:
+    name: str = ""
+    size: int = 0
+    # These three are views into the ROM map's compiled index (see
+    # compileROMMapIndex), so use romSymbolAtIndex to get a symbol's name
+    sortedAddrs: list = field(default_factory=list)
+    nameOffsets: list = field(default_factory=list)
+    strings: bytes = b""
+    # Keeps the memory-mapped index open for as long as the views above are in use
+    buffer: object = None
 
+@dataclass
+class SampleSummary:
+    totalSampleCount: float = 0
+    inclusive: dict = field(default_factory=dict)
+    exclusive: dict = field(default_factory=dict)
+    # Keyed by (symbol, file path, line number)
+    lines: dict = field(default_factory=dict)
+    # Keyed by tuple of symbols, outermost function first
+    stacks: dict = field(default_factory=dict)
 
-def readInt(f, size):
-    val = f.read(size)
-    
-    if len(val) != size:
-        raise Exception("Unexpected EOF")
-    
-    return int.from_bytes(val, "big")
+@dataclass
+class Timeline:
+    sliceUSec: int = 0
+    sliceCount: int = 0
+    # True if the profiler ran out of memory for the timeline, in which case
+    # it ends before the profile does
+    overflowed: bool = False
+    # (slice, stack, count) tuples, with stacks as in Profile.rawSamples
+    entries: list = field(default_factory=list)
 
+@dataclass
+class SamplingOverhead:
+    # How many samples were timed, and how long they took
+    sampleCount: int = 0
+    totalMicroseconds: int = 0
+    maxMicroseconds: int = 0
+    # The number of samples that took under 2 microseconds, 2 to 3, 4 to 7,
+    # and so on, with the last bucket counting everything longer
+    histogram: list = field(default_factory=list)
 
-def readPStr(f):
-    length = readInt(f, 1)
-    
-    if length is None:
-        raise Exception("Unexpected EOF")
-    
-    result = f.read(length).decode("mac_roman")
-    
-    if len(result) != length:
-        raise Exception("Unexpected EOF")
-    
-    if (length + 1) % 2 == 1:
-        f.read(1)
-    
-    return result
+@dataclass
+class CallCounts:
+    timed: bool = False
+    # Calls the profiler couldn't count because its table of functions was full
+    droppedCallCount: int = 0
+    # [calls, total microseconds, self microseconds] for each function, keyed
+    # by an address in the function, as with the addresses in stacks
+    functions: dict = field(default_factory=dict)
+
+@dataclass
+class Profile:
+    path: str = None
+    model: str = None
+    romBase: int = 0
+    codeSegments: dict = field(default_factory=dict)
+    rawSamples: dict = field(default_factory=dict)
+    # Usable samples, keyed by stacks of allAddrData keys
+    samples: dict = field(default_factory=dict)
+    version: int = 1
+    # These are only recorded in version 2 profiles, and are None otherwise
+    sampleRate: int = None
+    durationMilliseconds: int = None
+    badSampleCount: int = None
+    # 1 if the profiler ran out of memory for samples, and stopped early
+    errorCode: int = 0
+    # How full the profiler's hashtable was: stackCount, bucketCount,
+    # arenaUsed and arenaSize, and how long its chains got: usedBucketCount,
+    # maxChainLength, lookupCount and probeCount
+    hashtableStats: dict = None
+    # Only for profiles recorded with EnableProfilerTimeline
+    timeline: Timeline = None
+    # For profiles recorded with EnableProfilerSpilling, which are made up of
+    # chunks of samples written out as the profiler's buffers filled up.
+    # Incomplete ones were never finished, so their header is mostly empty.
+    spilled: bool = False
+    incomplete: bool = False
+    spillCount: int = 0
+    droppedSampleCount: int = 0
+    # Only for profiles recorded with EnableProfilerOverheadMeasurement
+    overhead: SamplingOverhead = None
+    # For profiles with named regions (see ProfilerPushRegion): the number of
+    # samples taken in each combination of regions, keyed by tuples of region
+    # names, outermost region first, with () for samples outside any region
+    regionCounts: dict = field(default_factory=dict)
+    # Only for profiles recorded with EnableProfilerInstrumentation
+    callCounts: CallCounts = None
+    # The same call counts, for the functions that could be resolved, keyed
+    # by allAddrData keys
+    calls: CallCounts = None
+    # The timeline's usable samples, as (slice, stack, count) tuples with
+    # stacks as in samples
+    timelineSamples: list = field(default_factory=list)
+
+romMaps = {}
+samplesOutPath = None
+collapsedOutPath = None
+flameGraphOutPath = None
+flameGraphIcicle = False
+flameGraphReverse = False
+pprofOutPath = None
+# Samples per second the profiler was set to take (the second argument to
+# InitProfiler), used to estimate how much time samples represent
+# None means using the rate the profiles were recorded at, if they say, or
+# else defaultSampleRate
+sampleRate = None
+defaultSampleRate = 1000
+# Functions to print annotated disassembly of instead of the usual report
+annotateFunctions = []
+annotateHottestCount = 5
+romImagePath = None
+# Frames narrower than this many pixels get merged together in flame graphs
+flameGraphMinWidth = 0.1
+separateReports = False
+normalizeProfiles = False
+diffJSONPath = None
+diffShowAll = False
+# Chance of a diff reporting any change in a section (functions, lines or stacks) as significant when it's
+# really just sampling noise, corrected for how many changes there are in the section
+diffSignificanceLevel = 0.01
+# How many percentage points a function's share of the samples has to grow by to count as a regression
+diffMinRegressionPercent = 0.5
+binaryHashes = {}
+progbitsSections = {}
+addrToLineTables = {}
+llvmSymbolizerPools = {}
+# Functions, lines, call tree nodes and stack traces with less than this
+# percent of the samples are left out of the report
+minPercent = 0.0
+# Only report this many of the biggest functions and stack traces if set
+topCount = None
+allReportSections = ["inclusive", "exclusive", "calls", "traps", "lines", "tree", "stacks"]
+reportSections = allReportSections
+# How many of the places each trap was called from to report
+trapCallSiteCount = 5
+# How often --watch checks for new profiles, in seconds
+watchPollInterval = 1.0
+showTimeline = False
+timelineCSVPath = None
+# Number of columns the timeline is squeezed into when printed
+timelineColumns = 60
+# (start, end) in seconds, either of which can be None, for restricting
+# reports to part of a profile's timeline
+timeWindow = None
+# Only samples taken inside the region with this name are reported on
+regionName = None
+timelineLevels = " ▁▂▃▄▅▆▇█"
+# Sampling that takes more of the CPU than this gets a warning
+maxSamplingOverheadPercent = 5
 
 
 def macModelToROMMapFilename(model):
@@ -90,12 +253,20 @@ def macModelToROMMapFilename(model):
     return model.replace(' ', '').replace('/', '').replace('Macintosh', 'Mac') + 'ROM.map'
 
 
-def readMPWROMMap(model):
-    global romMap, romSize
+def getROMMap(model):
+    if model not in romMaps:
+        romMaps[model] = readMPWROMMap(model)
     
+    return romMaps[model]
+
+
+def parseMPWROMMap(mapPath):
+    """Parses an MPW ROM map text file. Returns the size of the ROM and a
+    dict mapping ROM offsets to symbol names."""
     result = {}
+    romSize = 0
     
-    with open(os.path.join(romMapsDir, macModelToROMMapFilename(model)), "r") as f:
+    with open(mapPath, "r") as f:
         lines = f.readlines()
         inROMSegment = False
         
@@ -114,10 +285,150 @@ def readMPWROMMap(model):
             if not inROMSegment or len(words) < 3:
                 continue
             
-            addr = int(words[2].split(',')[1], 16)
+            # Names too long for their column push the segment and offset over
+            # one, with whatever's after them ending up in the third column
+            location = words[2] if ',' in words[2] else words[1]
+            
+            if ',' not in location:
+                continue
+            
+            addr = int(location.split(',')[1], 16)
             result[addr] = words[0]
     
-    romMap = (result, sorted(result.keys()))
+    return romSize, result
+
+
+def compileROMMapIndex(mapPath, mapStat):
+    """Turns an MPW ROM map into the compact index format that
+    loadROMMapIndex reads: a header, a sorted array of ROM offsets, an array
+    of offsets into the string table for each one's name (plus one more for
+    the end of the last name), and then the string table."""
+    romSize, symbols = parseMPWROMMap(mapPath)
+    sortedAddrs = sorted(symbols.keys())
+    names = [symbols[addr].encode("utf-8") for addr in sortedAddrs]
+    nameOffsets = [0]
+    
+    for name in names:
+        nameOffsets.append(nameOffsets[-1] + len(name))
+    
+    header = romIndexHeader.pack(romIndexMagic, romIndexFormatVersion, mapStat.st_mtime_ns, mapStat.st_size,
+                                 romSize, len(sortedAddrs), nameOffsets[-1])
+    
+    return b"".join([header,
+                     struct.pack(f"<{len(sortedAddrs)}I", *sortedAddrs),
+                     struct.pack(f"<{len(nameOffsets)}I", *nameOffsets),
+                     *names])
+
+
+def romIndexIsCurrent(data, mapStat):
+    if len(data) < romIndexHeader.size:
+        return False
+    
+    magic, version, mapMTime, mapSize, _, count, stringTableSize = romIndexHeader.unpack_from(data, 0)
+    
+    return (magic == romIndexMagic and version == romIndexFormatVersion
+            and mapMTime == mapStat.st_mtime_ns and mapSize == mapStat.st_size
+            and len(data) == romIndexHeader.size + count * 4 + (count + 1) * 4 + stringTableSize)
+
+
+def loadROMMapIndex(name, data):
+    """Makes a ROMMap that looks things up directly in index data from
+    compileROMMapIndex, which is typically memory-mapped so that only the
+    parts of it we touch get read in."""
+    _, _, _, _, romSize, count, stringTableSize = romIndexHeader.unpack_from(data, 0)
+    view = memoryview(data)
+    addrsStart = romIndexHeader.size
+    offsetsStart = addrsStart + count * 4
+    stringsStart = offsetsStart + (count + 1) * 4
+    
+    if sys.byteorder == "little":
+        sortedAddrs = view[addrsStart:offsetsStart].cast("I")
+        nameOffsets = view[offsetsStart:stringsStart].cast("I")
+    else:
+        sortedAddrs = array.array("I", view[addrsStart:offsetsStart])
+        sortedAddrs.byteswap()
+        nameOffsets = array.array("I", view[offsetsStart:stringsStart])
+        nameOffsets.byteswap()
+    
+    return ROMMap(name, romSize, sortedAddrs, nameOffsets, view[stringsStart:stringsStart + stringTableSize], data)
+
+
+def romIndexPath(mapPath):
+    # Different ROM map directories can have maps with the same name, so the
+    # directory gets a hash in the index's name
+    dirKey = hashlib.sha256(os.path.dirname(os.path.abspath(mapPath)).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cacheDir, "rom-index", f"{os.path.splitext(os.path.basename(mapPath))[0]}-{dirKey}.romidx")
+
+
+def buildROMMapIndex(mapPath, indexPath):
+    mapStat = os.stat(mapPath)
+    data = compileROMMapIndex(mapPath, mapStat)
+    
+    try:
+        os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(indexPath), suffix=".tmp")
+        
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            
+            os.replace(tempPath, indexPath)
+        except BaseException:
+            os.remove(tempPath)
+            raise
+    except OSError as e:
+        sys.stderr.write(f"Warning: couldn't write ROM map index {indexPath}: {e}\n")
+    
+    return data
+
+
+def openROMMapIndex(mapPath):
+    """Returns index data for the given ROM map, memory-mapping the compiled
+    index if it's up to date with the map file and (re)building it first if
+    it isn't."""
+    mapStat = os.stat(mapPath)
+    
+    if not cacheEnabled:
+        return compileROMMapIndex(mapPath, mapStat)
+    
+    indexPath = romIndexPath(mapPath)
+    
+    try:
+        with open(indexPath, "rb") as f:
+            data = mapFile(f)
+        
+        if romIndexIsCurrent(data, mapStat):
+            return data
+        
+        # Let go of the stale index before it's replaced
+        if isinstance(data, mmap.mmap):
+            data.close()
+    except OSError:
+        pass
+    
+    return buildROMMapIndex(mapPath, indexPath)
+
+
+def readMPWROMMap(model):
+    filename = macModelToROMMapFilename(model)
+    return loadROMMapIndex(filename, openROMMapIndex(os.path.join(romMapsDir, filename)))
+
+
+def romSymbolAtIndex(romMap, idx):
+    start = romMap.nameOffsets[idx]
+    return str(romMap.strings[start:romMap.nameOffsets[idx + 1]], "utf-8")
+
+
+def buildAllROMMapIndexes():
+    mapPaths = sorted(glob.glob(os.path.join(glob.escape(romMapsDir), "*.map")))
+    
+    for mapPath in mapPaths:
+        indexPath = romIndexPath(mapPath)
+        data = buildROMMapIndex(mapPath, indexPath)
+        _, _, _, _, romSize, count, _ = romIndexHeader.unpack_from(data, 0)
+        print(f"{os.path.basename(mapPath)}: {count} symbols, ROM size {romSize:#x}")
+    
+    print(f"Built {len(mapPaths)} ROM map indexes in {os.path.join(cacheDir, 'rom-index')}")
 
 
 def findKeyEqualToOrLessThan(m, sortedKeys, k):
@@ -130,25 +441,80 @@ def findKeyEqualToOrLessThan(m, sortedKeys, k):
 
 
 def findROMSymbol(romMap, addr):
-    return findKeyEqualToOrLessThan(romMap[0], romMap[1], addr)
+    idx = bisect.bisect_right(romMap.sortedAddrs, addr) - 1
+    
+    if idx >= 0:
+        return romSymbolAtIndex(romMap, idx)
+    
+    return None
+
+
+def findIndicesEqualToOrLessThan(sortedKeys, queries):
+    """Batch version of findKeyEqualToOrLessThan. For each query returns the
+    index of the greatest key in sortedKeys that is <= the query, or -1 if
+    there isn't one."""
+    if len(queries) == 0:
+        return []
+    
+    if numpy is not None:
+        keys = numpy.asarray(sortedKeys, dtype=numpy.int64)
+        indices = numpy.searchsorted(keys, numpy.asarray(queries, dtype=numpy.int64), side='right') - 1
+        return indices.tolist()
+    
+    # Visit the queries in ascending order so that each search only has to
+    # look at the part of sortedKeys past where the previous one landed
+    result = [-1] * len(queries)
+    lo = 0
+    
+    for i in sorted(range(len(queries)), key=queries.__getitem__):
+        lo = bisect.bisect_right(sortedKeys, queries[i], lo)
+        result[i] = lo - 1
+    
+    return result
 
 
-def readCodeSegments(binaryPath):
-    data = check_output([readelfPath, "--wide", "--sections", binaryPath])
-    sectionData = data.decode('utf-8')
+def getProgbitsSections(binaryPath):
+    """Returns a list of (name, addr, size) tuples for the binary's PROGBITS sections"""
+    stat = os.stat(binaryPath)
+    key = (os.path.abspath(binaryPath), stat.st_size, stat.st_mtime_ns)
+    
+    if key not in progbitsSections:
+        progbitsSections[key] = readProgbitsSections(binaryPath)
+    
+    return progbitsSections[key]
+
+
+def readProgbitsSections(binaryPath):
+    if useReadelf:
+        data = check_output([readelfPath, "--wide", "--sections", binaryPath])
+        sectionData = data.decode('utf-8')
+        entries = re.findall(r"^\s+\[[ 0-9]+]\s+(\S+)\s+PROGBITS\s+([0-9a-fA-F]+)\s+[0-9a-fA-F]+\s+([0-9a-fA-F]+)",
+                             sectionData, re.MULTILINE)
+        return [(name, int(addr, 16), int(size, 16)) for name, addr, size in entries]
+    
+    with ELFFile(binaryPath) as elf:
+        return [(section.name, section.addr, section.size) for section in elf.sections
+                if section.type == SHT_PROGBITS]
+
+
+def readCodeSegments(binaryPath, codeSegments):
+    sections = getProgbitsSections(binaryPath)
     
     if len(codeSegments) == 1:
-        codeSectionEntries = re.findall(r"^\s+\[[ 0-9]+]\s+\.text\s+PROGBITS\s+([0-9a-fA-F]+)\s+[0-9a-fA-F]+\s+([0-9a-fA-F]+)",
-                                        sectionData, re.MULTILINE)
+        codeSectionEntries = [entry for entry in sections if entry[0] == ".text"]
         
         if len(codeSectionEntries) == 0:
             raise Exception("Did not find expected .text section in single-segment application")
         
-        codeSections = {1: (".text", int(codeSectionEntries[0][0], 16), int(codeSectionEntries[0][1], 16))}
+        codeSections = {1: codeSectionEntries[0]}
     else:
-        codeSectionEntries = re.findall(r"^\s+\[[ 0-9]+]\s+(\.code(\d+))\s+PROGBITS\s+([0-9a-fA-F]+)\s+[0-9a-fA-F]+\s+([0-9a-fA-F]+)",
-                                        sectionData, re.MULTILINE)
-        codeSections = {int(entry[1]): (entry[0], int(entry[2], 16), int(entry[3], 16)) for entry in codeSectionEntries}
+        codeSections = {}
+        
+        for name, addr, size in sections:
+            match = re.match(r"^\.code(\d+)$", name)
+            
+            if match is not None:
+                codeSections[int(match.group(1))] = (name, addr, size)
     
     if len(codeSections) != len(codeSegments):
         raise Exception("Different number of code sections in binary and CODE segments in profile")
@@ -156,67 +522,222 @@ def readCodeSegments(binaryPath):
     for segmentId, (segmentName, offset, size) in codeSections.items():
         if segmentId not in codeSegments:
             raise Exception(f"Code section {segmentName} does not have corresponding CODE segment in profile")
-    
+        
         codeSegments[segmentId].sectionStart = offset
         codeSegments[segmentId].sectionEnd = offset + size
 
 
-def findCodeSegmentForGlobalAddr(globalAddr):
-    for codeSegment in codeSegments.values():
-        if globalAddr >= codeSegment.addrStart and globalAddr < codeSegment.addrEnd:
-            return codeSegment
+def readCallSiteWords(binaryPath, addrs):
+    """Returns the three instruction words ending with the one at each of the
+    given addresses in the binary, as a dict of tuples. Words before the start
+    of the address's section are None, and addresses that aren't in any
+    section are left out."""
+    result = {}
     
-    return None
+    with ELFFile(binaryPath) as elf:
+        sections = sorted([section for section in elf.sections
+                           if section.type == SHT_PROGBITS and section.flags & SHF_EXECINSTR],
+                          key=lambda section: section.addr)
+        indices = findIndicesEqualToOrLessThan([section.addr for section in sections], addrs)
+        
+        for addr, idx in zip(addrs, indices):
+            if idx < 0 or addr + 2 > sections[idx].addr + sections[idx].size:
+                continue
+            
+            section = sections[idx]
+            result[addr] = tuple([struct.unpack_from(">H", elf.data, section.offset + wordAddr - section.addr)[0]
+                                  if wordAddr >= section.addr else None
+                                  for wordAddr in (addr - 4, addr - 2, addr)])
+    
+    return result
+
 
+def callSiteTrapWord(words):
+    """Given the instruction words ending just before a return address, returns
+    the A-line trap that was called from there, or None if it wasn't a trap
+    call. A trap is only a word long, so the words are checked for the start
+    of a longer JSR or BSR whose last word happens to look like a trap."""
+    if words is None or not isTrapWord(words[2]):
+        return None
+    
+    # jsr d16(An), d8(An,Xn), abs.w, d16(pc) or d8(pc,Xn), or bsr.w
+    if words[1] is not None and (0x4EA8 <= words[1] <= 0x4EBB or words[1] == 0x6100):
+        return None
+    
+    # jsr abs.l or bsr.l
+    if words[0] is not None and words[0] in (0x4EB9, 0x61FF):
+        return None
+    
+    return words[2]
 
-def processSampleGlobalAddr(globalAddr):
-    if globalAddr in allAddrData:
-        return True
+
+def resolveGlobalAddrs(profile, globalAddrs):
+    """Figures out what each of the given addresses from the profile points
+    to, all in one pass. Returns a dict mapping each address to a tuple of
+    its Analyzer.allAddrData key and a new CodeAddrData, or to None if the address
+    isn't usable (i.e. it's past the end of the ROM, in the VBL interrupt
+    handler, or not in any code segment)."""
+    result = {}
+    romAddrs = []
+    codeAddrs = []
+    romMap = getROMMap(profile.model)
+    romBase = profile.romBase
+    
+    for globalAddr in globalAddrs:
+        if globalAddr >= romBase:
+            if globalAddr >= romBase + romMap.size:
+                # Addr is past the ROM
+                result[globalAddr] = None
+            else:
+                romAddrs.append(globalAddr)
+        else:
+            codeAddrs.append(globalAddr)
     
-    if globalAddr >= romBase:
-        if globalAddr >= romBase + romSize:
-            # Addr is past the ROM
-            return False
-        
+    indices = findIndicesEqualToOrLessThan(romMap.sortedAddrs, [globalAddr - romBase for globalAddr in romAddrs])
+    
+    for globalAddr, idx in zip(romAddrs, indices):
         romAddr = globalAddr - romBase
-        symbol = findROMSymbol(romMap, romAddr)
+        symbol = romSymbolAtIndex(romMap, idx) if idx >= 0 else None
         
         # We don't care about samples happening during a VBL interrupt
         if symbol == "VBLINT":
-            return False
+            result[globalAddr] = None
+        else:
+            result[globalAddr] = ((romMap.name, romAddr),
+                                  CodeAddrData(type='trap', addr=romAddr, symbol=symbol, file=None, line=None))
+    
+    segments = sorted(profile.codeSegments.values(), key=lambda segment: segment.addrStart)
+    indices = findIndicesEqualToOrLessThan([segment.addrStart for segment in segments], codeAddrs)
+    
+    for globalAddr, idx in zip(codeAddrs, indices):
+        if idx < 0 or globalAddr >= segments[idx].addrEnd:
+            # Addr not in any code segment
+            result[globalAddr] = None
+            continue
+        
+        codeSegment = segments[idx]
+        addr = globalAddr - codeSegment.addrStart + codeSegment.sectionStart
+        result[globalAddr] = (addr, CodeAddrData(type='func', addr=addr, symbol=None, file=None, line=None))
+    
+    return result
+
+
+class LLVMSymbolizerWorker:
+    """A long-running llvm-symbolizer process that addresses are fed to over stdin"""
+    
+    def __init__(self, symbolizerPath, binaryPath):
+        self.process = Popen([symbolizerPath, "--output-style=JSON", "--print-source-context-lines=1",
+                              "-f", "-e", binaryPath],
+                             stdin=PIPE, stdout=PIPE, encoding="utf-8")
+    
+    def symbolize(self, localAddrs):
+        results = []
+        
+        for i in range(0, len(localAddrs), llvmSymbolizerBatchSize):
+            batch = localAddrs[i:i + llvmSymbolizerBatchSize]
+            self.process.stdin.write("".join([addr + "\n" for addr in batch]))
+            self.process.stdin.flush()
+            
+            # Each address gets exactly one line of JSON back
+            for _ in batch:
+                line = self.process.stdout.readline()
+                
+                if not line:
+                    raise Exception(f"llvm-symbolizer exited unexpectedly (exit code: {self.process.poll()})")
+                
+                results.append(json.loads(line))
+        
+        return results
+    
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        
+        self.process.wait()
+
+
+class LLVMSymbolizerPool:
+    """A set of llvm-symbolizer workers for a single binary that large sets of
+    addresses are split between"""
+    
+    def __init__(self, symbolizerPath, binaryPath, workerCount):
+        self.symbolizerPath = symbolizerPath
+        self.binaryPath = binaryPath
+        self.workerCount = max(1, workerCount)
+        self.workers = []
+        stat = os.stat(binaryPath)
+        self.binaryStat = (stat.st_size, stat.st_mtime_ns)
+    
+    def isStale(self):
+        stat = os.stat(self.binaryPath)
+        return self.binaryStat != (stat.st_size, stat.st_mtime_ns)
+    
+    def symbolize(self, localAddrs):
+        # No point in spinning up workers that would get less than a batch each
+        batchCount = (len(localAddrs) + llvmSymbolizerBatchSize - 1) // llvmSymbolizerBatchSize
+        workerCount = max(1, min(self.workerCount, batchCount))
+        
+        while len(self.workers) < workerCount:
+            self.workers.append(LLVMSymbolizerWorker(self.symbolizerPath, self.binaryPath))
+        
+        if workerCount == 1:
+            return self.workers[0].symbolize(localAddrs)
+        
+        chunkSize = (len(localAddrs) + workerCount - 1) // workerCount
+        chunks = [localAddrs[i:i + chunkSize] for i in range(0, len(localAddrs), chunkSize)]
+        
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            chunkResults = list(executor.map(lambda worker, chunk: worker.symbolize(chunk), self.workers, chunks))
         
-        allAddrData[globalAddr] = CodeAddrData(type='trap', addr=romAddr, symbol=symbol, file=None, line=None)
+        return [result for results in chunkResults for result in results]
+    
+    def close(self):
+        for worker in self.workers:
+            worker.close()
         
-        return True
+        self.workers = []
+
+
+def getLLVMSymbolizerPool(binaryPath):
+    key = (llvmSymbolizer, os.path.abspath(binaryPath))
+    pool = llvmSymbolizerPools.get(key)
     
-    codeSegment = findCodeSegmentForGlobalAddr(globalAddr)
+    # If the binary was rebuilt then the running processes have the old one loaded
+    if pool is not None and pool.isStale():
+        pool.close()
+        pool = None
     
-    if codeSegment is None:
-        # Addr not in any code segment
-        return False
+    if pool is None:
+        pool = LLVMSymbolizerPool(llvmSymbolizer, binaryPath, jobCount)
+        llvmSymbolizerPools[key] = pool
+    
+    return pool
+
 
-    addr = globalAddr - codeSegment.addrStart + codeSegment.sectionStart
-    allAddrData[globalAddr] = CodeAddrData(type='func', addr=addr, symbol=None, file=None, line=None)
+@atexit.register
+def closeLLVMSymbolizerPools():
+    for pool in llvmSymbolizerPools.values():
+        pool.close()
     
-    return True
+    llvmSymbolizerPools.clear()
 
 
 def determineFileAndLineNumbersUsingLLVM(binaryPath, addrsToProcess):
-    localAddrs = [hex(allAddrData[globalAddr].addr) for globalAddr in addrsToProcess]
+    """Fills in the symbol, file, line and source of each of the given
+    CodeAddrDatas"""
+    localAddrs = [hex(addrData.addr) for addrData in addrsToProcess]
     
     if not os.path.exists(binaryPath):
         raise Exception(f"Can't find binary: {binaryPath}")
     
-    jsonData = check_output([llvmSymbolizer, "--output-style=JSON", "--print-source-context-lines=1",
-                             "-f", "-e", binaryPath] + localAddrs)
-    processedAddrs = json.loads(jsonData)
+    processedAddrs = getLLVMSymbolizerPool(binaryPath).symbolize(localAddrs)
     
     if len(processedAddrs) != len(addrsToProcess):
         raise Exception("Mis-matched data from addr2line")
     
     for i in range(len(addrsToProcess)):
-        globalAddr = addrsToProcess[i]
-        
         if len(processedAddrs[i]["Symbol"]) == 0:
             raise Exception(f"Code offset {localAddrs[i]} has no associated symbol")
         
@@ -225,7 +746,7 @@ def determineFileAndLineNumbersUsingLLVM(binaryPath, addrsToProcess):
                             "Note: linking with -Wl,-gc-sections will cause this to happen.")
         
         data = processedAddrs[i]["Symbol"][0]
-        addrData = allAddrData[globalAddr]
+        addrData = addrsToProcess[i]
         addrData.symbol = data["FunctionName"]
         
         if len(data["FileName"]) > 0 and "Source" in data:
@@ -234,7 +755,193 @@ def determineFileAndLineNumbersUsingLLVM(binaryPath, addrsToProcess):
             addrData.source = data["Source"]
 
 
+def hashBinary(binaryPath):
+    stat = os.stat(binaryPath)
+    key = (os.path.abspath(binaryPath), stat.st_size, stat.st_mtime_ns)
+    
+    if key not in binaryHashes:
+        h = hashlib.sha256()
+        
+        with open(binaryPath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        
+        binaryHashes[key] = h.hexdigest()
+    
+    return binaryHashes[key]
+
+
+def cacheEntryPath(binaryHash, kind):
+    return os.path.join(cacheDir, f"{binaryHash}-{kind}-v{cacheFormatVersion}.pickle")
+
+
+def invalidateStaleCacheEntries(binaryPath, binaryHash):
+    # Remember which hash we last saw for this binary path, so that when the
+    # binary is rebuilt its old entries are removed right away instead of
+    # waiting to be evicted
+    pathKey = hashlib.sha256(os.path.abspath(binaryPath).encode("utf-8")).hexdigest()
+    markerPath = os.path.join(cacheDir, f"{pathKey}.binary")
+    
+    try:
+        with open(markerPath, "r") as f:
+            previousHash = f.read().strip()
+    except OSError:
+        previousHash = None
+    
+    if previousHash == binaryHash:
+        return
+    
+    with open(markerPath, "w") as f:
+        f.write(binaryHash)
+    
+    if not previousHash:
+        return
+    
+    # Another copy of the old binary elsewhere may still be using its entries
+    for name in os.listdir(cacheDir):
+        if not name.endswith(".binary"):
+            continue
+        
+        try:
+            with open(os.path.join(cacheDir, name), "r") as f:
+                if f.read().strip() == previousHash:
+                    return
+        except OSError:
+            pass
+    
+    for name in os.listdir(cacheDir):
+        if name.startswith(previousHash + "-"):
+            try:
+                os.remove(os.path.join(cacheDir, name))
+            except OSError:
+                pass
+
+
+def evictCacheEntries():
+    entries = []
+    
+    for name in os.listdir(cacheDir):
+        if not name.endswith(".pickle"):
+            continue
+        
+        path = os.path.join(cacheDir, name)
+        
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        
+        entries.append((stat.st_mtime, stat.st_size, path))
+    
+    totalSize = sum([size for _, size, _ in entries])
+    
+    # Least recently used entries go first
+    for _, size, path in sorted(entries):
+        if totalSize <= cacheMaxBytes:
+            break
+        
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        
+        totalSize -= size
+
+
+def readCacheEntry(path):
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Corrupted or written by an incompatible version, so toss it
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        
+        return None
+    
+    # Mark it as recently used for LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    
+    return data
+
+
+def writeCacheEntry(path, data):
+    fd, tempPath = tempfile.mkstemp(dir=cacheDir, suffix=".tmp")
+    
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        
+        os.replace(tempPath, path)
+    except BaseException:
+        os.remove(tempPath)
+        raise
+    
+    evictCacheEntries()
+
+
+def cachedBinaryData(binaryPath, kind, producer):
+    """Returns producer(binaryPath), reusing the result from a previous run
+    with the same binary if it's in the cache."""
+    if not cacheEnabled:
+        return producer(binaryPath)
+    
+    binaryHash = hashBinary(binaryPath)
+    
+    try:
+        os.makedirs(cacheDir, exist_ok=True)
+        invalidateStaleCacheEntries(binaryPath, binaryHash)
+    except OSError as e:
+        sys.stderr.write(f"Warning: can't use cache directory {cacheDir}: {e}\n")
+        return producer(binaryPath)
+    
+    path = cacheEntryPath(binaryHash, kind)
+    data = readCacheEntry(path)
+    
+    if data is None:
+        data = producer(binaryPath)
+        
+        try:
+            writeCacheEntry(path, data)
+        except OSError as e:
+            sys.stderr.write(f"Warning: failed to write cache entry {path}: {e}\n")
+    
+    return data
+
+
 def getSymbols(binaryPath):
+    if useReadelf:
+        return cachedBinaryData(binaryPath, "readelf-symbols", readSymbolsUsingReadelf)
+    
+    return cachedBinaryData(binaryPath, "symbols", readSymbols)
+
+
+def readSymbols(binaryPath):
+    symbolsByAddr = {}
+    
+    with ELFFile(binaryPath) as elf:
+        for symbol in elf.symbols():
+            # Same as what we'd get from readelf --symbols
+            if symbol.value == 0 or len(symbol.name) == 0:
+                continue
+            
+            types = symbolsByAddr.setdefault(symbol.value, {})
+            types.setdefault(symbol.type, []).append(symbol.name)
+            
+            if symbol.type == "FUNC" and len(types[symbol.type]) > 1:
+                raise Exception(f"Symbol table has more than one function at same address?! addr: {symbol.value}")
+    
+    return symbolsByAddr
+
+
+def readSymbolsUsingReadelf(binaryPath):
     data = check_output([readelfPath, "--wide", "--symbols", binaryPath])
     symbolData = data.decode('utf-8')
     
@@ -269,6 +976,54 @@ def getSymbols(binaryPath):
 
 
 def getAddrToLineEntries(binaryPath):
+    if useReadelf:
+        return cachedBinaryData(binaryPath, "readelf-lines", readAddrToLineEntriesUsingReadelf)
+    
+    return cachedBinaryData(binaryPath, "lines", readAddrToLineEntries)
+
+
+def readAddrToLineEntries(binaryPath):
+    symbols = getSymbols(binaryPath)
+    addrsData = {}
+    
+    startingBlock = True
+    invalidBlock = False
+    currentFunc = None
+    
+    with ELFFile(binaryPath) as elf:
+        for addr, path, lineNumber, endSequence in elf.lineRows():
+            if endSequence:
+                # End of code block / function
+                startingBlock = True
+                
+                if not invalidBlock:
+                    addrsData[addr] = [path, None, None]
+                
+                continue
+            
+            if startingBlock:
+                # Starting a code block
+                # If its address is 0, then we know it was removed due to linker garbage collection
+                startingBlock = False
+                invalidBlock = (addr == 0)
+                
+                if invalidBlock:
+                    currentFunc = None
+                else:
+                    if addr not in symbols:
+                        raise Exception(f"Started block with address not listed in symbol table?? addr: {addr}")
+                    
+                    currentFunc = symbols[addr]["FUNC"][0] if "FUNC" in symbols[addr] else None
+            
+            if invalidBlock:
+                continue
+            
+            addrsData[addr] = [path, lineNumber, currentFunc]
+    
+    return addrsData
+
+
+def readAddrToLineEntriesUsingReadelf(binaryPath):
     symbols = getSymbols(binaryPath)
     
     data = check_output([readelfPath, "--wide", "--debug-dump=decodedline", binaryPath])
@@ -347,32 +1102,52 @@ def getAddrToLineEntries(binaryPath):
     return addrsData
 
 
-def determineFileAndLineNumbersUsingReadelf(binaryPath, addrsToProcess):
-    def getSourceLine(path, lineNumber):
-        if path not in sourceData:
-            if not os.path.exists(path):
-                sourceData[path] = []
-            else:
-                with open(path, "r") as f:
-                    sourceData[path] = f.readlines()
+def getAddrToLineTable(binaryPath):
+    """Returns the addr to line entries for the binary along with their
+    sorted addresses, keeping them in memory for as long as the binary is
+    unchanged so that repeated symbolication doesn't have to load them again"""
+    stat = os.stat(binaryPath)
+    key = (os.path.abspath(binaryPath), useReadelf)
     
-        lines = sourceData[path]
-        
-        if lineNumber <= 0 or lineNumber > len(lines):
-            return ""
-        else:
-            return lines[lineNumber-1]
+    if key in addrToLineTables and addrToLineTables[key][0] == (stat.st_size, stat.st_mtime_ns):
+        return addrToLineTables[key][1]
     
     addrsData = getAddrToLineEntries(binaryPath)
+    table = (addrsData, sorted(addrsData.keys()))
+    addrToLineTables[key] = ((stat.st_size, stat.st_mtime_ns), table)
     
-    addrsDataSortedKeys = sorted(addrsData.keys())
-    unknownSymbolCount = 0
+    return table
+
+
+def getSourceLine(sourceData, path, lineNumber):
+    """Returns a line from a source file, keeping the files that have been
+    read in sourceData"""
+    if path not in sourceData:
+        if not os.path.exists(path):
+            sourceData[path] = []
+        else:
+            with open(path, "r") as f:
+                sourceData[path] = f.readlines()
+    
+    lines = sourceData[path]
+    
+    if lineNumber <= 0 or lineNumber > len(lines):
+        return ""
+    else:
+        return lines[lineNumber-1]
+
+
+def determineFileAndLineNumbersUsingReadelf(binaryPath, addrsToProcess, unknownSymbolCount=0):
+    """Fills in the symbol, file, line and source of each of the given
+    CodeAddrDatas. Addresses without a symbol are given names numbered from
+    after unknownSymbolCount. Returns the new number of unknown symbols."""
+    addrsData, addrsDataSortedKeys = getAddrToLineTable(binaryPath)
     sourceData = {}
     
-    for i in range(len(addrsToProcess)):
-        globalAddr = addrsToProcess[i]
-        addrData = allAddrData[globalAddr]
-        data = findKeyEqualToOrLessThan(addrsData, addrsDataSortedKeys, addrData.addr)
+    indices = findIndicesEqualToOrLessThan(addrsDataSortedKeys, [addrData.addr for addrData in addrsToProcess])
+    
+    for addrData, idx in zip(addrsToProcess, indices):
+        data = addrsData[addrsDataSortedKeys[idx]] if idx >= 0 else None
         
         if data is None:
             unknownSymbolCount += 1
@@ -383,232 +1158,2006 @@ def determineFileAndLineNumbersUsingReadelf(binaryPath, addrsToProcess):
         addrData.symbol = data[2]
         
         if addrData.file is not None and addrData.line is not None:
-            addrData.source = f"{addrData.line} >: " + getSourceLine(addrData.file, addrData.line)
+            addrData.source = f"{addrData.line} >: " + getSourceLine(sourceData, addrData.file, addrData.line)
         else:
             addrData.source = None
-
-
-def addSampleToFunction(sample, symbol):
-    addrData = allAddrData[sample]
-    
-    if addrData.type == 'trap' or addrData.file is None or addrData.line is None:
-        return
-    
-    if symbol not in functionSamples:
-        functionSamples[symbol] = {}
-    
-    key = (addrData.file, addrData.line)
     
-    if key in functionSamples[symbol]:
-        functionSamples[symbol][key].count += 1
-        functionSamples[symbol][key].addrs[addrData.addr] += 1
-    else:
-        s = FunctionSample()
-        s.count = 1
-        s.line = addrData.line
-        s.file = os.path.basename(addrData.file)[:filenameMaxChars]
-        s.filePath = addrData.file
-        s.symbol = symbol
-        s.source = addrData.source
-        s.addrs[addrData.addr] += 1
-        functionSamples[symbol][key] = s
-
-
-def countSamples():
-    for sample, count in samples.items():
-        addrData = allAddrData[sample[0]]
-        symbol = allAddrData[sample[0]].symbol
-        exclusiveTally[symbol] = exclusiveTally.get(symbol, 0) + count
-        inclusiveTally[symbol] = inclusiveTally.get(symbol, 0) + count
-        addSampleToFunction(sample[0], symbol)
-        
-        for stackItem in sample[1:]:
-            symbol = allAddrData[stackItem].symbol
-            
-            if symbol is None:
-                continue
-            
-            inclusiveTally[symbol] = inclusiveTally.get(symbol, 0) + count
-            addSampleToFunction(stackItem, symbol)
+    return unknownSymbolCount
 
 
-def readProfile(profilePath):
-    global codeSegments, romBase, romMap
-    rawSamples = {}
-    
-    with open(profilePath, "rb") as f:
-        model = readPStr(f)
-        readMPWROMMap(model)
-        romBase = readInt(f, 4)
-        # print(f"romBase: {romBase:8x}")
+def readDisassembly(path, options=("-d",)):
+    """Disassembles a binary with Retro68's objdump. Returns a sorted list of
+    (addr, instruction) tuples and a dict mapping each function's name to
+    its (start, end) address range."""
+    data = check_output([objdumpPath, "--no-show-raw-insn", *options, path])
+    instructions = []
+    functionStarts = []
+    
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        match = re.match(r"^\s*([0-9a-fA-F]+):\t(.*)$", line)
         
-        codeCount = readInt(f, 2)
+        if match is not None:
+            instructions.append((int(match.group(1), 16), match.group(2).strip()))
+            continue
         
-        for i in range(codeCount):
-            codeId = readInt(f, 2)
-            addrStart = readInt(f, 4)
-            addrEnd = readInt(f, 4)
-            # print(f"Code segment {codeId}: {addrStart:8x} - {addrEnd:8x}")
-            codeSegments[codeId] = CodeSegment(addrStart, addrEnd, 0)
+        match = re.match(r"^([0-9a-fA-F]+) <(.+)>:$", line)
         
-        # Obnoxious pattern for checking if we're at EOF:
-        while f.read(1):
-            f.seek(-1, 1)
-            
-            sampleSize = readInt(f, 2) // 4
-            sample = []
-            
-            for i in range(sampleSize):
-                val = readInt(f, 4)
-                val -= 2 # account for this being the return addr, not the addr being executed
-                sample.append(val)
-            
-            count = readInt(f, 4)
-            
-            rawSamples[tuple(sample)] = count
+        if match is not None:
+            functionStarts.append((int(match.group(1), 16), match.group(2)))
+    
+    instructions.sort()
+    functionStarts.sort()
+    functions = {}
+    
+    # Each function runs up to the start of the next one, or the end of the
+    # instructions for the last one
+    for i, (start, name) in enumerate(functionStarts):
+        end = functionStarts[i + 1][0] if i + 1 < len(functionStarts) else instructions[-1][0] + 1
+        functions[name] = (start, end)
     
-    return rawSamples
+    return instructions, functions
 
 
-def sampleHasValidSymbols(sample):
-    return all(map(lambda addr: allAddrData[addr].symbol is not None, sample))
+def getDisassembly(binaryPath):
+    return cachedBinaryData(binaryPath, "disassembly", readDisassembly)
 
 
-def process(profilePath, binaryPath):
-    global allAddrData, samples, totalSampleCount
+def getROMDisassembly(romImagePath, start, end):
+    # Disassembling just the routine, since disassembling the entire ROM from
+    # its first byte can get out of step with the instructions
+    def readROMDisassembly(path):
+        return readDisassembly(path, ("-D", "-b", "binary", "-m", "m68k",
+                                      f"--start-address={start:#x}", f"--stop-address={end:#x}"))[0]
+    
+    return cachedBinaryData(romImagePath, f"rom-disassembly-{start:x}-{end:x}", readROMDisassembly)
 
-    rawSamples = readProfile(profilePath)
-    readCodeSegments(binaryPath)
+
+def findBranchTarget(instruction):
+    # e.g. "bras 1b0 <leafA+0xc>" or "jsr 1c4 <helper>"
+    match = re.match(r"^(?:b|db|j)\S*\s+(?:0x)?([0-9a-fA-F]+)\b", instruction)
     
-    ignoredSamples = 0
-    samples = {}
+    if match is None:
+        return None
     
-    for sample, count in rawSamples.items():
-        usable = len(sample) > 0
-        
-        for i, globalAddr in enumerate(sample):
-            if not processSampleGlobalAddr(globalAddr):
-                usable = False
-                break
-        
-        if usable:
-            if sample in samples:
-                raise Exception("OH NOOOO!")
-            samples[sample] = count
-        else:
-            ignoredSamples += count
+    return int(match.group(1), 16)
 
-    addrsToProcess = [key for key, val in allAddrData.items() if val.type == 'func']
 
-    rawSampleCount = sum(rawSamples.values())
-    print("Total samples in profile: ", rawSampleCount)
-    print("")
-    
-    if llvmSymbolizer is not None:
-        determineFileAndLineNumbersUsingLLVM(binaryPath, addrsToProcess)
-    else:
-        determineFileAndLineNumbersUsingReadelf(binaryPath, addrsToProcess)
-    
-    samples = {sample: count for sample, count in samples.items() if sampleHasValidSymbols(sample)}
-    totalSampleCount = sum(samples.values())
-    
-    print("Usable samples: ", totalSampleCount)
-    print("Unusable samples: ", rawSampleCount - totalSampleCount)
-    
-    countSamples()
-    
-    printResults()
-    
-    if samplesOutPath is not None:
-        writeSamplesAsJSON()
+def mapFile(f):
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files can't be memory-mapped
+        return f.read()
 
 
-def printResults():
-    def printSymbol(symbol, count):
-        percent = ((count * 10000) // totalSampleCount) / 100.0
-        print(f"    {symbol[:functionNameMaxChars]:{functionNameMaxChars}} - {count:8}   {percent:6}%")
-    
-    print("--------------------------------------------")
-    print("Functions by inclusive samples:")
-    print("--------------------------------------------\n")
-    
-    funcList = sorted([(count, symbol) for symbol, count in inclusiveTally.items()], reverse=True)
-    
-    for count, symbol in funcList:
-        printSymbol(symbol, count)
+def readProfileHeader(data):
+    """Reads the header at the start of profile data. Returns a Profile with
+    everything but the samples filled in, and the offset of what follows the
+    header, which is the sample records in version 1 profiles or the chunks
+    in version 2 ones."""
+    profile = Profile()
+    offset = 0
+    
+    if bytes(data[:4]) == profileMagic:
+        if len(data) < 8:
+            raise Exception("Unexpected EOF")
+        
+        profile.version, headerSize = struct.unpack_from(">HH", data, 4)
+        offset = 8
+        
+        if profile.version != 2:
+            raise Exception(f"Unsupported profile version {profile.version}")
+        
+        if headerSize < profileHeader.size or offset + headerSize > len(data):
+            raise Exception("Unexpected EOF")
+        
+        (profile.sampleRate, profile.durationMilliseconds, _, profile.badSampleCount, profile.errorCode, flags,
+         stackCount, bucketCount, arenaUsed, arenaSize) = profileHeader.unpack_from(data, offset)
+        profile.spilled = (flags & profileSpilledFlag) != 0
+        profile.incomplete = (flags & profileIncompleteFlag) != 0
+        profile.hashtableStats = {"stackCount": stackCount, "bucketCount": bucketCount,
+                                  "arenaUsed": arenaUsed, "arenaSize": arenaSize}
+        
+        if headerSize >= profileHeader.size + profileChainStats.size:
+            usedBucketCount, maxChainLength, lookupCount, probeCount = profileChainStats.unpack_from(
+                data, offset + profileHeader.size)
+            profile.hashtableStats.update({"usedBucketCount": usedBucketCount, "maxChainLength": maxChainLength,
+                                           "lookupCount": lookupCount, "probeCount": probeCount})
+        
+        if headerSize >= profileHeader.size + profileChainStats.size + profileSpillStats.size:
+            profile.spillCount, profile.droppedSampleCount = profileSpillStats.unpack_from(
+                data, offset + profileHeader.size + profileChainStats.size)
+        
+        # Skip any fields added by later versions of the profiler
+        offset += headerSize
+    
+    if len(data) < offset + 1 or len(data) < offset + 1 + data[offset]:
+        raise Exception("Unexpected EOF")
+    
+    modelLength = data[offset]
+    profile.model = bytes(data[offset + 1:offset + 1 + modelLength]).decode("mac_roman")
+    offset += 1 + modelLength
     
-    print("\n\n--------------------------------------------")
-    print("Functions by exclusive samples:")
-    print("--------------------------------------------\n")
+    # Keep it word aligned
+    if offset % 2 == 1:
+        offset += 1
+    
+    if offset + 6 > len(data):
+        raise Exception("Unexpected EOF")
     
-    funcList = sorted([(count, symbol) for symbol, count in exclusiveTally.items()], reverse=True)
+    profile.romBase, codeCount = struct.unpack_from(">IH", data, offset)
+    offset += 6
     
-    for count, symbol in funcList:
-        printSymbol(symbol, count)
+    if offset + codeCount * 10 > len(data):
+        raise Exception("Unexpected EOF")
     
-    print("\n\n--------------------------------------------")
-    print("Samples by function and line:")
-    print("--------------------------------------------")
+    for codeId, addrStart, addrEnd in struct.iter_unpack(">HII", data[offset:offset + codeCount * 10]):
+        # print(f"Code segment {codeId}: {addrStart:8x} - {addrEnd:8x}")
+        profile.codeSegments[codeId] = CodeSegment(addrStart, addrEnd, 0)
     
-    for symbol, lineDict in functionSamples.items():
-        funcSamples = sorted(lineDict.values(), key=lambda x: x.line)
-        funcSampleTotalCount = sum([funcSample.count for funcSample in funcSamples])
+    return profile, offset + codeCount * 10
+
+
+def decodeProfileSamples(data, offset):
+    """Generator that decodes the sample records in profile data starting at
+    offset, yielding a (stack, count) tuple for each one. Returns the offset
+    of the chunks after the samples, if there are any."""
+    end = len(data)
+    recordFormats = {}
+    
+    while offset < end:
+        if offset + 2 > end:
+            raise Exception("Unexpected EOF")
         
-        if funcSampleTotalCount == 0:
-            continue
+        frameCount = ((data[offset] << 8) | data[offset + 1]) // 4
         
-        print(f"\n=== {symbol + ' ':=<40}")
+        if frameCount == 0:
+            # Marks the end of the samples and the start of the chunks
+            return offset + 2
         
-        for funcSample in funcSamples:
-            percent = (funcSample.count * 10000 // funcSampleTotalCount) / 100.0
-            print(f"  count:{funcSample.count:6} {percent:6}%  {funcSample.file:>{filenameMaxChars}}  {funcSample.source.strip()}")
+        recordFormat = recordFormats.get(frameCount)
+        
+        if recordFormat is None:
+            # The stack's addresses followed by its count
+            recordFormat = struct.Struct(f">{frameCount + 1}I")
+            recordFormats[frameCount] = recordFormat
+        
+        if offset + 2 + recordFormat.size > end:
+            raise Exception("Unexpected EOF")
+        
+        values = recordFormat.unpack_from(data, offset + 2)
+        offset += 2 + recordFormat.size
+        
+        # Subtract 2 to account for these being return addrs, not the addrs being executed
+        yield tuple([val - 2 for val in values[:-1]]), values[-1]
+    
+    return end
+
 
-            if showAddrs:
-                print("     " + ", ".join([f"{addr:x} x{count}" for addr, count in funcSample.addrs.items()]))
+def readProfileChunks(data, offset, incomplete=False):
+    """Reads the tagged chunks of extra data that can follow the samples,
+    returning a list of (tag, contents) tuples in the order they're in. A tag
+    can appear more than once, as in spilled profiles. Chunks that this
+    version doesn't know about are skipped over by whoever is reading them.
+    If incomplete is set, the profiler may have stopped partway through
+    writing the last chunk, so it's dropped rather than being an error."""
+    chunks = []
+    end = len(data)
+    
+    while offset < end:
+        if offset + 8 > end:
+            if incomplete:
+                break
+            
+            raise Exception("Unexpected EOF")
         
-    print("")
+        tag, length = struct.unpack_from(">4sI", data, offset)
+        
+        # Chunks whose length is filled in after they're written (e.g. STKS) still have a length of 0 if the
+        # profiler didn't get that far
+        if incomplete and (length == 0 or offset + 8 + length > end):
+            break
+        
+        offset += 8
+        
+        if offset + length > end:
+            raise Exception("Unexpected EOF")
+        
+        chunks.append((tag.decode("mac_roman"), bytes(data[offset:offset + length])))
+        offset += length
     
-    print("\n\n--------------------------------------------")
-    print("All stack traces:")
-    print("--------------------------------------------")
+    if offset < end:
+        sys.stderr.write(f"Warning: ignoring the last {end - offset} bytes of an incomplete profile, which the "
+                         f"profiler didn't finish writing\n")
     
-    stackTraces = {}
+    return chunks
+
+
+def findChunk(chunks, tag):
+    """Returns the contents of the first chunk with the given tag, or None"""
+    for chunkTag, contents in chunks:
+        if chunkTag == tag:
+            return contents
     
-    for sample, count in samples.items():
-        sampleSymbols = tuple(reversed([allAddrData[globalAddr].symbol for globalAddr in sample]))
+    return None
+
+
+def decodeTimeline(chunk, stacks):
+    """Decodes a TIME chunk. stacks is the profile's stacks in the order they
+    were saved in, which is what the timeline's stack ids refer to."""
+    if len(chunk) < 12:
+        raise Exception("Unexpected EOF in timeline")
+    
+    sliceUSec, sliceCount, flags = struct.unpack_from(">IIH", chunk, 0)
+    timeline = Timeline(sliceUSec, sliceCount, (flags & 1) != 0)
+    
+    for timeSlice, stackId, count in struct.iter_unpack(">IHH", chunk[12:12 + (len(chunk) - 12) // 8 * 8]):
+        # Stacks past the first 65535 don't have an id, and stacks are None if
+        # they were left out of the profile
+        if stackId < len(stacks) and stackId != 0xFFFF and stacks[stackId] is not None:
+            timeline.entries.append((timeSlice, stacks[stackId], count))
+    
+    return timeline
+
+
+def decodeOverhead(chunk):
+    if len(chunk) < 20:
+        raise Exception("Unexpected EOF in sampling overhead")
+    
+    sampleCount, totalHi, totalLo, maxMicroseconds, bucketCount = struct.unpack_from(">IIIIH", chunk, 0)
+    
+    if len(chunk) < 20 + bucketCount * 4:
+        raise Exception("Unexpected EOF in sampling overhead")
+    
+    return SamplingOverhead(sampleCount, (totalHi << 32) | totalLo, maxMicroseconds,
+                            list(struct.unpack_from(f">{bucketCount}I", chunk, 20)))
+
+
+def decodeCallCounts(chunk):
+    if len(chunk) < 12:
+        raise Exception("Unexpected EOF in call counts")
+    
+    functionCount, flags, _, droppedCallCount = struct.unpack_from(">IHHI", chunk, 0)
+    
+    if len(chunk) < 12 + functionCount * 24:
+        raise Exception("Unexpected EOF in call counts")
+    
+    callCounts = CallCounts(timed=(flags & callCountsTimedFlag) != 0, droppedCallCount=droppedCallCount)
+    
+    for addr, calls, totalHi, totalLo, selfHi, selfLo in struct.iter_unpack(">6I", chunk[12:12 + functionCount * 24]):
+        # Like the return addresses in stacks, the address is just after a call
+        callCounts.functions[addr - 2] = [calls, (totalHi << 32) | totalLo, (selfHi << 32) | selfLo]
+    
+    return callCounts
+
+
+def decodeRegionNames(chunk):
+    """Decodes a RGNS chunk, returning a dict of region names by id"""
+    if len(chunk) < 2:
+        raise Exception("Unexpected EOF in region names")
+    
+    names = {}
+    offset = 2
+    
+    for regionId in range(1, struct.unpack_from(">H", chunk, 0)[0] + 1):
+        if offset >= len(chunk) or offset + 1 + chunk[offset] > len(chunk):
+            raise Exception("Unexpected EOF in region names")
         
-        if sampleSymbols not in stackTraces:
-            stackTraces[sampleSymbols] = count
+        names[regionId] = chunk[offset + 1:offset + 1 + chunk[offset]].decode("mac_roman")
+        offset += 1 + chunk[offset]
+    
+    return names
+
+
+def splitRegions(stack):
+    """Splits the ids of the regions a sample was taken in off the end of its
+    stack, returning the stack and the ids, outermost region first. They're
+    saved as odd numbers, which return addresses never are."""
+    regionCount = 0
+    
+    while regionCount < len(stack) and stack[-1 - regionCount] & 1:
+        regionCount += 1
+    
+    if regionCount == 0:
+        return stack, ()
+    
+    # Like every address, they've had 2 subtracted from them
+    return stack[:-regionCount], tuple([(value + 2) >> 1 for value in reversed(stack[-regionCount:])])
+
+
+def decodeVarints(data):
+    values = []
+    value = 0
+    shift = 0
+    
+    for byte in data:
+        if byte < 0x80:
+            values.append(value | (byte << shift))
+            value = 0
+            shift = 0
         else:
-            stackTraces[sampleSymbols] += count
+            value |= (byte & 0x7F) << shift
+            shift += 7
+    
+    if shift != 0:
+        raise Exception("Unexpected EOF in varint")
+    
+    return values
+
+
+def decodeFrameTable(frameTable):
+    frameCount = struct.unpack_from(">I", frameTable, 0)[0] if len(frameTable) >= 4 else None
     
-    sortedStackTraces = sorted([(count, sampleSymbols) for sampleSymbols, count in stackTraces.items()], reverse=True)
+    if frameCount is None or len(frameTable) < 4 + frameCount * 4:
+        raise Exception("Unexpected EOF in frame table")
     
-    for count, sampleSymbols in sortedStackTraces:
-        percent = (count * 10000 // totalSampleCount) / 100.0
-        print(f"\n({count} times / {percent:6}%)")
-        for i, sampleSymbol in enumerate(sampleSymbols):
-            spaces = ' ' * (i+1) * 2
-            print(f"{spaces}{sampleSymbol}")
+    # Subtract 2 to account for these being return addrs, not the addrs being executed
+    return [val - 2 for val in struct.unpack_from(f">{frameCount}I", frameTable, 4)]
+
+
+def decodeCompactStacks(stacks, frames):
+    if len(stacks) < 4:
+        raise Exception("Unexpected EOF in stacks")
+    
+    stackCount = struct.unpack_from(">I", stacks, 0)[0]
+    values = decodeVarints(stacks[4:])
+    i = 0
+    
+    try:
+        for _ in range(stackCount):
+            stackLength = values[i]
+            yield tuple([frames[index] for index in values[i + 1:i + 1 + stackLength]]), values[i + 1 + stackLength]
+            i += stackLength + 2
+    except IndexError:
+        raise Exception("Unexpected EOF in stacks")
+
+
+def decodeCompactSamples(chunks, spilled=False):
+    """Generator that decodes the samples in a version 2 profile's FRMS and
+    STKS chunks, yielding a (stack, count) tuple for each one. Spilled
+    profiles have a FRMS and STKS chunk for each time the profiler wrote its
+    samples out, or a RECS chunk of version 1 sample records instead when it
+    was short of memory, and may have none at all if nothing was written."""
+    frames = None
+    foundSamples = False
+    
+    for tag, contents in chunks:
+        if tag == "FRMS":
+            frames = decodeFrameTable(contents)
+        elif tag == "STKS":
+            if frames is None:
+                raise Exception("Profile's stacks come before its frame table")
+            
+            foundSamples = True
+            yield from decodeCompactStacks(contents, frames)
+            
+            # Each set of stacks has its own frame table
+            frames = None
+        elif tag == "RECS":
+            foundSamples = True
+            yield from decodeProfileSamples(contents, 0)
+    
+    if not foundSamples and not spilled:
+        raise Exception("Profile is missing its frame table or stacks")
+
 
+def decodeProfileRecords(data, profile, offset):
+    """Generator that yields a (stack, count) tuple for each sample in a
+    profile of either version, in the order they were saved in, given the
+    Profile and offset from readProfileHeader. Returns the profile's chunks."""
+    if profile.version == 1:
+        chunksOffset = yield from decodeProfileSamples(data, offset)
+        return readProfileChunks(data, chunksOffset)
+    
+    chunks = readProfileChunks(data, offset, profile.incomplete)
+    yield from decodeCompactSamples(chunks, profile.spilled)
+    
+    return chunks
 
-def writeSamplesAsJSON():
-    fileAndLineData = {}
+
+def iterProfileSamples(profilePath):
+    """Generator that yields a (stack, count) tuple for each sample in the
+    profile, without reading the whole profile in first."""
+    with open(profilePath, "rb") as f:
+        data = mapFile(f)
+        
+        try:
+            profile, offset = readProfileHeader(data)
+            yield from decodeProfileRecords(data, profile, offset)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def splitProfileRegions(profile, stacks, regionNames, region):
+    """Takes the region ids off the end of the profile's raw samples, counting
+    the samples in each combination of regions in regionCounts. If region is
+    given, only the samples inside that region are kept. Returns stacks, the
+    profile's stacks in the order they were saved in, without their region
+    ids, and with None for the ones that weren't kept."""
+    rawSamples = profile.rawSamples
+    profile.rawSamples = {}
+    regionPaths = {(): ()}
+    
+    for stack, count in rawSamples.items():
+        stack, regionIds = splitRegions(stack)
+        path = regionPaths.get(regionIds)
+        
+        if path is None:
+            path = tuple([regionNames.get(regionId, f"region {regionId}") for regionId in regionIds])
+            regionPaths[regionIds] = path
+        
+        profile.regionCounts[path] = profile.regionCounts.get(path, 0) + count
+        
+        if region is None or region in path:
+            profile.rawSamples[stack] = profile.rawSamples.get(stack, 0) + count
     
-    for symbol, lineDict in functionSamples.items():
-        funcSamples = sorted(lineDict.values(), key=lambda x: x.line)
+    keptStacks = []
+    
+    for stack in stacks:
+        stack, regionIds = splitRegions(stack)
+        keptStacks.append(stack if region is None or region in regionPaths[regionIds] else None)
+    
+    return keptStacks
+
+
+def readProfile(profilePath, region=None):
+    """Reads a profile. If region is given, only samples taken inside the
+    region with that name are kept, though the profile's regionCounts still
+    count all of them."""
+    with open(profilePath, "rb") as f:
+        data = mapFile(f)
         
-        for funcSample in funcSamples:
-            if funcSample.filePath not in fileAndLineData:
-                fileAndLineData[funcSample.filePath] = {}
+        try:
+            profile, offset = readProfileHeader(data)
+            profile.path = profilePath
+            # print(f"romBase: {profile.romBase:8x}")
+            
+            records = decodeProfileRecords(data, profile, offset)
+            stacks = []
+            
+            while True:
+                try:
+                    stack, count = next(records)
+                except StopIteration as stop:
+                    chunks = stop.value
+                    break
+                
+                stacks.append(stack)
+                profile.rawSamples[stack] = profile.rawSamples.get(stack, 0) + count
+            
+            regionNamesChunk = findChunk(chunks, "RGNS")
+            
+            if regionNamesChunk is not None:
+                regionNames = decodeRegionNames(regionNamesChunk)
+                
+                if region is not None and region not in regionNames.values():
+                    raise Exception(f"{profilePath} doesn't have a region named {region!r}. Its regions are: "
+                                    + ", ".join(sorted(set(regionNames.values()))))
+                
+                stacks = splitProfileRegions(profile, stacks, regionNames, region)
+            elif region is not None:
+                raise Exception(f"{profilePath} doesn't have any named regions (see ProfilerPushRegion), so it "
+                                f"can't be restricted to one")
+            
+            timelineChunk = findChunk(chunks, "TIME")
+            
+            if timelineChunk is not None:
+                profile.timeline = decodeTimeline(timelineChunk, stacks)
+            
+            overheadChunk = findChunk(chunks, "OVHD")
             
-            percent = (funcSample.count * 10000 // totalSampleCount) / 100.0
+            if overheadChunk is not None:
+                profile.overhead = decodeOverhead(overheadChunk)
             
-            fileAndLineData[funcSample.filePath][funcSample.line] = {"count": funcSample.count, "percent": percent}        
+            callCountsChunk = findChunk(chunks, "CALL")
+            
+            if callCountsChunk is not None:
+                profile.callCounts = decodeCallCounts(callCountsChunk)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+    
+    return profile
+
+
+def readProfiles(profilePaths, region=None):
+    if len(profilePaths) > 1 and jobCount > 1:
+        with ProcessPoolExecutor(max_workers=min(jobCount, len(profilePaths))) as executor:
+            return list(executor.map(readProfile, profilePaths, [region] * len(profilePaths)))
+    
+    return [readProfile(profilePath, region) for profilePath in profilePaths]
+
 
-    with open(samplesOutPath, "w") as f:
-        f.write(json.dumps(fileAndLineData))
+def expandProfilePaths(paths):
+    result = []
+    
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+            
+            if len(matches) == 0:
+                raise Exception(f"No profiles match: {path}")
+            
+            result.extend(matches)
+        else:
+            result.append(path)
+    
+    return result
+
+
+class CallTree:
+    """Prefix trie of stack traces, starting from the outermost function.
+    Symbols are interned, and nodes are stored as parallel lists indexed by
+    node id, with node 0 being the root, so that large profiles don't need
+    an object per node."""
+    
+    def __init__(self):
+        self.symbols = []
+        self.symbolIds = {}
+        self.parents = [-1]
+        self.nodeSymbols = [-1]
+        self.selfCounts = [0]
+        self.totalCounts = [0]
+        # Keyed by (parent node id, symbol id)
+        self.childIds = {}
+    
+    def symbolId(self, symbol):
+        symbolId = self.symbolIds.get(symbol)
+        
+        if symbolId is None:
+            symbolId = len(self.symbols)
+            self.symbolIds[symbol] = symbolId
+            self.symbols.append(symbol)
         
+        return symbolId
+    
+    def insert(self, stackSymbols, count):
+        """Adds count samples for a stack of symbols, outermost first"""
+        nodeId = 0
+        self.totalCounts[0] += count
+        
+        for symbol in stackSymbols:
+            key = (nodeId, self.symbolId(symbol))
+            childId = self.childIds.get(key)
+            
+            if childId is None:
+                childId = len(self.parents)
+                self.childIds[key] = childId
+                self.parents.append(nodeId)
+                self.nodeSymbols.append(key[1])
+                self.selfCounts.append(0)
+                self.totalCounts.append(0)
+            
+            nodeId = childId
+            self.totalCounts[nodeId] += count
+        
+        self.selfCounts[nodeId] += count
+    
+    def symbolOf(self, nodeId):
+        return self.symbols[self.nodeSymbols[nodeId]]
+    
+    def path(self, nodeId):
+        """Returns the symbols from the outermost function down to nodeId"""
+        result = []
+        
+        while nodeId > 0:
+            result.append(self.symbolOf(nodeId))
+            nodeId = self.parents[nodeId]
+        
+        return tuple(reversed(result))
+    
+    def children(self):
+        """Returns a list of each node's children, biggest first"""
+        result = [[] for _ in self.parents]
+        
+        for nodeId in range(1, len(self.parents)):
+            result[self.parents[nodeId]].append(nodeId)
+        
+        for childIds in result:
+            childIds.sort(key=lambda childId: -self.totalCounts[childId])
+        
+        return result
+    
+    def stackTraces(self):
+        """Returns sample counts keyed by tuples of symbols, starting from the
+        outermost function"""
+        return {self.path(nodeId): count for nodeId, count in enumerate(self.selfCounts) if nodeId > 0 and count > 0}
+
+
+class Analyzer:
+    """Holds everything learned about a binary's addresses and the samples
+    being reported on, so that it can be reused for more than one set of
+    profiles. Addresses that have already been symbolicated aren't looked up
+    again, and the binary's symbol and line tables stay loaded in between.
+
+    Typical use:
+        analyzer = Analyzer(binaryPath)
+        profile = analyzer.loadProfile(profilePath)
+        analyzer.symbolicate()
+        analyzer.aggregate(profile.samples)
+        analyzer.printResults()
+    """
+    
+    def __init__(self, binaryPath):
+        self.binaryPath = binaryPath
+        self.binaryStat = None
+        # Keyed by the address in the binary for addresses in our code, or a
+        # tuple of (ROM map name, ROM offset) for addresses in ROM, so that
+        # samples from profiles where the app was loaded at different
+        # addresses or that were taken on different machines can be merged
+        self.allAddrData = {}
+        self.unsymbolicatedKeys = []
+        self.unknownSymbolCount = 0
+        self.samples = {}
+        self.totalSampleCount = 0
+        self.inclusiveTally = {}
+        self.exclusiveTally = {}
+        self.functionSamples = {}
+        self.functionCalls = {}
+        self.callsTimed = False
+        # The A-line trap called from each code address that's been checked,
+        # or None if it isn't a trap call
+        self.trapCalls = {}
+        self.callTree = CallTree()
+        self.sampleRate = defaultSampleRate
+    
+    def checkBinary(self):
+        # If the binary was rebuilt then everything we know about its
+        # addresses is out of date
+        stat = os.stat(self.binaryPath)
+        binaryStat = (stat.st_size, stat.st_mtime_ns)
+        
+        if self.binaryStat is not None and self.binaryStat != binaryStat:
+            self.allAddrData = {}
+            self.unsymbolicatedKeys = []
+            self.unknownSymbolCount = 0
+            self.trapCalls = {}
+        
+        self.binaryStat = binaryStat
+    
+    def loadProfile(self, profilePath):
+        return self.loadProfiles([profilePath])[0]
+    
+    def loadProfiles(self, profilePaths):
+        """Reads the profiles and resolves their addresses. Returns the
+        profiles, with their usable samples in profile.samples. Their
+        addresses still need symbolicating before they can be reported on."""
+        profiles = readProfiles(profilePaths, regionName)
+        self.checkBinary()
+        self.sampleRate = profilesSampleRate(profiles)
+        
+        for profile in profiles:
+            if timeWindow is not None:
+                restrictToTimeWindow(profile, timeWindow)
+            
+            readCodeSegments(self.binaryPath, profile.codeSegments)
+            self.addProfileAddrs(profile)
+        
+        return profiles
+    
+    def addProfileAddrs(self, profile):
+        """Resolves all the addresses in the profile's raw samples, adding the
+        new ones to allAddrData, and fills in profile.samples with its usable
+        samples."""
+        uniqueAddrs = set()
+        
+        for sample in profile.rawSamples:
+            uniqueAddrs.update(sample)
+        
+        if profile.callCounts is not None:
+            uniqueAddrs.update(profile.callCounts.functions)
+        
+        resolvedAddrs = resolveGlobalAddrs(profile, uniqueAddrs)
+        profile.samples = {}
+        resolvedSamples = {}
+        
+        for sample, count in profile.rawSamples.items():
+            usable = len(sample) > 0
+            keys = []
+            
+            for globalAddr in sample:
+                resolved = resolvedAddrs[globalAddr]
+                
+                if resolved is None:
+                    usable = False
+                    break
+                
+                key, addrData = resolved
+                
+                if key not in self.allAddrData:
+                    self.allAddrData[key] = addrData
+                    
+                    if addrData.type == 'func':
+                        self.unsymbolicatedKeys.append(key)
+                
+                keys.append(key)
+            
+            if usable:
+                keys = tuple(keys)
+                profile.samples[keys] = profile.samples.get(keys, 0) + count
+                resolvedSamples[sample] = keys
+        
+        if profile.timeline is not None:
+            profile.timelineSamples = [(timeSlice, resolvedSamples[sample], count)
+                                       for timeSlice, sample, count in profile.timeline.entries
+                                       if sample in resolvedSamples]
+        
+        profile.calls = None
+        
+        if profile.callCounts is not None:
+            profile.calls = CallCounts(timed=profile.callCounts.timed,
+                                       droppedCallCount=profile.callCounts.droppedCallCount)
+            
+            for globalAddr, counts in profile.callCounts.functions.items():
+                resolved = resolvedAddrs[globalAddr]
+                
+                # Only functions in our code segments can have been instrumented
+                if resolved is None or resolved[1].type != 'func':
+                    continue
+                
+                key, addrData = resolved
+                
+                if key not in self.allAddrData:
+                    self.allAddrData[key] = addrData
+                    self.unsymbolicatedKeys.append(key)
+                
+                profile.calls.functions[key] = counts
+    
+    def symbolicate(self):
+        """Symbolicates the addresses that have been added since the last
+        time this was called. Returns how many there were."""
+        addrsToProcess = [self.allAddrData[key] for key in self.unsymbolicatedKeys]
+        
+        if len(addrsToProcess) > 0:
+            if llvmSymbolizer is not None:
+                determineFileAndLineNumbersUsingLLVM(self.binaryPath, addrsToProcess)
+            else:
+                self.unknownSymbolCount = determineFileAndLineNumbersUsingReadelf(self.binaryPath, addrsToProcess,
+                                                                                  self.unknownSymbolCount)
+        
+        self.unsymbolicatedKeys = []
+        
+        return len(addrsToProcess)
+    
+    def sampleHasValidSymbols(self, sample):
+        return all(map(lambda addr: self.allAddrData[addr].symbol is not None, sample))
+    
+    def removeUnsymbolicatedSamples(self, profiles):
+        for profile in profiles:
+            profile.samples = {sample: count for sample, count in profile.samples.items()
+                               if self.sampleHasValidSymbols(sample)}
+            profile.timelineSamples = [entry for entry in profile.timelineSamples if entry[1] in profile.samples]
+    
+    def aggregate(self, samples, countLines=True, buildCallTree=True, calls=None):
+        """Makes samples the samples that are counted and reported on. Counting
+        samples by line and building the call tree can be skipped when
+        they're not going to be used, since they take most of the time.
+        calls is the CallCounts to report alongside them, if there are any."""
+        self.samples = samples
+        self.totalSampleCount = sum(samples.values())
+        self.inclusiveTally = {}
+        self.exclusiveTally = {}
+        self.functionSamples = {}
+        self.callTree = CallTree()
+        self.countSamples(countLines, buildCallTree)
+        self.countCalls(calls)
+    
+    def countCalls(self, calls):
+        self.functionCalls = {}
+        self.callsTimed = calls is not None and calls.timed
+        
+        if calls is None:
+            return
+        
+        for key, counts in calls.functions.items():
+            symbol = self.allAddrData[key].symbol
+            
+            if symbol is None:
+                continue
+            
+            # Functions can be counted at more than one address if they were
+            # inlined into a function that's also instrumented
+            total = self.functionCalls.setdefault(symbol, [0, 0, 0])
+            
+            for i in range(3):
+                total[i] += counts[i]
+    
+    def addSampleToFunction(self, sample, symbol, count):
+        addrData = self.allAddrData[sample]
+        
+        if addrData.type == 'trap' or addrData.file is None or addrData.line is None:
+            return
+        
+        if symbol not in self.functionSamples:
+            self.functionSamples[symbol] = {}
+        
+        key = (addrData.file, addrData.line)
+        
+        if key in self.functionSamples[symbol]:
+            self.functionSamples[symbol][key].count += count
+            self.functionSamples[symbol][key].addrs[addrData.addr] += count
+        else:
+            s = FunctionSample()
+            s.count = count
+            s.line = addrData.line
+            s.file = os.path.basename(addrData.file)[:filenameMaxChars]
+            s.filePath = addrData.file
+            s.symbol = symbol
+            s.source = addrData.source
+            s.addrs[addrData.addr] += count
+            self.functionSamples[symbol][key] = s
+    
+    def countSamples(self, countLines=True, buildCallTree=True):
+        for sample, count in self.samples.items():
+            symbols = [self.allAddrData[stackItem].symbol for stackItem in sample]
+            self.exclusiveTally[symbols[0]] = self.exclusiveTally.get(symbols[0], 0) + count
+            
+            if buildCallTree:
+                self.callTree.insert(reversed(symbols), count)
+            
+            if countLines:
+                self.addSampleToFunction(sample[0], symbols[0], count)
+                
+                for stackItem, symbol in zip(sample[1:], symbols[1:]):
+                    if symbol is not None:
+                        self.addSampleToFunction(stackItem, symbol, count)
+            
+            # A function that's in the stack more than once (i.e. it's
+            # recursive) only gets counted once per sample
+            inclusiveSymbols = {symbol for symbol in symbols[1:] if symbol is not None}
+            inclusiveSymbols.add(symbols[0])
+            
+            for symbol in inclusiveSymbols:
+                self.inclusiveTally[symbol] = self.inclusiveTally.get(symbol, 0) + count
+    
+    def report(self, samples, unusableSampleCount, profilePath=None, calls=None):
+        """Prints a report on the samples and writes out whichever files
+        were asked for. When reporting on one of several profiles separately,
+        profilePath is used to give each profile's files a different name."""
+        self.aggregate(samples,
+                       countLines="lines" in reportSections or samplesOutPath is not None,
+                       buildCallTree=("tree" in reportSections or "stacks" in reportSections
+                                      or collapsedOutPath is not None),
+                       calls=calls)
+        
+        print("Usable samples: ", round(self.totalSampleCount))
+        print("Unusable samples: ", unusableSampleCount)
+        
+        self.printResults()
+        
+        if samplesOutPath is not None:
+            self.writeSamplesAsJSON(outputPathForProfile(samplesOutPath, profilePath))
+        
+        if collapsedOutPath is not None:
+            self.writeCollapsedStacks(outputPathForProfile(collapsedOutPath, profilePath))
+        
+        if flameGraphOutPath is not None:
+            self.writeFlameGraph(outputPathForProfile(flameGraphOutPath, profilePath))
+        
+        if pprofOutPath is not None:
+            self.writePprof(outputPathForProfile(pprofOutPath, profilePath))
+    
+    def selectLargest(self, entries):
+        """Takes (count, item) tuples and returns the ones that should be
+        reported, biggest first. When only the top few are wanted they're
+        picked out with a heap rather than sorting everything."""
+        threshold = self.totalSampleCount * minPercent / 100
+        entries = [entry for entry in entries if entry[0] >= threshold]
+        
+        if topCount is None:
+            return sorted(entries, reverse=True)
+        
+        return heapq.nlargest(topCount, entries)
+    
+    def formatCalls(self, symbol):
+        calls, totalMicroseconds, selfMicroseconds = self.functionCalls[symbol]
+        text = f"{calls:10} calls"
+        
+        if self.callsTimed:
+            text += f"  {totalMicroseconds / 1000:10.1f} ms total  {selfMicroseconds / 1000:10.1f} ms self"
+        
+        return text
+    
+    def printResults(self):
+        def printSymbol(symbol, count):
+            percent = ((count * 10000) // self.totalSampleCount) / 100.0
+            calls = f"  {self.formatCalls(symbol)}" if symbol in self.functionCalls else ""
+            print(f"    {symbol[:functionNameMaxChars]:{functionNameMaxChars}} - {round(count):8}   {percent:6}%{calls}")
+        
+        def printHiddenCount(shownCount, totalCount):
+            if shownCount < totalCount:
+                print(f"    ... {totalCount - shownCount} more not shown")
+        
+        if "inclusive" in reportSections:
+            print("--------------------------------------------")
+            print("Functions by inclusive samples:")
+            print("--------------------------------------------\n")
+            
+            funcList = self.selectLargest([(count, symbol) for symbol, count in self.inclusiveTally.items()])
+            
+            for count, symbol in funcList:
+                printSymbol(symbol, count)
+            
+            printHiddenCount(len(funcList), len(self.inclusiveTally))
+        
+        if "exclusive" in reportSections:
+            print("\n\n--------------------------------------------")
+            print("Functions by exclusive samples:")
+            print("--------------------------------------------\n")
+            
+            funcList = self.selectLargest([(count, symbol) for symbol, count in self.exclusiveTally.items()])
+            
+            for count, symbol in funcList:
+                printSymbol(symbol, count)
+            
+            printHiddenCount(len(funcList), len(self.exclusiveTally))
+        
+        if "calls" in reportSections and len(self.functionCalls) > 0:
+            self.printCalls()
+        
+        if "traps" in reportSections:
+            self.printTraps()
+        
+        if "lines" in reportSections:
+            self.printLines()
+        
+        if "tree" in reportSections:
+            self.printCallTree()
+        
+        if "stacks" in reportSections:
+            print("\n\n--------------------------------------------")
+            print("All stack traces:")
+            print("--------------------------------------------")
+            
+            stackTraces = self.getStackTraces()
+            sortedStackTraces = self.selectLargest([(count, sampleSymbols) for sampleSymbols, count in stackTraces.items()])
+            
+            for count, sampleSymbols in sortedStackTraces:
+                percent = (count * 10000 // self.totalSampleCount) / 100.0
+                print(f"\n({round(count)} times / {percent:6}%)")
+                for i, sampleSymbol in enumerate(sampleSymbols):
+                    spaces = ' ' * (i+1) * 2
+                    print(f"{spaces}{sampleSymbol}")
+            
+            if len(sortedStackTraces) < len(stackTraces):
+                print(f"\n... {len(stackTraces) - len(sortedStackTraces)} more not shown")
+    
+    def printCalls(self):
+        print("\n\n--------------------------------------------")
+        print("Functions by calls:")
+        print("--------------------------------------------\n")
+        
+        # Calls are counted exactly, so functions that were hardly ever
+        # sampled are still worth showing, and only --top applies
+        entries = [(counts[0], symbol) for symbol, counts in self.functionCalls.items()]
+        entries = sorted(entries, reverse=True) if topCount is None else heapq.nlargest(topCount, entries)
+        
+        for calls, symbol in entries:
+            line = f"    {symbol[:functionNameMaxChars]:{functionNameMaxChars}} - {self.formatCalls(symbol)}"
+            
+            if self.callsTimed and calls > 0:
+                line += f"  {self.functionCalls[symbol][1] / calls:10.1f} us per call"
+            
+            print(line)
+        
+        if len(entries) < len(self.functionCalls):
+            print(f"    ... {len(self.functionCalls) - len(entries)} more not shown")
+    
+    def findTrapCalls(self, keys):
+        newKeys = [key for key in keys if key not in self.trapCalls]
+        
+        if len(newKeys) == 0:
+            return
+        
+        words = readCallSiteWords(self.binaryPath, newKeys)
+        
+        for key in newKeys:
+            self.trapCalls[key] = callSiteTrapWord(words.get(key))
+    
+    def countTraps(self):
+        """Attributes each sample taken in ROM to the Toolbox trap our code
+        called to get there, which is the trap at the innermost return
+        address in our code. Returns a dict of sample counts by trap name, a
+        dict of the counts for each trap's call sites keyed by allAddrData key,
+        and how many samples in ROM couldn't be attributed to a trap."""
+        callSites = {}
+        
+        for sample, count in self.samples.items():
+            if self.allAddrData[sample[0]].type != 'trap':
+                continue
+            
+            callSite = None
+            
+            for key in sample[1:]:
+                if self.allAddrData[key].type == 'func':
+                    callSite = key
+                    break
+            
+            callSites[callSite] = callSites.get(callSite, 0) + count
+        
+        self.findTrapCalls([key for key in callSites if key is not None])
+        trapCounts = {}
+        trapSites = {}
+        unattributedCount = 0
+        
+        for callSite, count in callSites.items():
+            trapWord = self.trapCalls.get(callSite)
+            
+            # Either ROM code that wasn't called from ours, or a trap that
+            # didn't set up an A6 frame, so the crawl went straight past the
+            # return address to our code
+            if trapWord is None:
+                unattributedCount += count
+                continue
+            
+            name = trapName(trapWord)
+            trapCounts[name] = trapCounts.get(name, 0) + count
+            trapSites.setdefault(name, {})[callSite] = count
+        
+        return trapCounts, trapSites, unattributedCount
+    
+    def formatCallSite(self, key):
+        addrData = self.allAddrData[key]
+        
+        if addrData.file is None or addrData.line is None:
+            return f"{addrData.symbol} +{addrData.addr:x}"
+        
+        return f"{addrData.symbol} ({os.path.basename(addrData.file)}:{addrData.line})"
+    
+    def printTraps(self):
+        print("\n\n--------------------------------------------")
+        print("Time by Toolbox trap:")
+        print("--------------------------------------------\n")
+        
+        trapCounts, trapSites, unattributedCount = self.countTraps()
+        trapList = self.selectLargest([(count, name) for name, count in trapCounts.items()])
+        
+        for count, name in trapList:
+            percent = ((count * 10000) // self.totalSampleCount) / 100.0
+            print(f"    {name[:functionNameMaxChars]:{functionNameMaxChars}} - {round(count):8}   {percent:6}%")
+            
+            sites = heapq.nlargest(trapCallSiteCount, [(count, key) for key, count in trapSites[name].items()])
+            
+            for siteCount, key in sites:
+                sitePercent = ((siteCount * 10000) // count) / 100.0
+                print(f"        {round(siteCount):8} {sitePercent:6}%  {self.formatCallSite(key)}")
+            
+            if len(sites) < len(trapSites[name]):
+                print(f"        ... {len(trapSites[name]) - len(sites)} more call sites not shown")
+        
+        if len(trapList) < len(trapCounts):
+            print(f"    ... {len(trapCounts) - len(trapList)} more not shown")
+        
+        if unattributedCount > 0:
+            percent = ((unattributedCount * 10000) // self.totalSampleCount) / 100.0
+            name = "(not under a trap call)"
+            print(f"    {name:{functionNameMaxChars}} - {round(unattributedCount):8}   {percent:6}%")
+    
+    def selectFunctionSamples(self):
+        """Returns (symbol, line dict) tuples for the functions whose lines
+        should be reported"""
+        if minPercent == 0 and topCount is None:
+            return list(self.functionSamples.items())
+        
+        functionTotals = [(sum([funcSample.count for funcSample in lineDict.values()]), symbol)
+                          for symbol, lineDict in self.functionSamples.items()]
+        
+        return [(symbol, self.functionSamples[symbol]) for _, symbol in self.selectLargest(functionTotals)]
+    
+    def printLines(self):
+        print("\n\n--------------------------------------------")
+        print("Samples by function and line:")
+        print("--------------------------------------------")
+        
+        selectedFunctionSamples = self.selectFunctionSamples()
+        
+        for symbol, lineDict in selectedFunctionSamples:
+            funcSamples = sorted(lineDict.values(), key=lambda x: x.line)
+            funcSampleTotalCount = sum([funcSample.count for funcSample in funcSamples])
+            
+            if funcSampleTotalCount == 0:
+                continue
+            
+            print(f"\n=== {symbol + ' ':=<40}")
+            
+            for funcSample in funcSamples:
+                percent = (funcSample.count * 10000 // funcSampleTotalCount) / 100.0
+                print(f"  count:{round(funcSample.count):6} {percent:6}%  {funcSample.file:>{filenameMaxChars}}  {funcSample.source.strip()}")
+                
+                if showAddrs:
+                    print("     " + ", ".join([f"{addr:x} x{round(count)}" for addr, count in funcSample.addrs.items()]))
+        
+        if len(selectedFunctionSamples) < len(self.functionSamples):
+            print(f"\n... {len(self.functionSamples) - len(selectedFunctionSamples)} more functions not shown")
+        
+        print("")
+    
+    def printCallTree(self):
+        def percentOf(count):
+            return (count * 10000 // self.totalSampleCount) / 100.0
+        
+        print("\n\n--------------------------------------------")
+        print("Call tree:")
+        print("--------------------------------------------\n")
+        print(f"  {'total':>7} {'self':>7}")
+        
+        callTree = self.callTree
+        children = callTree.children()
+        threshold = self.totalSampleCount * minPercent / 100
+        # Entries are (node id, depth), or (-1, depth, count, total) for the
+        # children of a node that were too small to show
+        stack = []
+        
+        def pushChildren(nodeId, depth):
+            shown = [childId for childId in children[nodeId] if callTree.totalCounts[childId] >= threshold]
+            hidden = [childId for childId in children[nodeId] if callTree.totalCounts[childId] < threshold]
+            
+            if len(hidden) > 0:
+                stack.append((-1, depth, len(hidden), sum([callTree.totalCounts[childId] for childId in hidden])))
+            
+            for childId in reversed(shown):
+                stack.append((childId, depth))
+        
+        # Walking the tree without recursion, since deeply recursive code makes for very deep trees
+        pushChildren(0, 0)
+        
+        while len(stack) > 0:
+            entry = stack.pop()
+            spaces = ' ' * entry[1] * 2
+            
+            if entry[0] < 0:
+                print(f"  {percentOf(entry[3]):6}% {'':7}  {spaces}... {entry[2]} more below {minPercent}%")
+                continue
+            
+            nodeId = entry[0]
+            print(f"  {percentOf(callTree.totalCounts[nodeId]):6}% {percentOf(callTree.selfCounts[nodeId]):6}%  "
+                  f"{spaces}{callTree.symbolOf(nodeId)}")
+            pushChildren(nodeId, entry[1] + 1)
+    
+    def getStackTraces(self):
+        """Returns sample counts keyed by tuples of symbols, starting from the
+        outermost function"""
+        return self.callTree.stackTraces()
+    
+    def summarize(self, samples):
+        self.aggregate(samples)
+        summary = SampleSummary(self.totalSampleCount, dict(self.inclusiveTally), dict(self.exclusiveTally))
+        
+        for symbol, lineDict in self.functionSamples.items():
+            for funcSample in lineDict.values():
+                summary.lines[(symbol, funcSample.filePath, funcSample.line)] = funcSample.count
+        
+        summary.stacks = self.getStackTraces()
+        
+        return summary
+    
+    def findAnnotationTarget(self, functionName):
+        """Works out where the function is, returning ("code", None, start,
+        end) for one in the binary, ("rom", ROMMap, start, end) for one in
+        ROM, or None if it can't be found"""
+        functions = getDisassembly(self.binaryPath)[1]
+        
+        if functionName in functions:
+            return ("code", None) + functions[functionName]
+        
+        for romMap in romMaps.values():
+            for idx in range(len(romMap.sortedAddrs)):
+                if romSymbolAtIndex(romMap, idx) == functionName:
+                    start = romMap.sortedAddrs[idx]
+                    end = romMap.sortedAddrs[idx + 1] if idx + 1 < len(romMap.sortedAddrs) else romMap.size
+                    return ("rom", romMap, start, end)
+        
+        return None
+    
+    def annotate(self, functionName):
+        """Prints the function's disassembly with how many samples landed on
+        each instruction, interleaved with its source lines"""
+        target = self.findAnnotationTarget(functionName)
+        
+        print("\n\n--------------------------------------------")
+        print(f"Annotated: {functionName}")
+        print("--------------------------------------------\n")
+        
+        if target is None:
+            print(f"Couldn't find {functionName} in the binary or the ROM maps for these profiles")
+            return
+        
+        kind, romMap, start, end = target
+        
+        if kind == "rom":
+            if romImagePath is None:
+                print(f"{functionName} is in ROM ({romMap.name}), so annotating it needs a ROM image (--rom-image)")
+                return
+            
+            instructions = getROMDisassembly(romImagePath, start, end)
+        else:
+            allInstructions = getDisassembly(self.binaryPath)[0]
+            first = bisect.bisect_left(allInstructions, (start,))
+            last = bisect.bisect_left(allInstructions, (end,))
+            instructions = allInstructions[first:last]
+        
+        if len(instructions) == 0:
+            print(f"No instructions found for {functionName}")
+            return
+        
+        # Samples taken in the function, and samples where it called
+        # something else, by address
+        selfCounts = Counter()
+        callCounts = Counter()
+        
+        for sample, count in self.samples.items():
+            for i, key in enumerate(sample):
+                addrData = self.allAddrData[key]
+                
+                if addrData.symbol != functionName or (addrData.type == 'trap') != (kind == "rom"):
+                    continue
+                
+                if kind == "rom" and key[0] != romMap.name:
+                    continue
+                
+                if i == 0:
+                    selfCounts[addrData.addr] += count
+                else:
+                    callCounts[addrData.addr] += count
+        
+        # Sample addresses can be partway into an instruction, so count each
+        # one towards the instruction it's in
+        instructionAddrs = [addr for addr, _ in instructions]
+        instructionSelfCounts = Counter()
+        instructionCallCounts = Counter()
+        
+        for counts, instructionCounts in [(selfCounts, instructionSelfCounts), (callCounts, instructionCallCounts)]:
+            addrs = list(counts.keys())
+            
+            for addr, idx in zip(addrs, findIndicesEqualToOrLessThan(instructionAddrs, addrs)):
+                if idx >= 0:
+                    instructionCounts[instructionAddrs[idx]] += counts[addr]
+        
+        selfTotal = sum(instructionSelfCounts.values())
+        hottest = {addr for addr, count in instructionSelfCounts.most_common(annotateHottestCount) if count > 0}
+        branchTargets = {findBranchTarget(instruction) for _, instruction in instructions}
+        
+        if kind == "code":
+            lineEntries, lineEntryAddrs = getAddrToLineTable(self.binaryPath)
+            lineIndices = findIndicesEqualToOrLessThan(lineEntryAddrs, instructionAddrs)
+        else:
+            lineIndices = [-1] * len(instructions)
+        
+        sourceData = {}
+        lastLine = None
+        
+        print(f"Samples in {functionName}: {round(selfTotal)}, "
+              f"samples calling other functions from it: {round(sum(instructionCallCounts.values()))}")
+        print(f"(* = {annotateHottestCount} hottest instructions, > = branch target)\n")
+        print(f"  {'self':>7} {'self%':>7} {'calls':>7}")
+        
+        for (addr, instruction), lineIdx in zip(instructions, lineIndices):
+            if lineIdx >= 0:
+                lineEntry = lineEntries[lineEntryAddrs[lineIdx]]
+                
+                if (lineEntry[0], lineEntry[1]) != lastLine:
+                    lastLine = (lineEntry[0], lineEntry[1])
+                    source = getSourceLine(sourceData, lineEntry[0], lineEntry[1]).rstrip()
+                    print(f"\n{'':26}{os.path.basename(lineEntry[0])[:filenameMaxChars]}:{lineEntry[1]} >: {source}")
+            
+            selfCount = instructionSelfCounts[addr]
+            callCount = instructionCallCounts[addr]
+            selfText = f"{round(selfCount):7}" if selfCount > 0 else f"{'':7}"
+            percentText = f"{(selfCount * 10000 // selfTotal) / 100.0:6}%" if selfCount > 0 else f"{'':7}"
+            callText = f"{round(callCount):7}" if callCount > 0 else f"{'':7}"
+            marker = ("*" if addr in hottest else " ") + (">" if addr in branchTargets else " ")
+            print(f"  {selfText} {percentText} {callText} {marker} {addr:8x}:  {instruction}")
+    
+    def getStackFrames(self, reverse=False):
+        """Returns sample counts keyed by tuples of (symbol, isROM) frames,
+        starting from the outermost function, or from the innermost one if
+        reverse is set"""
+        stackFrames = {}
+        
+        for sample, count in self.samples.items():
+            frames = [(self.allAddrData[key].symbol, self.allAddrData[key].type == 'trap') for key in sample]
+            frames = tuple(frames if reverse else reversed(frames))
+            stackFrames[frames] = stackFrames.get(frames, 0) + count
+        
+        return stackFrames
+    
+    def countTimeline(self, profile, slicesPerColumn):
+        """Adds up the profile's timeline into columns of slicesPerColumn
+        time slices each. Returns the first slice, the total samples in each
+        column, and each function's inclusive samples in each column."""
+        firstSlice, endSlice = timelineSliceRange(profile.timeline)
+        columnCount = max(1, math.ceil((endSlice - firstSlice) / slicesPerColumn))
+        columnTotals = [0] * columnCount
+        functionColumns = {}
+        sampleSymbols = {}
+        
+        for timeSlice, sample, count in profile.timelineSamples:
+            column = (timeSlice - firstSlice) // slicesPerColumn
+            
+            if column < 0 or column >= columnCount:
+                continue
+            
+            columnTotals[column] += count
+            symbols = sampleSymbols.get(sample)
+            
+            if symbols is None:
+                # Recursive functions are only counted once, as in countSamples
+                symbols = {self.allAddrData[key].symbol for key in sample}
+                symbols.discard(None)
+                sampleSymbols[sample] = symbols
+            
+            for symbol in symbols:
+                counts = functionColumns.get(symbol)
+                
+                if counts is None:
+                    counts = [0] * columnCount
+                    functionColumns[symbol] = counts
+                
+                counts[column] += count
+        
+        return firstSlice, columnTotals, functionColumns
+    
+    def selectTimelineFunctions(self, functionColumns):
+        return heapq.nlargest(topCount or 20, functionColumns.items(), key=lambda item: (sum(item[1]), item[0]))
+    
+    def printTimeline(self, profile):
+        """Prints how each of the busiest functions' share of the samples
+        changes over the course of the profile"""
+        timeline = profile.timeline
+        sliceSeconds = timeline.sliceUSec / 1000000
+        firstSlice, endSlice = timelineSliceRange(timeline)
+        slicesPerColumn = max(1, math.ceil((endSlice - firstSlice) / timelineColumns))
+        firstSlice, columnTotals, functionColumns = self.countTimeline(profile, slicesPerColumn)
+        totalCount = sum(columnTotals)
+        
+        def sparkline(values, scale):
+            chars = []
+            
+            for value, total in zip(values, scale):
+                if value == 0 or total == 0:
+                    chars.append(timelineLevels[0])
+                else:
+                    chars.append(timelineLevels[max(1, round(value / total * (len(timelineLevels) - 1)))])
+            
+            return "".join(chars)
+        
+        print("--------------------------------------------")
+        print("Timeline:")
+        print("--------------------------------------------\n")
+        
+        startTime = firstSlice * sliceSeconds
+        endTime = (firstSlice + len(columnTotals) * slicesPerColumn) * sliceSeconds
+        print(f"{startTime:.3f}s to {endTime:.3f}s, {slicesPerColumn * sliceSeconds * 1000:g} ms per column. Each "
+              f"function's bars show its share of the samples in that column.\n")
+        
+        if timeline.overflowed:
+            print(f"Note: the profiler ran out of memory for the timeline after "
+                  f"{timeline.sliceCount * sliceSeconds:.3f}s, so it's missing the rest of the samples\n")
+        
+        if totalCount == 0:
+            print("    No samples in the timeline\n")
+            return
+        
+        maxColumnTotal = max(columnTotals)
+        print(f"    {'(samples)':{functionNameMaxChars}} |{sparkline(columnTotals, [maxColumnTotal] * len(columnTotals))}| "
+              f"{totalCount:8}")
+        
+        for symbol, counts in self.selectTimelineFunctions(functionColumns):
+            percent = (sum(counts) * 10000 // totalCount) / 100.0
+            print(f"    {symbol[:functionNameMaxChars]:{functionNameMaxChars}} |{sparkline(counts, columnTotals)}| "
+                  f"{percent:7}%")
+        
+        print("")
+    
+    def writeTimelineCSV(self, profile, outPath):
+        """Writes the samples in each time slice, in total and for each of
+        the busiest functions, out as a CSV file for plotting"""
+        sliceSeconds = profile.timeline.sliceUSec / 1000000
+        firstSlice, sliceTotals, functionColumns = self.countTimeline(profile, 1)
+        functions = self.selectTimelineFunctions(functionColumns)
+        
+        with open(outPath, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["time", "samples"] + [symbol for symbol, _ in functions])
+            
+            for i, total in enumerate(sliceTotals):
+                writer.writerow([f"{(firstSlice + i) * sliceSeconds:.6f}", total]
+                                + [counts[i] for _, counts in functions])
+    
+    def writeCollapsedStacks(self, outPath):
+        stackTraces = self.getStackTraces()
+        
+        with open(outPath, "w") as f:
+            f.write(formatCollapsedStacks(stackTraces))
+    
+    def writeFlameGraph(self, outPath):
+        title = ("Icicle Graph" if flameGraphIcicle else "Flame Graph")
+        
+        if flameGraphReverse:
+            title = "Reverse " + title
+        
+        svg = renderFlameGraph(self.getStackFrames(flameGraphReverse), title, flameGraphIcicle, flameGraphMinWidth)
+        
+        with open(outPath, "w") as f:
+            f.write(svg)
+    
+    def writePprof(self, outPath):
+        periodNanos = 1000000000 // self.sampleRate
+        pprof = PprofProfile([("samples", "count"), ("cpu", "nanoseconds")], ("cpu", "nanoseconds"), periodNanos)
+        pprof.timeNanos = time.time_ns()
+        pprof.durationNanos = round(self.totalSampleCount * periodNanos)
+        pprof.addComment(f"Estimated times assume {self.sampleRate} samples per second")
+        
+        # A mapping for each of the binary's code sections, and one for each ROM
+        buildId = hashBinary(self.binaryPath)
+        codeSections = sorted([(addr, size) for name, addr, size in getProgbitsSections(self.binaryPath)
+                               if name == ".text" or re.match(r"^\.code\d+$", name)])
+        codeMappingIds = [pprof.addMapping(addr, addr + size, self.binaryPath, buildId, True, True)
+                          for addr, size in codeSections]
+        romMappingIds = {}
+        
+        for romMap in romMaps.values():
+            romMappingIds[romMap.name] = pprof.addMapping(0, romMap.size, romMap.name)
+        
+        locationIds = {}
+        
+        for sample, count in self.samples.items():
+            sampleLocationIds = []
+            
+            for key in sample:
+                if key not in locationIds:
+                    addrData = self.allAddrData[key]
+                    
+                    if addrData.type == 'trap':
+                        # ROM addresses are offsets from the start of the ROM
+                        functionId = pprof.addFunction(addrData.symbol, key[0])
+                        locationIds[key] = pprof.addLocation(romMappingIds[key[0]], addrData.addr, functionId)
+                    else:
+                        idx = findIndicesEqualToOrLessThan([addr for addr, _ in codeSections], [addrData.addr])[0]
+                        mappingId = codeMappingIds[idx] if idx >= 0 else 0
+                        functionId = pprof.addFunction(addrData.symbol, addrData.file or "")
+                        locationIds[key] = pprof.addLocation(mappingId, addrData.addr, functionId, addrData.line or 0)
+                
+                sampleLocationIds.append(locationIds[key])
+            
+            pprof.addSample(sampleLocationIds, [round(count), round(count * periodNanos)])
+        
+        pprof.write(outPath)
+    
+    def writeSamplesAsJSON(self, outPath):
+        fileAndLineData = {}
+        
+        for symbol, lineDict in self.selectFunctionSamples():
+            funcSamples = sorted(lineDict.values(), key=lambda x: x.line)
+            
+            for funcSample in funcSamples:
+                if funcSample.filePath not in fileAndLineData:
+                    fileAndLineData[funcSample.filePath] = {}
+                
+                percent = (funcSample.count * 10000 // self.totalSampleCount) / 100.0
+                
+                fileAndLineData[funcSample.filePath][funcSample.line] = {"count": funcSample.count, "percent": percent}
+        
+        with open(outPath, "w") as f:
+            f.write(json.dumps(fileAndLineData))
+
+
+def outputPathForProfile(outPath, profilePath):
+    # e.g. samples.json -> samples.profile1.json
+    if profilePath is None:
+        return outPath
+    
+    base, ext = os.path.splitext(outPath)
+    return f"{base}.{os.path.splitext(os.path.basename(profilePath))[0]}{ext}"
+
+
+def timelineSliceRange(timeline):
+    """Returns the first and one past the last time slice to report on,
+    which is all of them unless the reports are restricted to a time window"""
+    sliceSeconds = timeline.sliceUSec / 1000000
+    firstSlice = 0
+    endSlice = timeline.sliceCount
+    
+    if timeWindow is not None and timeWindow[0] is not None:
+        firstSlice = min(endSlice, int(timeWindow[0] / sliceSeconds))
+    
+    if timeWindow is not None and timeWindow[1] is not None:
+        endSlice = max(firstSlice, min(endSlice, math.ceil(timeWindow[1] / sliceSeconds)))
+    
+    return firstSlice, endSlice
+
+
+def restrictToTimeWindow(profile, window):
+    """Replaces the profile's raw samples with the ones from the time slices
+    that overlap window, a (start, end) tuple in seconds where either can be
+    None"""
+    if profile.timeline is None:
+        raise Exception(f"{profile.path} doesn't have a timeline (see EnableProfilerTimeline), so it can't be "
+                        f"restricted to a time window")
+    
+    sliceSeconds = profile.timeline.sliceUSec / 1000000
+    start, end = window
+    profile.timeline.entries = [entry for entry in profile.timeline.entries
+                                if (start is None or (entry[0] + 1) * sliceSeconds > start)
+                                and (end is None or entry[0] * sliceSeconds < end)]
+    profile.rawSamples = {}
+    
+    for _, sample, count in profile.timeline.entries:
+        profile.rawSamples[sample] = profile.rawSamples.get(sample, 0) + count
+
+
+def profilesSampleRate(profiles):
+    """Returns the samples per second to assume the profiles were recorded
+    at: --sample-rate if it was given, otherwise whatever rate they say they
+    were recorded at"""
+    if sampleRate is not None:
+        return sampleRate
+    
+    rates = {profile.sampleRate for profile in profiles if profile.sampleRate}
+    
+    if len(rates) == 1:
+        return rates.pop()
+    
+    return defaultSampleRate
+
+
+def overheadBucketName(bucket, bucketCount):
+    if bucket == 0:
+        return "<2us"
+    
+    if bucket == bucketCount - 1:
+        return f">={1 << bucket}us"
+    
+    return f"{1 << bucket}-{(2 << bucket) - 1}us"
+
+
+def printSamplingOverhead(profile):
+    overhead = profile.overhead
+    
+    if overhead is None or overhead.sampleCount == 0:
+        return
+    
+    averageMicroseconds = overhead.totalMicroseconds / overhead.sampleCount
+    
+    if profile.durationMilliseconds:
+        durationMicroseconds = profile.durationMilliseconds * 1000
+    else:
+        # Profiles saved in the old format don't say how long they ran for, but
+        # every tick of the timer is timed, so the duration follows from the rate
+        durationMicroseconds = overhead.sampleCount * 1000000 / profilesSampleRate([profile])
+    
+    # Samples are timed from when the profiler's timer function starts to when
+    # it finishes, so this doesn't include the time taken to get there from the
+    # interrupt, and is a bit of an underestimate
+    percent = 100 * overhead.totalMicroseconds / durationMicroseconds
+    print(f"    Sampling used {percent:.1f}% of the CPU: {averageMicroseconds:.0f} microseconds per sample on "
+          f"average, longest {overhead.maxMicroseconds}")
+    print("    Time per sample: " + ", ".join([f"{overheadBucketName(bucket, len(overhead.histogram))} {count}"
+                                             for bucket, count in enumerate(overhead.histogram) if count > 0]))
+    
+    if percent > maxSamplingOverheadPercent:
+        suggestedRate = int(maxSamplingOverheadPercent / 100 * 1000000 / averageMicroseconds)
+        print(f"    Warning: sampling took enough of the CPU to skew the profile. Around {suggestedRate} samples per "
+              f"second would keep it under {maxSamplingOverheadPercent}%.")
+
+
+def printProfileDetails(profile):
+    """Prints what the profiler recorded about the profile in its header,
+    for profiles that have one"""
+    if profile.version < 2:
+        # The profiler falls back to the old format when it's short of memory,
+        # which still has any extra chunks
+        printSamplingOverhead(profile)
+        return
+    
+    if profile.incomplete:
+        print("    Warning: the profiler didn't finish writing this profile (see FinishProfilerSpilling), so it only "
+              "has the samples spilled before then")
+        return
+    
+    stats = profile.hashtableStats
+    # Spilled profiles' stats are added up over all the times the profiler wrote out a table
+    tableCount = max(1, profile.spillCount) if profile.spilled else 1
+    print(f"    Recorded at {profile.sampleRate} samples per second for "
+          f"{profile.durationMilliseconds / 1000:.2f} seconds, with {profile.badSampleCount} bad samples")
+    printSamplingOverhead(profile)
+    
+    if profile.spilled:
+        print(f"    Spilled to disk {profile.spillCount} times, with {stats['stackCount']} stacks in all in "
+              f"{stats['bucketCount']} buckets, using up to {stats['arenaUsed']} of {stats['arenaSize']} bytes "
+              f"each time")
+    else:
+        print(f"    {stats['stackCount']} unique stacks in {stats['bucketCount']} buckets, using "
+              f"{stats['arenaUsed']} of {stats['arenaSize']} bytes")
+    
+    if stats.get("usedBucketCount"):
+        loadFactor = stats["stackCount"] / (stats["bucketCount"] * tableCount)
+        averageChainLength = stats["stackCount"] / stats["usedBucketCount"]
+        probesPerLookup = stats["probeCount"] / max(1, stats["lookupCount"])
+        print(f"    Load factor {loadFactor:.2f}, longest chain {stats['maxChainLength']}, average chain "
+              f"{averageChainLength:.2f}, {probesPerLookup:.2f} entries compared per sample")
+        
+        if probesPerLookup > 4:
+            print("    Warning: the hashtable's chains are long, which slows down sampling. Use "
+                  "SetProfilerBucketCount to give it more buckets.")
+    
+    if profile.errorCode == 1:
+        print("    Warning: the profiler ran out of memory for samples and stopped early. Give InitProfiler more "
+              "memory to profile the whole run, or use EnableProfilerSpilling.")
+    
+    if profile.droppedSampleCount > 0:
+        print(f"    Warning: {profile.droppedSampleCount} samples were lost because both of the profiler's buffers "
+              "were full. Call ProfilerIdle more often, or give InitProfiler more memory.")
+    
+    if profile.callCounts is not None:
+        print(f"    Counted calls to {len(profile.callCounts.functions)} functions"
+              f"{', and timed them' if profile.callCounts.timed else ''}")
+        
+        if profile.callCounts.droppedCallCount > 0:
+            print(f"    Warning: {profile.callCounts.droppedCallCount} calls weren't counted because the profiler's "
+                  "table of functions was full. Give EnableProfilerInstrumentation more memory.")
+
+
+def printProfileTotals(profiles):
+    if len(profiles) == 1:
+        print("Total samples in profile: ", sum(profiles[0].rawSamples.values()))
+        printProfileDetails(profiles[0])
+    else:
+        for profile in profiles:
+            print(f"Samples in {profile.path} ({profile.model}): ", sum(profile.rawSamples.values()))
+            printProfileDetails(profile)
+        
+        print("Total samples in profiles: ", sum([sum(profile.rawSamples.values()) for profile in profiles]))
+    
+    printRegionCounts(profiles)
+    print("")
+
+
+def printRegionCounts(profiles):
+    """Prints how many samples were taken in each combination of named
+    regions, and roughly how long was spent in it, for profiles with regions"""
+    counts = {}
+    seconds = {}
+    
+    for profile in profiles:
+        profileSampleRate = profilesSampleRate([profile])
+        
+        for path, count in profile.regionCounts.items():
+            counts[path] = counts.get(path, 0) + count
+            seconds[path] = seconds.get(path, 0) + count / profileSampleRate
+    
+    totalCount = sum(counts.values())
+    
+    if totalCount == 0:
+        return
+    
+    print("Samples by region:")
+    
+    for path, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+        if count > 0:
+            name = " > ".join(path) if len(path) > 0 else "(no region)"
+            print(f"    {count:8} {100 * count / totalCount:6.2f}% {seconds[path]:9.2f}s  {name}")
+    
+    if regionName is not None:
+        print(f"Only reporting on samples in region: {regionName}")
+
+
+def loadAndSymbolicate(analyzer, profilePaths):
+    """Reads the profiles and symbolicates all of their addresses. Returns
+    the profiles, with their usable samples in profile.samples."""
+    profiles = analyzer.loadProfiles(profilePaths)
+    printProfileTotals(profiles)
+    
+    startTime = time.perf_counter()
+    addrCount = analyzer.symbolicate()
+    print(f"Symbolicated {addrCount} addresses in {time.perf_counter() - startTime:.2f} seconds")
+    
+    analyzer.removeUnsymbolicatedSamples(profiles)
+    
+    return profiles
+
+def unusableSampleCount(profiles):
+    return sum([sum(profile.rawSamples.values()) - sum(profile.samples.values()) for profile in profiles])
+
+
+def processTimelines(analyzer, profiles, nameByProfile):
+    """Prints and writes out the timelines of whichever profiles have one.
+    nameByProfile gives each profile's CSV file a different name."""
+    for profile in profiles:
+        if profile.timeline is None:
+            if showTimeline:
+                print(f"{profile.path} doesn't have a timeline (see EnableProfilerTimeline)\n")
+            
+            continue
+        
+        if showTimeline:
+            if len(profiles) > 1:
+                print(f"Profile: {profile.path}")
+            
+            analyzer.printTimeline(profile)
+        
+        if timelineCSVPath is not None:
+            analyzer.writeTimelineCSV(profile, outputPathForProfile(timelineCSVPath,
+                                                                    profile.path if nameByProfile else None))
+
+
+def process(analyzer, profilePaths):
+    profiles = loadAndSymbolicate(analyzer, profilePaths)
+    
+    if separateReports and len(profiles) > 1:
+        for profile in profiles:
+            print(f"\n\n============================================")
+            print(f"Profile: {profile.path} ({profile.model})")
+            print(f"============================================\n")
+            
+            processTimelines(analyzer, [profile], True)
+            analyzer.report(profile.samples, unusableSampleCount([profile]), profile.path, profile.calls)
+    else:
+        processTimelines(analyzer, profiles, len(profiles) > 1)
+        analyzer.report(mergeProfileSamples(profiles), unusableSampleCount(profiles), calls=mergeProfileCalls(profiles))
+
+
+def mergeProfileSamples(profiles):
+    """Combines the usable samples from all the profiles. If normalizing,
+    each profile's counts are scaled so that every profile contributes the
+    same number of samples, regardless of how long it ran for."""
+    if len(profiles) == 1:
+        return profiles[0].samples
+    
+    weights = [1] * len(profiles)
+    
+    if normalizeProfiles:
+        totals = [sum(profile.samples.values()) for profile in profiles]
+        meanTotal = sum(totals) / len(totals)
+        weights = [meanTotal / total if total > 0 else 0 for total in totals]
+    
+    merged = {}
+    
+    for profile, weight in zip(profiles, weights):
+        for sample, count in profile.samples.items():
+            merged[sample] = merged.get(sample, 0) + count * weight
+    
+    return merged
+
+
+def mergeProfileCalls(profiles):
+    """Adds up the call counts from all the profiles that have them. Unlike
+    samples, they're never normalized, since they're exact counts rather
+    than a share of the run. Returns None if none of them do."""
+    profilesWithCalls = [profile for profile in profiles if profile.calls is not None]
+    
+    if len(profilesWithCalls) == 0:
+        return None
+    
+    merged = CallCounts(timed=all([profile.calls.timed for profile in profilesWithCalls]))
+    
+    for profile in profilesWithCalls:
+        merged.droppedCallCount += profile.calls.droppedCallCount
+        
+        for key, counts in profile.calls.functions.items():
+            total = merged.functions.setdefault(key, [0, 0, 0])
+            
+            for i in range(3):
+                total[i] += counts[i]
+    
+    return merged
+
+
+def compareCounts(baseCounts, baseTotal, newCounts, newTotal):
+    """Lines up the counts in two profiles and works out how much each item's
+    share of its profile's samples changed. Each change gets a z-score from a
+    two-proportion test, i.e. how many standard errors the change is, which
+    is what tells us whether a change is real or just sampling noise in a
+    short run. Since hundreds of items are tested at once, some would look
+    significant by chance alone, so they're only marked significant if they
+    pass the Holm-Bonferroni correction at diffSignificanceLevel. Returns a
+    list of dicts sorted by size of the change."""
+    result = []
+    
+    for key in baseCounts.keys() | newCounts.keys():
+        baseCount = baseCounts.get(key, 0)
+        newCount = newCounts.get(key, 0)
+        baseFraction = baseCount / baseTotal if baseTotal > 0 else 0
+        newFraction = newCount / newTotal if newTotal > 0 else 0
+        
+        pooled = (baseCount + newCount) / (baseTotal + newTotal) if baseTotal + newTotal > 0 else 0
+        pooled = min(max(pooled, 0), 1)
+        
+        if baseTotal > 0 and newTotal > 0:
+            standardError = math.sqrt(pooled * (1 - pooled) * (1 / baseTotal + 1 / newTotal))
+        else:
+            standardError = 0
+        
+        if standardError > 0:
+            z = (newFraction - baseFraction) / standardError
+        else:
+            z = 0.0 if newFraction == baseFraction else math.copysign(math.inf, newFraction - baseFraction)
+        
+        result.append({
+            "key": key,
+            "baseCount": baseCount,
+            "newCount": newCount,
+            "basePercent": round(baseFraction * 100, 2),
+            "newPercent": round(newFraction * 100, 2),
+            "deltaPercent": round((newFraction - baseFraction) * 100, 2),
+            # Only infinite when one side had no samples at all, which json can't represent
+            "z": round(z, 2) if math.isfinite(z) else None,
+            # Two-sided
+            "p": math.erfc(abs(z) / math.sqrt(2)),
+            "significant": False,
+        })
+    
+    # Holm-Bonferroni: the smallest p-value is tested at level / m, the next at level / (m - 1) and so on,
+    # stopping at the first one that fails
+    for rank, entry in enumerate(sorted(result, key=lambda entry: entry["p"])):
+        if entry["p"] > diffSignificanceLevel / (len(result) - rank):
+            break
+        
+        entry["significant"] = True
+    
+    # The key breaks ties so that the order doesn't change from run to run
+    result.sort(key=lambda entry: (-abs(entry["deltaPercent"]), -abs(entry["newPercent"]), str(entry["key"])))
+    
+    return result
+
+
+def diffSummaries(base, new):
+    def keyed(entries, keyName, makeKey):
+        for entry in entries:
+            entry[keyName] = makeKey(entry.pop("key"))
+        
+        return entries
+    
+    inclusive = keyed(compareCounts(base.inclusive, base.totalSampleCount, new.inclusive, new.totalSampleCount),
+                      "symbol", lambda key: key)
+    exclusive = keyed(compareCounts(base.exclusive, base.totalSampleCount, new.exclusive, new.totalSampleCount),
+                      "symbol", lambda key: key)
+    lines = keyed(compareCounts(base.lines, base.totalSampleCount, new.lines, new.totalSampleCount),
+                  "line", lambda key: {"symbol": key[0], "file": key[1], "line": key[2]})
+    stacks = keyed(compareCounts(base.stacks, base.totalSampleCount, new.stacks, new.totalSampleCount),
+                   "stack", list)
+    
+    regressions = [entry["symbol"] for entry in exclusive
+                   if entry["significant"] and entry["deltaPercent"] >= diffMinRegressionPercent]
+    
+    return {
+        "base": {"totalSamples": base.totalSampleCount},
+        "new": {"totalSamples": new.totalSampleCount},
+        "significanceLevel": diffSignificanceLevel,
+        "minRegressionPercent": diffMinRegressionPercent,
+        "inclusive": inclusive,
+        "exclusive": exclusive,
+        "lines": lines,
+        "stacks": stacks,
+        "regressions": regressions,
+    }
+
+
+def printDiff(diff):
+    def formatZ(z):
+        return f"{z:6.1f}" if z is not None else "   n/a"
+    
+    def printEntries(title, entries, describe):
+        print("\n\n--------------------------------------------")
+        print(title)
+        print("--------------------------------------------\n")
+        
+        hiddenCount = 0
+        
+        for entry in entries:
+            if entry["deltaPercent"] == 0 or (not entry["significant"] and not diffShowAll):
+                hiddenCount += 1
+                continue
+            
+            marker = "*" if entry["significant"] else " "
+            print(f"  {marker} {entry['deltaPercent']:+7.2f}pp  {entry['basePercent']:6.2f}% -> {entry['newPercent']:6.2f}%"
+                  f"  z={formatZ(entry['z'])}  {describe(entry)}")
+        
+        if hiddenCount > 0:
+            print(f"\n  ({hiddenCount} unchanged or not significant{'' if diffShowAll else '; use --diff-all to show'})")
+    
+    print(f"Base samples: {round(diff['base']['totalSamples'])}")
+    print(f"New samples: {round(diff['new']['totalSamples'])}")
+    print(f"Changes marked with * are significant at the {diff['significanceLevel']} level, corrected for the "
+          f"number of changes in each section")
+    
+    printEntries("Functions by inclusive samples (change):", diff["inclusive"],
+                 lambda entry: entry["symbol"][:functionNameMaxChars])
+    printEntries("Functions by exclusive samples (change):", diff["exclusive"],
+                 lambda entry: entry["symbol"][:functionNameMaxChars])
+    printEntries("Samples by function and line (change):", diff["lines"],
+                 lambda entry: f"{entry['line']['symbol'][:functionNameMaxChars]}  "
+                               f"{os.path.basename(entry['line']['file'] or '')[:filenameMaxChars]}:{entry['line']['line']}")
+    printEntries("Stack traces (change):", diff["stacks"], lambda entry: " > ".join(entry["stack"]))
+    
+    print("")
+    
+    if len(diff["regressions"]) > 0:
+        print(f"Significant regressions of at least {diff['minRegressionPercent']}pp in exclusive samples: "
+              f"{', '.join(diff['regressions'])}")
+    else:
+        print(f"No significant regressions of at least {diff['minRegressionPercent']}pp in exclusive samples")
+
+
+def processAnnotations(analyzer, profilePaths):
+    profiles = loadAndSymbolicate(analyzer, profilePaths)
+    analyzer.aggregate(mergeProfileSamples(profiles))
+    
+    for functionName in annotateFunctions:
+        analyzer.annotate(functionName)
+
+
+def processDiff(analyzer, baseProfilePaths, newProfilePaths):
+    profiles = loadAndSymbolicate(analyzer, baseProfilePaths + newProfilePaths)
+    baseProfiles = profiles[:len(baseProfilePaths)]
+    newProfiles = profiles[len(baseProfilePaths):]
+    
+    base = analyzer.summarize(mergeProfileSamples(baseProfiles))
+    new = analyzer.summarize(mergeProfileSamples(newProfiles))
+    diff = diffSummaries(base, new)
+    
+    printDiff(diff)
+    
+    if diffJSONPath is not None:
+        diff["base"]["profiles"] = baseProfilePaths
+        diff["new"]["profiles"] = newProfilePaths
+        
+        with open(diffJSONPath, "w") as f:
+            json.dump(diff, f, indent=1)
+
+
+def listWatchedProfiles(watchDir, pattern):
+    result = {}
+    
+    for path in glob.glob(os.path.join(glob.escape(watchDir), pattern)):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        
+        if os.path.isfile(path) and stat.st_size > 0:
+            result[path] = (stat.st_size, stat.st_mtime_ns)
+    
+    return result
+
+
+def watchForProfiles(analyzer, watchDir, pattern):
+    """Analyzes each profile that shows up in watchDir (or is overwritten)
+    until interrupted. A profile is only read once its size and modification
+    time are the same two checks in a row, so that we don't try to read one
+    that's still being written."""
+    seen = listWatchedProfiles(watchDir, pattern)
+    pending = {}
+    
+    print(f"Watching {watchDir} for new profiles (press Ctrl-C to stop)")
+    
+    try:
+        while True:
+            time.sleep(watchPollInterval)
+            
+            for path, stat in sorted(listWatchedProfiles(watchDir, pattern).items()):
+                if seen.get(path) == stat:
+                    continue
+                
+                if pending.get(path) != stat:
+                    pending[path] = stat
+                    continue
+                
+                del pending[path]
+                seen[path] = stat
+                
+                print(f"\n\n============================================")
+                print(f"Profile: {path}")
+                print(f"============================================\n")
+                
+                try:
+                    process(analyzer, [path])
+                except Exception as e:
+                    sys.stderr.write(f"Error: couldn't analyze {path}: {e}\n")
+    except KeyboardInterrupt:
+        print("")
+
 
 def parseArgs():
     defaultLLVMSymbolizerPath = "/opt/local/bin/llvm-symbolizer-mp-19"
@@ -627,16 +3176,30 @@ def parseArgs():
             llvmSymbolizerPath = arg[len("--llvm-symbolizer="):]
             del sys.argv[i]
     
+    # Profiles and a binary aren't needed when just building ROM map indexes,
+    # and profiles are optional when watching for them
+    buildingROMIndexes = "--build-rom-index" in sys.argv
+    watching = "--watch" in sys.argv
+    
     parser = argparse.ArgumentParser(formatter_class=CustomHelpFormatter)
-    parser.add_argument("profile_path", help="Path to profile")
-    parser.add_argument("binary_path", help="Path to ELF formatted binary (e.g. Project.code.bin.gdb)")
+    parser.add_argument("profile_paths", nargs="*" if buildingROMIndexes or watching else "+", metavar="profile_path",
+                        help="Path to profile. More than one can be given (or a glob pattern) to merge them.")
+    parser.add_argument("binary_path", nargs="?" if buildingROMIndexes else None,
+                        help="Path to ELF formatted binary (e.g. Project.code.bin.gdb)")
     parser.add_argument("-r", "--rom-maps-dir", metavar="PATH",
                         help="Path to ROM maps directory (default: same directory as this script)")
     parser.add_argument("-t", "--retro68-toolchain",  metavar="PATH",
-                        help="Specify the path to Retro68's toolchain directory.")
+                        help="Specify the path to Retro68's toolchain directory. Only needed with --use-readelf "
+                        "and --annotate.")
+    parser.add_argument("--use-readelf", action="store_true",
+                        help="Read symbols and line numbers by running Retro68's readelf instead of using the "
+                        "built-in ELF/DWARF reader")
     parser.add_argument("--llvm-symbolizer", action="store_true",
                         help=f"Use llvm-symbolizer for symbolication instead of Retro68's elftools, and optionally "
                         f"specify the path to llvm-symbolizer (defaulting to {defaultLLVMSymbolizerPath})")
+    parser.add_argument("-j", "--jobs", type=int, metavar="COUNT", default=jobCount,
+                        help=f"Number of processes to use for reading multiple profiles, and llvm-symbolizer "
+                        f"processes to split large sets of addresses between (default: {jobCount})")
     parser.add_argument("--function-max-chars",
                         type=int, metavar="COUNT",
                         default=functionNameMaxChars,
@@ -645,11 +3208,93 @@ def parseArgs():
                         type=int, metavar="COUNT",
                         default=filenameMaxChars,
                         help=f"Maximum number of characters in filenames (default: {filenameMaxChars})")
+    parser.add_argument("--top", type=int, metavar="N", default=topCount,
+                        help="Only report the N functions and stack traces with the most samples")
+    parser.add_argument("--min-percent", type=float, metavar="PERCENT", default=minPercent,
+                        help=f"Leave functions, call tree nodes and stack traces with less than this percent of the "
+                        f"samples out of the report (default: {minPercent})")
+    parser.add_argument("--sections", metavar="LIST", default=",".join(allReportSections),
+                        help=f"Comma separated list of the report sections to print, out of: "
+                        f"{', '.join(allReportSections)} (default: all of them)")
+    parser.add_argument("--annotate", metavar="FUNCTION", action="append", default=[],
+                        help="Instead of the usual report, print the function's disassembly with the number of "
+                        "samples for each instruction. Can be given more than once. Needs Retro68's toolchain, and "
+                        "a ROM image (--rom-image) for functions in ROM.")
+    parser.add_argument("--rom-image", metavar="PATH", default=None,
+                        help="ROM image for the Mac model the profiles were taken on, used by --annotate")
     parser.add_argument("--show-sample-addrs", action="store_true",
                         help="Show the actual code addresses for each sample in the 'functions and line' section")
     parser.add_argument("--samples-path",
                         default=None, metavar="PATH",
                         help=f"Write out samples as a json file")
+    parser.add_argument("--collapsed", metavar="PATH", default=None,
+                        help="Write out the stack traces in collapsed stack format, as used by flamegraph.pl "
+                        "and other flame graph tools")
+    parser.add_argument("--flamegraph", metavar="PATH", default=None,
+                        help="Write out a flame graph of the stack traces as an SVG file")
+    parser.add_argument("--icicle", action="store_true",
+                        help="Draw the flame graph upside down, with the outermost functions at the top")
+    parser.add_argument("--reverse-stacks", action="store_true",
+                        help="Build the flame graph from the innermost function of each stack trace out, so that "
+                        "the functions samples were taken in are merged together at the base")
+    parser.add_argument("--flamegraph-min-width", type=float, metavar="PIXELS", default=flameGraphMinWidth,
+                        help=f"Merge flame graph frames narrower than this together (default: {flameGraphMinWidth})")
+    parser.add_argument("--pprof", metavar="PATH", default=None,
+                        help="Write out the samples as a gzipped pprof profile (e.g. out.pb.gz)")
+    parser.add_argument("--sample-rate", type=int, metavar="HZ", default=None,
+                        help=f"Samples per second the profiler was initialized with, used to estimate time for "
+                        f"--pprof (default: the rate recorded in the profile, or {defaultSampleRate} for profiles "
+                        f"from older versions of the profiler)")
+    parser.add_argument("--timeline", action="store_true",
+                        help="Print how the busiest functions' share of the samples changes over time. Needs "
+                        "profiles recorded with EnableProfilerTimeline.")
+    parser.add_argument("--timeline-csv", metavar="PATH", default=None,
+                        help="Write out the samples in each time slice of the timeline, in total and for the "
+                        "busiest functions, as a CSV file for plotting")
+    parser.add_argument("--timeline-columns", type=int, metavar="COUNT", default=timelineColumns,
+                        help=f"Number of columns to fit the printed timeline into (default: {timelineColumns})")
+    parser.add_argument("--time-window", metavar="START:END", default=None,
+                        help="Only report on samples taken between START and END seconds into the profile. "
+                        "Either can be left out, e.g. 2.5: for everything after 2.5 seconds. Needs profiles "
+                        "recorded with EnableProfilerTimeline.")
+    parser.add_argument("--region", metavar="NAME", default=None,
+                        help="Only report on samples taken inside the region called NAME, including regions nested "
+                        "inside it. Needs profiles with regions (see ProfilerPushRegion).")
+    parser.add_argument("--diff", action="store_true",
+                        help="Compare two profiles: analyze.py --diff BASE NEW binary_path. BASE and NEW can "
+                        "each be a glob pattern matching several profiles, which are merged.")
+    parser.add_argument("--diff-json", metavar="PATH", default=None,
+                        help="With --diff, also write the comparison out as a json file")
+    parser.add_argument("--diff-all", action="store_true",
+                        help="With --diff, show changes that aren't statistically significant too")
+    parser.add_argument("--significance", type=float, metavar="LEVEL", default=diffSignificanceLevel,
+                        help=f"With --diff, the chance of any change in a section being reported as significant "
+                        f"when it's just noise, corrected for the number of changes in it (default: "
+                        f"{diffSignificanceLevel})")
+    parser.add_argument("--min-regression", type=float, metavar="PP", default=diffMinRegressionPercent,
+                        help=f"With --diff, how many percentage points a function's share of the exclusive "
+                        f"samples has to grow by to be listed as a regression (default: {diffMinRegressionPercent})")
+    parser.add_argument("--watch", metavar="DIR", default=None,
+                        help="Keep running, and analyze each new profile that's saved to DIR (e.g. the emulator's "
+                        "shared folder). Addresses already symbolicated for earlier profiles are reused.")
+    parser.add_argument("--watch-pattern", metavar="GLOB", default="*",
+                        help="With --watch, only analyze files in DIR matching this glob pattern (default: *)")
+    parser.add_argument("--separate", action="store_true",
+                        help="When given multiple profiles, print a report for each one instead of merging them")
+    parser.add_argument("--normalize", action="store_true",
+                        help="When merging multiple profiles, scale each one's sample counts so that they all "
+                        "contribute equally")
+    parser.add_argument("--build-rom-index", action="store_true",
+                        help="Compile the index for every ROM map in the ROM maps directory and exit. Indexes are "
+                        "otherwise built the first time each ROM map is used, and rebuilt when it changes.")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Don't read or write the symbolication cache or ROM map indexes")
+    parser.add_argument("--cache-dir", metavar="PATH", default=cacheDir,
+                        help=f"Directory for caching symbol and line tables and ROM map indexes between runs "
+                        f"(default: {cacheDir})")
+    parser.add_argument("--cache-max-size", type=int, metavar="MB", default=cacheMaxBytes // (1024 * 1024),
+                        help=f"Maximum size of the cache directory before least recently used entries are "
+                        f"removed (default: {cacheMaxBytes // (1024 * 1024)})")
     args = parser.parse_args()
     
     if args.llvm_symbolizer == True or llvmSymbolizerPath is not None:
@@ -660,26 +3305,89 @@ def parseArgs():
     return args
 
 
+def parseTimeWindow(text):
+    parts = text.split(":")
+    
+    if len(parts) != 2:
+        raise Exception(f"Invalid time window '{text}', expected START:END")
+    
+    try:
+        start, end = [float(part) if len(part.strip()) > 0 else None for part in parts]
+    except ValueError:
+        raise Exception(f"Invalid time window '{text}', expected START:END in seconds")
+    
+    if start is not None and end is not None and end <= start:
+        raise Exception(f"Invalid time window '{text}', END needs to be after START")
+    
+    return start, end
+
+
 def main():
     global romMapsDir, llvmSymbolizer, readelfPath, functionNameMaxChars, filenameMaxChars, samplesOutPath, showAddrs
+    global pprofOutPath, sampleRate, objdumpPath, annotateFunctions, romImagePath
+    global topCount, reportSections
+    global minPercent, collapsedOutPath, flameGraphOutPath, flameGraphIcicle, flameGraphReverse, flameGraphMinWidth
+    global cacheEnabled, cacheDir, cacheMaxBytes, useReadelf, jobCount, separateReports, normalizeProfiles
+    global diffJSONPath, diffShowAll, diffSignificanceLevel, diffMinRegressionPercent
+    global showTimeline, timelineCSVPath, timelineColumns, timeWindow, regionName
     
     args = parseArgs()
     
     llvmSymbolizer = args.llvm_symbolizer
-    
-    if args.retro68_toolchain is not None:
-        readelfPath = os.path.join(args.retro68_toolchain, "bin", "m68k-apple-macos-readelf")
-    elif "RETRO68_TOOLCHAIN" in os.environ:
-        readelfPath = os.path.join(os.environ["RETRO68_TOOLCHAIN"], "bin", "m68k-apple-macos-readelf")
-    else:
-        sys.stderr.write("Error: need to specify path to Retro68's toolchain directory, either using\n"
-                         "--retro68-toolchain or RETRO68_TOOLCHAIN environment variable\n")
+    useReadelf = args.use_readelf
+    jobCount = max(1, args.jobs)
+    
+    annotateFunctions = args.annotate
+    romImagePath = args.rom_image
+    toolchainPath = args.retro68_toolchain or os.environ.get("RETRO68_TOOLCHAIN")
+    
+    if toolchainPath is not None:
+        readelfPath = os.path.join(toolchainPath, "bin", "m68k-apple-macos-readelf")
+        objdumpPath = os.path.join(toolchainPath, "bin", "m68k-apple-macos-objdump")
+    elif useReadelf or len(annotateFunctions) > 0:
+        sys.stderr.write("Error: --use-readelf and --annotate need the path to Retro68's toolchain directory, either\n"
+                         "using --retro68-toolchain or RETRO68_TOOLCHAIN environment variable\n")
         sys.exit(1)
     
     functionNameMaxChars = args.function_max_chars
     filenameMaxChars = args.filename_max_chars
     showAddrs = args.show_sample_addrs
-    profilePath = args.profile_path
+    minPercent = args.min_percent
+    topCount = args.top
+    reportSections = [section.strip() for section in args.sections.split(",") if len(section.strip()) > 0]
+    
+    for section in reportSections:
+        if section not in allReportSections:
+            sys.stderr.write(f"Error: unknown report section '{section}', expected one of: "
+                             f"{', '.join(allReportSections)}\n")
+            sys.exit(1)
+    
+    pprofOutPath = args.pprof
+    sampleRate = max(1, args.sample_rate) if args.sample_rate is not None else None
+    collapsedOutPath = args.collapsed
+    flameGraphOutPath = args.flamegraph
+    flameGraphIcicle = args.icicle
+    flameGraphReverse = args.reverse_stacks
+    flameGraphMinWidth = args.flamegraph_min_width
+    separateReports = args.separate
+    normalizeProfiles = args.normalize
+    diffJSONPath = args.diff_json
+    diffShowAll = args.diff_all
+    diffSignificanceLevel = args.significance
+    diffMinRegressionPercent = args.min_regression
+    showTimeline = args.timeline
+    timelineCSVPath = args.timeline_csv
+    timelineColumns = max(1, args.timeline_columns)
+    
+    regionName = args.region
+    
+    if args.time_window is not None:
+        try:
+            timeWindow = parseTimeWindow(args.time_window)
+        except Exception as e:
+            sys.stderr.write(f"Error: {e}\n")
+            sys.exit(1)
+    
     binaryPath = args.binary_path
     
     if args.rom_maps_dir:
@@ -688,7 +3396,34 @@ def main():
     if args.samples_path:
         samplesOutPath = args.samples_path
     
-    process(profilePath, binaryPath)
+    cacheEnabled = not args.no_cache
+    cacheDir = args.cache_dir
+    cacheMaxBytes = args.cache_max_size * 1024 * 1024
+    
+    if args.build_rom_index:
+        buildAllROMMapIndexes()
+        return
+    
+    analyzer = Analyzer(binaryPath)
+    
+    if args.diff:
+        if len(args.profile_paths) != 2 or args.watch is not None:
+            sys.stderr.write("Error: --diff needs exactly two profiles (or glob patterns): BASE and NEW, "
+                             "and can't be used with --watch\n")
+            sys.exit(1)
+        
+        processDiff(analyzer, expandProfilePaths(args.profile_paths[:1]), expandProfilePaths(args.profile_paths[1:]))
+        return
+    
+    if len(annotateFunctions) > 0:
+        processAnnotations(analyzer, expandProfilePaths(args.profile_paths))
+        return
+    
+    if len(args.profile_paths) > 0:
+        process(analyzer, expandProfilePaths(args.profile_paths))
+    
+    if args.watch is not None:
+        watchForProfiles(analyzer, args.watch, args.watch_pattern)
 
 
 if __name__ == "__main__":
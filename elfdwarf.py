@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+
+# A minimal ELF and DWARF .debug_line reader, so that analyze.py can get at a
+# binary's sections, symbols and line number table without having to run
+# Retro68's readelf and scrape its text output. It only implements what the
+# profiler needs: section headers, .symtab, and version 2 through 4 line
+# number programs (which is what -gdwarf-4 produces). Works with both 32 and 64
+# bit ELF files of either endianness, though in practice the binaries we care
+# about are always big-endian 32-bit m68k ones.
+
+import os
+import mmap
+import struct
+from dataclasses import dataclass
+
+SHT_PROGBITS = 1
+SHT_SYMTAB = 2
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+SHN_XINDEX = 0xFFFF
+SHF_EXECINSTR = 0x4
+
+# The names readelf uses for symbol types, which is what the rest of the
+# analyzer expects to see
+symbolTypeNames = {
+    0: "NOTYPE",
+    1: "OBJECT",
+    2: "FUNC",
+    3: "SECTION",
+    4: "FILE",
+    5: "COMMON",
+    6: "TLS",
+    10: "IFUNC",
+}
+
+sectionTypeNames = {
+    0: "NULL",
+    SHT_PROGBITS: "PROGBITS",
+    SHT_SYMTAB: "SYMTAB",
+    3: "STRTAB",
+    4: "RELA",
+    5: "HASH",
+    6: "DYNAMIC",
+    7: "NOTE",
+    SHT_NOBITS: "NOBITS",
+    9: "REL",
+    SHT_DYNSYM: "DYNSYM",
+}
+
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_set_column = 5
+DW_LNS_negate_stmt = 6
+DW_LNS_set_basic_block = 7
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+
+
+class ELFError(Exception):
+    pass
+
+
+@dataclass
+class Section:
+    name: str = ""
+    type: int = 0
+    flags: int = 0
+    addr: int = 0
+    offset: int = 0
+    size: int = 0
+    link: int = 0
+    entsize: int = 0
+    
+    @property
+    def typeName(self):
+        return sectionTypeNames.get(self.type, str(self.type))
+
+
+@dataclass
+class Symbol:
+    name: str = ""
+    value: int = 0
+    size: int = 0
+    type: str = "NOTYPE"
+    bind: int = 0
+    sectionIndex: int = 0
+
+
+def readULEB128(data, pos):
+    result = 0
+    shift = 0
+    
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        
+        if byte < 0x80:
+            return result, pos
+        
+        shift += 7
+
+
+def readSLEB128(data, pos):
+    result = 0
+    shift = 0
+    
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        
+        if byte < 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            
+            return result, pos
+
+
+def readCString(data, pos):
+    end = pos
+    
+    while data[end] != 0:
+        end += 1
+    
+    return bytes(data[pos:end]).decode("utf-8", errors="replace"), end + 1
+
+
+class ELFFile:
+    """A memory-mapped ELF file. Use as a context manager, or call close()
+    when done with it."""
+    
+    def __init__(self, path):
+        self.path = path
+        
+        with open(path, "rb") as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ELFError(f"{path} is empty")
+        
+        try:
+            self._readHeader()
+            self._readSectionHeaders()
+        except (struct.error, IndexError):
+            self.close()
+            raise ELFError(f"{path} is truncated or not a valid ELF file")
+        except ELFError:
+            self.close()
+            raise
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+    
+    def _readHeader(self):
+        ident = self.data[:16]
+        
+        if len(ident) < 16 or ident[:4] != b"\x7fELF":
+            raise ELFError(f"{self.path} is not an ELF file")
+        
+        if ident[4] not in (1, 2):
+            raise ELFError(f"{self.path} has unknown ELF class {ident[4]}")
+        
+        if ident[5] not in (1, 2):
+            raise ELFError(f"{self.path} has unknown ELF data encoding {ident[5]}")
+        
+        self.is64Bit = ident[4] == 2
+        self.endian = "<" if ident[5] == 1 else ">"
+        
+        if self.is64Bit:
+            header = struct.unpack_from(self.endian + "HHIQQQIHHHHHH", self.data, 16)
+        else:
+            header = struct.unpack_from(self.endian + "HHIIIIIHHHHHH", self.data, 16)
+        
+        (_, self.machine, _, self.entry, _, self.sectionHeaderOffset, _, _, _, _,
+         self.sectionHeaderSize, self.sectionCount, self.sectionNamesIndex) = header
+        self.addressSize = 8 if self.is64Bit else 4
+    
+    def _readSectionHeaders(self):
+        if self.is64Bit:
+            headerFormat = struct.Struct(self.endian + "IIQQQQIIQQ")
+        else:
+            headerFormat = struct.Struct(self.endian + "IIIIIIIIII")
+        
+        self.sections = []
+        self.sectionsByName = {}
+        
+        if self.sectionHeaderOffset == 0:
+            return
+        
+        def readSectionHeader(index):
+            offset = self.sectionHeaderOffset + index * self.sectionHeaderSize
+            (nameOffset, type, flags, addr, fileOffset, size,
+             link, _, _, entsize) = headerFormat.unpack_from(self.data, offset)
+            return nameOffset, Section("", type, flags, addr, fileOffset, size, link, entsize)
+        
+        sectionCount = self.sectionCount
+        namesIndex = self.sectionNamesIndex
+        
+        # Extended section numbering: the real values live in section 0
+        if sectionCount == 0 or namesIndex == SHN_XINDEX:
+            _, first = readSectionHeader(0)
+            
+            if sectionCount == 0:
+                sectionCount = first.size
+            
+            if namesIndex == SHN_XINDEX:
+                namesIndex = first.link
+        
+        headers = [readSectionHeader(i) for i in range(sectionCount)]
+        
+        if namesIndex >= len(headers):
+            raise ELFError(f"{self.path} has an invalid section name table index")
+        
+        namesSection = headers[namesIndex][1]
+        
+        for nameOffset, section in headers:
+            section.name, _ = readCString(self.data, namesSection.offset + nameOffset)
+            self.sections.append(section)
+            
+            # Keep the first one if there are duplicate names
+            self.sectionsByName.setdefault(section.name, section)
+    
+    def section(self, name):
+        return self.sectionsByName.get(name)
+    
+    def sectionData(self, section):
+        if section.type == SHT_NOBITS:
+            return memoryview(b"")
+        
+        if section.offset + section.size > len(self.data):
+            raise ELFError(f"Section {section.name} in {self.path} extends past the end of the file")
+        
+        return memoryview(self.data)[section.offset:section.offset + section.size]
+    
+    def symbols(self):
+        symtab = self.section(".symtab")
+        
+        if symtab is None or symtab.type != SHT_SYMTAB:
+            symtab = self.section(".dynsym")
+        
+        if symtab is None:
+            return []
+        
+        if self.is64Bit:
+            symbolFormat = struct.Struct(self.endian + "IBBHQQ")
+        else:
+            symbolFormat = struct.Struct(self.endian + "IIIBBH")
+        
+        strtab = self.sections[symtab.link]
+        strings = self.sectionData(strtab)
+        data = self.sectionData(symtab)
+        result = []
+        
+        try:
+            for offset in range(0, len(data) - symbolFormat.size + 1, symbolFormat.size):
+                if self.is64Bit:
+                    nameOffset, info, _, sectionIndex, value, size = symbolFormat.unpack_from(data, offset)
+                else:
+                    nameOffset, value, size, info, _, sectionIndex = symbolFormat.unpack_from(data, offset)
+                
+                name, _ = readCString(strings, nameOffset)
+                type = symbolTypeNames.get(info & 0xF, str(info & 0xF))
+                result.append(Symbol(name, value, size, type, info >> 4, sectionIndex))
+        finally:
+            data.release()
+            strings.release()
+        
+        return result
+    
+    def lineRows(self):
+        """Generator that decodes the .debug_line section, yielding tuples of
+        (address, file path, line number, end of sequence) for each row of
+        the line number matrix, in the order they are produced. Rows that end
+        a sequence have a line number of None."""
+        section = self.section(".debug_line")
+        
+        if section is None:
+            return
+        
+        data = self.sectionData(section)
+        
+        try:
+            offset = 0
+            
+            while offset < len(data):
+                offset = yield from self._lineProgramRows(data, offset)
+        except IndexError:
+            raise ELFError(f".debug_line section in {self.path} is truncated")
+        finally:
+            data.release()
+    
+    def _lineProgramRows(self, data, offset):
+        endian = self.endian
+        unitLength = struct.unpack_from(endian + "I", data, offset)[0]
+        offset += 4
+        offsetSize = 4
+        
+        if unitLength == 0xFFFFFFFF:
+            unitLength = struct.unpack_from(endian + "Q", data, offset)[0]
+            offset += 8
+            offsetSize = 8
+        
+        unitEnd = offset + unitLength
+        version = struct.unpack_from(endian + "H", data, offset)[0]
+        offset += 2
+        
+        if version < 2 or version > 4:
+            raise ELFError(f"Unsupported DWARF line table version {version} in {self.path} "
+                           "(only versions 2 through 4 are supported; build with -gdwarf-4)")
+        
+        headerLength = int.from_bytes(data[offset:offset + offsetSize], "little" if endian == "<" else "big")
+        offset += offsetSize
+        programStart = offset + headerLength
+        
+        minInstructionLength = data[offset]
+        offset += 1
+        
+        if version >= 4:
+            # maximum_operations_per_instruction, only matters for VLIW
+            offset += 1
+        
+        # Skip default_is_stmt
+        lineBase = struct.unpack_from("b", data, offset + 1)[0]
+        lineRange = data[offset + 2]
+        opcodeBase = data[offset + 3]
+        offset += 4
+        standardOpcodeLengths = [0] + list(data[offset:offset + opcodeBase - 1])
+        offset += opcodeBase - 1
+        
+        includeDirs = []
+        
+        while data[offset] != 0:
+            directory, offset = readCString(data, offset)
+            includeDirs.append(directory)
+        
+        offset += 1
+        fileNames = [None] # DWARF 4 and earlier file numbers start at 1
+        
+        def readFileEntry(offset):
+            name, offset = readCString(data, offset)
+            dirIndex, offset = readULEB128(data, offset)
+            _, offset = readULEB128(data, offset) # modification time
+            _, offset = readULEB128(data, offset) # length
+            
+            # Directory 0 is the compilation directory, which isn't recorded
+            # here. readelf doesn't go looking for it either.
+            if dirIndex > 0 and dirIndex <= len(includeDirs) and not os.path.isabs(name):
+                name = os.path.join(includeDirs[dirIndex - 1], name)
+            
+            fileNames.append(name)
+            return offset
+        
+        while data[offset] != 0:
+            offset = readFileEntry(offset)
+        
+        offset = programStart
+        constAddPCAdvance = ((255 - opcodeBase) // lineRange) * minInstructionLength
+        byteOrder = "little" if endian == "<" else "big"
+        
+        def fileName(index):
+            if 0 < index < len(fileNames):
+                return fileNames[index]
+            
+            return f"<unknown file {index}>"
+        
+        address = 0
+        fileIndex = 1
+        line = 1
+        
+        while offset < unitEnd:
+            opcode = data[offset]
+            offset += 1
+            
+            if opcode >= opcodeBase:
+                adjusted = opcode - opcodeBase
+                address += (adjusted // lineRange) * minInstructionLength
+                line += lineBase + (adjusted % lineRange)
+                yield (address, fileName(fileIndex), line, False)
+            elif opcode == 0:
+                length, offset = readULEB128(data, offset)
+                end = offset + length
+                
+                if length == 0:
+                    continue
+                
+                subOpcode = data[offset]
+                
+                if subOpcode == DW_LNE_end_sequence:
+                    yield (address, fileName(fileIndex), None, True)
+                    address = 0
+                    fileIndex = 1
+                    line = 1
+                elif subOpcode == DW_LNE_set_address:
+                    address = int.from_bytes(data[offset + 1:end], byteOrder)
+                elif subOpcode == DW_LNE_define_file:
+                    readFileEntry(offset + 1)
+                
+                offset = end
+            elif opcode == DW_LNS_copy:
+                yield (address, fileName(fileIndex), line, False)
+            elif opcode == DW_LNS_advance_pc:
+                advance, offset = readULEB128(data, offset)
+                address += advance * minInstructionLength
+            elif opcode == DW_LNS_advance_line:
+                advance, offset = readSLEB128(data, offset)
+                line += advance
+            elif opcode == DW_LNS_set_file:
+                fileIndex, offset = readULEB128(data, offset)
+            elif opcode == DW_LNS_const_add_pc:
+                address += constAddPCAdvance
+            elif opcode == DW_LNS_fixed_advance_pc:
+                address += struct.unpack_from(endian + "H", data, offset)[0]
+                offset += 2
+            else:
+                # Opcodes that only affect state we don't track (column,
+                # is_stmt, basic_block, etc.) or that we don't know about
+                for _ in range(standardOpcodeLengths[opcode]):
+                    _, offset = readULEB128(data, offset)
+        
+        return unitEnd
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# Writes stack samples out as collapsed stacks (the text format Brendan
+# Gregg's flamegraph.pl and most other flame graph tools read), and renders
+# them as a self-contained SVG flame graph that can be opened in a web
+# browser. The SVG has a bit of embedded JavaScript so that clicking a frame
+# zooms in on it, but doesn't depend on anything else.
+
+import zlib
+from xml.sax.saxutils import escape
+
+imageWidth = 1200
+frameHeight = 16
+fontSize = 12
+# Rough width of a character in Verdana as a fraction of the font size, used
+# to work out how much of each frame's name fits in it
+fontWidth = 0.59
+sidePadding = 10
+topPadding = 50
+bottomPadding = 30
+
+
+def formatCollapsedStacks(stacks):
+    """Takes sample counts keyed by tuples of frame names, outermost function
+    first, and returns them in collapsed stack format: one stack per line,
+    with the frames separated by semicolons, then a space and the count."""
+    lines = []
+    
+    for stack, count in sorted(stacks.items()):
+        # Counts can be fractional when profiles have been normalized
+        count = round(count)
+        
+        if count > 0:
+            lines.append(f"{';'.join(stack)} {count}\n")
+    
+    return "".join(lines)
+
+
+def frameColor(name, isROM):
+    # Derived from the name so that a function is the same color everywhere
+    # it appears and from one run to the next
+    hashValue = zlib.crc32(name.encode("utf-8"))
+    v1 = (hashValue & 0xFF) / 255
+    v2 = ((hashValue >> 8) & 0xFF) / 255
+    v3 = ((hashValue >> 16) & 0xFF) / 255
+    
+    if isROM:
+        return f"rgb({int(50 + 60 * v1)},{int(165 + 55 * v2)},{int(165 + 55 * v2)})"
+    
+    return f"rgb({int(205 + 50 * v3)},{int(230 * v1)},{int(55 * v2)})"
+
+
+def fitLabel(name, width):
+    charCount = int((width - 6) / (fontSize * fontWidth))
+    
+    if charCount < 3:
+        return ""
+    
+    if len(name) <= charCount:
+        return name
+    
+    return name[:charCount - 2] + ".."
+
+
+def layoutFrames(stacks, scale, minWidth):
+    """Works out where each frame goes, returning a list of (name, isROM,
+    count, depth, x, width, mergedFrameCount) tuples with x and width in
+    pixels. Children narrower than minWidth are merged into a single frame
+    after their siblings, with a name of None and mergedFrameCount saying how
+    many there were, and nothing is drawn above it.
+    
+    Rather than building a tree of every stack, the stacks under each frame
+    are grouped by their next frame one level at a time, so stacks that end
+    up in frames too small to draw aren't looked at any further. That keeps
+    this fast for profiles with huge numbers of unique stacks."""
+    frames = []
+    # Walking the tree without recursion, since deeply recursive code makes for very deep trees
+    work = [(list(stacks.items()), 0, 0.0)]
+    
+    while len(work) > 0:
+        items, depth, x = work.pop()
+        groups = {}
+        
+        for item in items:
+            if len(item[0]) > depth:
+                frame = item[0][depth]
+                
+                if frame in groups:
+                    groups[frame].append(item)
+                else:
+                    groups[frame] = [item]
+        
+        mergedCount = 0
+        mergedFrameCount = 0
+        
+        for frame in sorted(groups.keys()):
+            group = groups[frame]
+            count = sum([item[1] for item in group])
+            width = count * scale
+            
+            if width < minWidth:
+                mergedCount += count
+                mergedFrameCount += 1
+                continue
+            
+            frames.append((frame[0], frame[1], count, depth, x, width, 0))
+            work.append((group, depth + 1, x))
+            x += width
+        
+        if mergedFrameCount > 0 and mergedCount * scale >= minWidth:
+            frames.append((None, False, mergedCount, depth, x, mergedCount * scale, mergedFrameCount))
+    
+    return frames
+
+
+def renderFlameGraph(stacks, title="Flame Graph", icicle=False, minWidth=0.1):
+    """Takes sample counts keyed by tuples of (name, isROM) frames,
+    outermost function first, and returns an SVG flame graph of them. ROM
+    frames are drawn in shades of blue, and the rest in reds and yellows.
+    With icicle set the outermost functions are at the top instead of the
+    bottom. Frames narrower than minWidth pixels are merged together."""
+    totalCount = sum(stacks.values())
+    graphWidth = imageWidth - 2 * sidePadding
+    scale = graphWidth / totalCount if totalCount > 0 else 0
+    frames = layoutFrames(stacks, scale, minWidth)
+    maxDepth = max([frame[3] for frame in frames], default=0)
+    imageHeight = topPadding + (maxDepth + 1) * frameHeight + bottomPadding
+    
+    def frameY(depth):
+        if icicle:
+            return topPadding + depth * frameHeight
+        
+        return imageHeight - bottomPadding - (depth + 1) * frameHeight
+    
+    out = []
+    out.append(f'<?xml version="1.0" standalone="no"?>\n'
+               f'<svg version="1.1" width="{imageWidth}" height="{imageHeight}" '
+               f'viewBox="0 0 {imageWidth} {imageHeight}" xmlns="http://www.w3.org/2000/svg" '
+               f'data-width="{graphWidth}" data-padding="{sidePadding}" data-font-size="{fontSize}" '
+               f'data-font-width="{fontWidth}">\n')
+    out.append(f'<style>\n'
+               f'text {{ font-family: Verdana, sans-serif; font-size: {fontSize}px; fill: rgb(0,0,0); }}\n'
+               f'#frames g:hover rect {{ stroke: rgb(0,0,0); stroke-width: 0.5; cursor: pointer; }}\n'
+               f'#frames text {{ pointer-events: none; }}\n'
+               f'.title {{ font-size: {fontSize + 5}px; text-anchor: middle; }}\n'
+               f'.ancestor rect {{ opacity: 0.5; }}\n'
+               f'</style>\n')
+    out.append(flameGraphScript)
+    out.append(f'<rect x="0" y="0" width="{imageWidth}" height="{imageHeight}" fill="rgb(245,245,235)" '
+               f'onclick="unzoom()"/>\n')
+    out.append(f'<text class="title" x="{imageWidth / 2}" y="24">{escape(title)}</text>\n')
+    out.append(f'<text x="{sidePadding}" y="{topPadding - 12}">ROM frames are shown in blue</text>\n')
+    out.append(f'<text id="unzoom" x="{imageWidth - sidePadding}" y="{topPadding - 12}" text-anchor="end" '
+               f'style="opacity: 0; cursor: pointer;" onclick="unzoom()">Reset Zoom</text>\n')
+    out.append(f'<text id="details" x="{sidePadding}" y="{imageHeight - 10}"> </text>\n')
+    out.append('<g id="frames">\n')
+    
+    for name, isROM, count, depth, x, width, mergedFrameCount in frames:
+        percent = (count * 10000 // totalCount) / 100.0
+        
+        if name is None:
+            description = f"{mergedFrameCount} small frames merged"
+            fill = "rgb(190,190,190)"
+            label = ""
+        else:
+            description = name + (" (ROM)" if isROM else "")
+            fill = frameColor(name, isROM)
+            label = fitLabel(name, width)
+        
+        attributeName = escape(name or "", {'"': "&quot;"})
+        out.append(f'<g data-x="{x:.2f}" data-w="{width:.2f}" data-d="{depth}" data-name="{attributeName}" '
+                   f'onclick="zoom(this)" onmouseover="showDetails(this)" onmouseout="showDetails(null)">'
+                   f'<title>{escape(description)} ({round(count)} samples, {percent}%)</title>'
+                   f'<rect x="{sidePadding + x:.2f}" y="{frameY(depth)}" width="{width:.2f}" '
+                   f'height="{frameHeight - 1}" rx="2" fill="{fill}"/>'
+                   f'<text x="{sidePadding + x + 3:.2f}" y="{frameY(depth) + frameHeight - 4}">{escape(label)}</text>'
+                   f'</g>\n')
+    
+    out.append('</g>\n</svg>\n')
+    
+    return "".join(out)
+
+
+flameGraphScript = '''<script type="text/ecmascript"><![CDATA[
+var svg = document.documentElement;
+var graphWidth = +svg.getAttribute("data-width");
+var padding = +svg.getAttribute("data-padding");
+var charWidth = +svg.getAttribute("data-font-size") * +svg.getAttribute("data-font-width");
+
+function fitLabel(name, width) {
+    var charCount = Math.floor((width - 6) / charWidth);
+    if (charCount < 3) return "";
+    if (name.length <= charCount) return name;
+    return name.substring(0, charCount - 2) + "..";
+}
+
+function place(g, x, width) {
+    var rect = g.getElementsByTagName("rect")[0];
+    var text = g.getElementsByTagName("text")[0];
+    rect.setAttribute("x", padding + x);
+    rect.setAttribute("width", width);
+    text.setAttribute("x", padding + x + 3);
+    text.textContent = fitLabel(g.getAttribute("data-name"), width);
+}
+
+function zoom(target) {
+    var x = +target.getAttribute("data-x");
+    var width = +target.getAttribute("data-w");
+    var depth = +target.getAttribute("data-d");
+    var scale = graphWidth / width;
+    var frames = document.getElementById("frames").children;
+    for (var i = 0; i < frames.length; i++) {
+        var g = frames[i];
+        var gx = +g.getAttribute("data-x");
+        var gWidth = +g.getAttribute("data-w");
+        var gDepth = +g.getAttribute("data-d");
+        g.removeAttribute("class");
+        g.style.display = "";
+        if (gDepth < depth && gx <= x + 0.001 && gx + gWidth >= x + width - 0.001) {
+            g.setAttribute("class", "ancestor");
+            place(g, 0, graphWidth);
+        } else if (gDepth >= depth && gx >= x - 0.001 && gx + gWidth <= x + width + 0.001) {
+            place(g, (gx - x) * scale, gWidth * scale);
+        } else {
+            g.style.display = "none";
+        }
+    }
+    document.getElementById("unzoom").style.opacity = 1;
+}
+
+function unzoom() {
+    var frames = document.getElementById("frames").children;
+    for (var i = 0; i < frames.length; i++) {
+        var g = frames[i];
+        g.removeAttribute("class");
+        g.style.display = "";
+        place(g, +g.getAttribute("data-x"), +g.getAttribute("data-w"));
+    }
+    document.getElementById("unzoom").style.opacity = 0;
+}
+
+function showDetails(g) {
+    var details = document.getElementById("details");
+    details.textContent = g ? g.getElementsByTagName("title")[0].textContent : " ";
+}
+]]></script>
+'''
@@ -11,18 +11,29 @@
 
 typedef struct ArenaEntry {
     UInt16 keyLength;
+    UInt32 hash; // compared before the key, which is usually enough to tell keys apart
     UInt32 value;
-    UInt32 nextOffset;
+    UInt32 index;
+    UInt32 nextOffset; // offset plus one, like the buckets (0 = end of chain)
     UInt8 keyData[];
 } ArenaEntry;
 
-// Jenkins one-at-a-time hash, good for 68k
+// Jenkins one-at-a-time hash, good for 68k, but taking keys a 32-bit word at a
+// time instead of a byte at a time since they're stacks of return addresses.
+// Keys must be word aligned.
 static UInt32 hashKey(const UInt8 *key, UInt16 keyLength)
 {
+    const UInt32 *words = (const UInt32 *)key;
     UInt32 hash = 0;
-    UInt16 i;
+    UInt16 i, wordCount = keyLength / sizeof(UInt32);
     
-    for(i = 0; i < keyLength; ++i) {
+    for(i = 0; i < wordCount; ++i) {
+        hash += words[i];
+        hash += (hash << 10);
+        hash ^= (hash >> 6);
+    }
+    
+    for(i = wordCount * sizeof(UInt32); i < keyLength; ++i) {
         hash += key[i];
         hash += (hash << 10);
         hash ^= (hash >> 6);
@@ -47,6 +58,11 @@ static UInt32 getEntrySize(UInt16 keyLength)
     return result;
 }
 
+UInt32 hashtableMemoryNeeded(UInt32 entryCount, UInt16 keyLength, UInt32 bucketCount)
+{
+    return bucketCount * sizeof(UInt32) + entryCount * getEntrySize(keyLength);
+}
+
 HashtableStatus hashtableInit(HashTable *table, void *mem, UInt32 memSize, UInt32 bucketCount)
 {
     UInt32 bucketsBytes;
@@ -69,50 +85,77 @@ HashtableStatus hashtableInit(HashTable *table, void *mem, UInt32 memSize, UInt3
     table->arena = (UInt8*)mem + bucketsBytes;
     table->arenaSize = memSize - bucketsBytes;
     table->arenaUsed = 0;
+    table->entryCount = 0;
+    table->usedBucketCount = 0;
+    table->maxChainLength = 0;
+    table->lookupCount = 0;
+    table->probeCount = 0;
     
     return kHashtableNoErr;
 }
 
-static Boolean hashtableLookup_(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 hash,
-                                UInt32 bucketIndex, UInt32 **outValue)
+// If the key isn't found, outChainLength is the length of the bucket's chain
+static ArenaEntry *hashtableLookup_(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 hash,
+                                   UInt32 *outChainLength)
 {
-    UInt32 offset = table->buckets[bucketIndex];
+    UInt32 offset = table->buckets[hash & (table->bucketCount - 1)];
+    UInt32 chainLength = 0;
+    
+    table->lookupCount++;
 
     while(offset != 0) {
-        ArenaEntry *entry = (ArenaEntry*)(table->arena + offset);
+        ArenaEntry *entry = (ArenaEntry*)(table->arena + offset - 1);
+        
+        chainLength++;
 
-        if (entry->keyLength == keyLength && memcmp(entry->keyData, key, keyLength) == 0) {
-            *outValue = &entry->value;
-            return true;
+        if (entry->hash == hash && entry->keyLength == keyLength && memcmp(entry->keyData, key, keyLength) == 0) {
+            table->probeCount += chainLength;
+            return entry;
         }
         
         offset = entry->nextOffset;
     }
     
-    return false;
+    table->probeCount += chainLength;
+    *outChainLength = chainLength;
+    
+    return NULL;
 }
 
 Boolean hashtableLookup(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 **outValue)
 {
-    UInt32 hash = hashKey(key, keyLength);
-    UInt32 bucketIndex = bucketIndex = hash & (table->bucketCount - 1);
+    UInt32 chainLength;
+    ArenaEntry *entry = hashtableLookup_(table, key, keyLength, hashKey(key, keyLength), &chainLength);
+    
+    if (!entry) {
+        return false;
+    }
     
-    return hashtableLookup_(table, key, keyLength, hash, bucketIndex, outValue);
+    *outValue = &entry->value;
+    
+    return true;
 }
 
-HashtableStatus hashtableInsertOrLookup(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 **outValue)
+HashtableStatus hashtableInsertOrLookup(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 **outValue,
+                                        UInt32 *outIndex)
 {
-    UInt32 hash, bucketIndex, entrySize, *bucket;
-    ArenaEntry *newEntry;
+    UInt32 hash, entrySize, *bucket, chainLength;
+    ArenaEntry *entry;
     
     hash = hashKey(key, keyLength);
-    bucketIndex = bucketIndex = hash & (table->bucketCount - 1);
+    entry = hashtableLookup_(table, key, keyLength, hash, &chainLength);
     
-    if (hashtableLookup_(table, key, keyLength, hash, bucketIndex, outValue)) {
+    if (entry) {
+        *outValue = &entry->value;
+        
+        if (outIndex) {
+            *outIndex = entry->index;
+        }
+        
         return kHashtableFoundKey;
     }
     
-    bucket = &table->buckets[bucketIndex];
+    bucket = &table->buckets[hash & (table->bucketCount - 1)];
 
     // Not found: allocate new arena entry
     entrySize = getEntrySize(keyLength);
@@ -121,17 +164,31 @@ HashtableStatus hashtableInsertOrLookup(HashTable *table, const UInt8 *key, UInt
         return kHashtableNotEnoughMemoryError;
     }
 
-    newEntry = (ArenaEntry*)(table->arena + table->arenaUsed);
-    newEntry->keyLength = keyLength;
-    newEntry->value = 0;
-    newEntry->nextOffset = *bucket; // chain to previous head
-    memcpy(newEntry->keyData, key, keyLength);
+    entry = (ArenaEntry*)(table->arena + table->arenaUsed);
+    entry->keyLength = keyLength;
+    entry->hash = hash;
+    entry->value = 0;
+    entry->index = table->entryCount++;
+    entry->nextOffset = *bucket; // chain to previous head
+    memcpy(entry->keyData, key, keyLength);
 
     // Point bucket to new entry
-    *bucket = table->arenaUsed;
+    *bucket = table->arenaUsed + 1;
     table->arenaUsed += entrySize;
     
-    *outValue = &newEntry->value;
+    if (chainLength == 0) {
+        table->usedBucketCount++;
+    }
+    
+    if (chainLength + 1 > table->maxChainLength) {
+        table->maxChainLength = chainLength + 1;
+    }
+    
+    *outValue = &entry->value;
+    
+    if (outIndex) {
+        *outIndex = entry->index;
+    }
 
     return kHashtableInsertedKey;
 }
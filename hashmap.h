@@ -15,19 +15,32 @@ typedef enum HashtableStatus_ {
 
 typedef struct HashTable {
     UInt32 bucketCount; // must be power of two
-    UInt32 *buckets; // offsets into arena (0 = empty bucket)
+    UInt32 *buckets; // offsets into arena plus one (0 = empty bucket)
     UInt8 *arena; // arena memory
     UInt32 arenaSize;
     UInt32 arenaUsed;
+    UInt32 entryCount;
+    
+    // Statistics, for working out whether there are enough buckets
+    UInt32 usedBucketCount;
+    UInt32 maxChainLength;
+    UInt32 lookupCount;
+    UInt32 probeCount; // entries compared against while looking up keys
 } HashTable;
 
 typedef struct HashtableIterator {
     UInt32 arenaOffset;
 } HashtableIterator;
 
+// How much memory hashtableInit needs for a table that can hold entryCount
+// entries with keys of keyLength bytes
+UInt32 hashtableMemoryNeeded(UInt32 entryCount, UInt16 keyLength, UInt32 bucketCount);
 HashtableStatus hashtableInit(HashTable *table, void *mem, UInt32 memMize, UInt32 bucketCount);
 Boolean hashtableLookup(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 **outValue);
-HashtableStatus hashtableInsertOrLookup(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 **outValue);
+// outIndex (optional) receives the entry's index, i.e. the order it was inserted
+// in, which is also the order hashtableIterNext returns entries in
+HashtableStatus hashtableInsertOrLookup(HashTable *table, const UInt8 *key, UInt16 keyLength, UInt32 **outValue,
+                                        UInt32 *outIndex);
 void hashtableIterInit(HashtableIterator *it);
 Boolean hashtableIterNext(HashTable *table, HashtableIterator *it, const UInt8 **key, UInt16 *keyLength, UInt32 **value);
 
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Writes profiles in the gzipped protocol buffer format that Go's pprof and
+# other tools built around it read (see profile.proto in
+# github.com/google/pprof). Only writing is supported, and only the parts of
+# the format the analyzer needs, so there's a small protobuf encoder here
+# rather than a dependency on the protobuf package.
+
+import gzip
+
+# profile.proto field numbers
+PROFILE_SAMPLE_TYPE = 1
+PROFILE_SAMPLE = 2
+PROFILE_MAPPING = 3
+PROFILE_LOCATION = 4
+PROFILE_FUNCTION = 5
+PROFILE_STRING_TABLE = 6
+PROFILE_TIME_NANOS = 9
+PROFILE_DURATION_NANOS = 10
+PROFILE_PERIOD_TYPE = 11
+PROFILE_PERIOD = 12
+PROFILE_COMMENT = 13
+
+VALUE_TYPE_TYPE = 1
+VALUE_TYPE_UNIT = 2
+
+SAMPLE_LOCATION_ID = 1
+SAMPLE_VALUE = 2
+
+MAPPING_ID = 1
+MAPPING_MEMORY_START = 2
+MAPPING_MEMORY_LIMIT = 3
+MAPPING_FILE_OFFSET = 4
+MAPPING_FILENAME = 5
+MAPPING_BUILD_ID = 6
+MAPPING_HAS_FUNCTIONS = 7
+MAPPING_HAS_FILENAMES = 8
+MAPPING_HAS_LINE_NUMBERS = 9
+
+LOCATION_ID = 1
+LOCATION_MAPPING_ID = 2
+LOCATION_ADDRESS = 3
+LOCATION_LINE = 4
+
+LINE_FUNCTION_ID = 1
+LINE_LINE = 2
+
+FUNCTION_ID = 1
+FUNCTION_NAME = 2
+FUNCTION_SYSTEM_NAME = 3
+FUNCTION_FILENAME = 4
+FUNCTION_START_LINE = 5
+
+WIRE_TYPE_VARINT = 0
+WIRE_TYPE_LENGTH_DELIMITED = 2
+
+
+def encodeVarint(value):
+    # Negative int64s are encoded as their 64-bit two's complement
+    value &= (1 << 64) - 1
+    result = bytearray()
+    
+    while value >= 0x80:
+        result.append((value & 0x7F) | 0x80)
+        value >>= 7
+    
+    result.append(value)
+    
+    return bytes(result)
+
+
+def varintField(fieldNumber, value):
+    # Fields with default values are left out, as protobuf does
+    if value == 0:
+        return b""
+    
+    return encodeVarint((fieldNumber << 3) | WIRE_TYPE_VARINT) + encodeVarint(value)
+
+
+def bytesField(fieldNumber, data):
+    return encodeVarint((fieldNumber << 3) | WIRE_TYPE_LENGTH_DELIMITED) + encodeVarint(len(data)) + data
+
+
+def packedVarintsField(fieldNumber, values):
+    if len(values) == 0:
+        return b""
+    
+    return bytesField(fieldNumber, b"".join([encodeVarint(value) for value in values]))
+
+
+class PprofProfile:
+    """Builds up a profile.proto message. Strings, functions and locations are
+    deduplicated as they're added, with locations keyed by mapping and
+    address, so that each address only appears in the file once however many
+    samples include it."""
+    
+    def __init__(self, sampleTypes, periodType, period):
+        """sampleTypes is a list of (type, unit) tuples, one for each value
+        in every sample, and periodType is a (type, unit) tuple for period"""
+        self.strings = [""]
+        self.stringIds = {"": 0}
+        self.sampleTypes = [(self.string(type), self.string(unit)) for type, unit in sampleTypes]
+        self.periodType = (self.string(periodType[0]), self.string(periodType[1]))
+        self.period = period
+        self.timeNanos = 0
+        self.durationNanos = 0
+        self.comments = []
+        self.mappings = []
+        self.functions = []
+        self.functionIds = {}
+        self.locations = []
+        self.locationIds = {}
+        self.samples = []
+    
+    def string(self, s):
+        stringId = self.stringIds.get(s)
+        
+        if stringId is None:
+            stringId = len(self.strings)
+            self.stringIds[s] = stringId
+            self.strings.append(s)
+        
+        return stringId
+    
+    def addComment(self, comment):
+        self.comments.append(self.string(comment))
+    
+    def addMapping(self, memoryStart, memoryLimit, filename, buildId="", hasFilenames=False, hasLineNumbers=False):
+        mappingId = len(self.mappings) + 1
+        self.mappings.append(b"".join([
+            varintField(MAPPING_ID, mappingId),
+            varintField(MAPPING_MEMORY_START, memoryStart),
+            varintField(MAPPING_MEMORY_LIMIT, memoryLimit),
+            varintField(MAPPING_FILENAME, self.string(filename)),
+            varintField(MAPPING_BUILD_ID, self.string(buildId)),
+            # Everything we write out has already been symbolicated
+            varintField(MAPPING_HAS_FUNCTIONS, 1),
+            varintField(MAPPING_HAS_FILENAMES, int(hasFilenames)),
+            varintField(MAPPING_HAS_LINE_NUMBERS, int(hasLineNumbers)),
+        ]))
+        
+        return mappingId
+    
+    def addFunction(self, name, filename="", startLine=0):
+        key = (name, filename, startLine)
+        functionId = self.functionIds.get(key)
+        
+        if functionId is None:
+            functionId = len(self.functions) + 1
+            self.functionIds[key] = functionId
+            self.functions.append(b"".join([
+                varintField(FUNCTION_ID, functionId),
+                varintField(FUNCTION_NAME, self.string(name)),
+                varintField(FUNCTION_SYSTEM_NAME, self.string(name)),
+                varintField(FUNCTION_FILENAME, self.string(filename)),
+                varintField(FUNCTION_START_LINE, startLine),
+            ]))
+        
+        return functionId
+    
+    def addLocation(self, mappingId, address, functionId, line=0):
+        key = (mappingId, address)
+        locationId = self.locationIds.get(key)
+        
+        if locationId is None:
+            locationId = len(self.locations) + 1
+            self.locationIds[key] = locationId
+            lineMessage = varintField(LINE_FUNCTION_ID, functionId) + varintField(LINE_LINE, line)
+            self.locations.append(b"".join([
+                varintField(LOCATION_ID, locationId),
+                varintField(LOCATION_MAPPING_ID, mappingId),
+                varintField(LOCATION_ADDRESS, address),
+                bytesField(LOCATION_LINE, lineMessage),
+            ]))
+        
+        return locationId
+    
+    def addSample(self, locationIds, values):
+        """locationIds starts with the innermost function"""
+        self.samples.append(packedVarintsField(SAMPLE_LOCATION_ID, locationIds)
+                            + packedVarintsField(SAMPLE_VALUE, values))
+    
+    def serialize(self):
+        def valueType(typeAndUnit):
+            return varintField(VALUE_TYPE_TYPE, typeAndUnit[0]) + varintField(VALUE_TYPE_UNIT, typeAndUnit[1])
+        
+        parts = [bytesField(PROFILE_SAMPLE_TYPE, valueType(sampleType)) for sampleType in self.sampleTypes]
+        parts += [bytesField(PROFILE_SAMPLE, sample) for sample in self.samples]
+        parts += [bytesField(PROFILE_MAPPING, mapping) for mapping in self.mappings]
+        parts += [bytesField(PROFILE_LOCATION, location) for location in self.locations]
+        parts += [bytesField(PROFILE_FUNCTION, function) for function in self.functions]
+        parts += [bytesField(PROFILE_STRING_TABLE, s.encode("utf-8")) for s in self.strings]
+        parts.append(varintField(PROFILE_TIME_NANOS, self.timeNanos))
+        parts.append(varintField(PROFILE_DURATION_NANOS, self.durationNanos))
+        parts.append(bytesField(PROFILE_PERIOD_TYPE, valueType(self.periodType)))
+        parts.append(varintField(PROFILE_PERIOD, self.period))
+        parts.append(packedVarintsField(PROFILE_COMMENT, self.comments))
+        
+        return b"".join(parts)
+    
+    def write(self, path):
+        with gzip.open(path, "wb") as f:
+            f.write(self.serialize())
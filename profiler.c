@@ -1,4 +1,5 @@
 #include <Errors.h>
+#include <Events.h>
 #include <Files.h>
 #include <Folders.h>
 #include <Gestalt.h>
@@ -24,17 +25,161 @@ extern UInt32 profilerAppHeapStart;
 extern UInt32 profilerAppHeapEnd;
 
 static Ptr sampleData = NULL;
-static HashTable samples;
+static UInt32 sampleDataSize = 0;
+static HashTable sampleTables[2];
+// The table samples are being recorded in. When spilling to disk the other one
+// is either ready to take over or waiting for ProfilerIdle to write it out.
+static HashTable *volatile samples = &sampleTables[0];
 static UInt32 sampleCount = 0;
 static UInt32 badSampleCount = 0;
 static TimerUPP timerUPP = NULL;
 static long timerUSec;
 static Boolean timerEnabled = false;
 static UInt16 errorCode = 0;
+static long samplingRate = 0;
+static UInt32 requestedBucketCount = 0;
+static UInt32 profilingTicks = 0;
+static UInt32 startTicks = 0;
+
+// Spill mode: the sample buffer is split into two tables, and when the one
+// being recorded in fills up the profiler switches to the other, leaving
+// ProfilerIdle to append the full one to the spill file
+static FILE *spillFile = NULL;
+static volatile Boolean spareTableReady = false;
+static UInt32 spillCount = 0;
+static UInt32 droppedSampleCount = 0;
+// Stats of all the tables written out so far, for the file's header
+static HashTable spillTotals;
+
+// Named regions: ProfilerPushRegion gives each name an id, and samples taken
+// inside regions have the ids added to the end of their stack, after the
+// outermost frame, innermost region first. Ids are stored as (id << 1) | 1,
+// which can't be mistaken for a return address since those are always even.
+#define kMaxRegionCount 64
+#define kMaxRegionNameLength 31
+#define kMaxRegionDepth 8
+
+static char regionNames[kMaxRegionCount][kMaxRegionNameLength + 1];
+static UInt16 regionCount = 0;
+// Ids of the regions that have been pushed, or 0 for ones without an id
+static volatile UInt8 regionStack[kMaxRegionDepth];
+// Can be more than kMaxRegionDepth, in which case the innermost regions aren't recorded
+static volatile UInt16 regionDepth = 0;
+
+// Profiles are written in version 2 of the file format, which starts with this
+// header. Version 1 files start with the machine name instead, which never
+// begins with the magic number.
+typedef struct ProfileFileHeader {
+    OSType magic;
+    UInt16 version;
+    UInt16 headerSize; // of the fields after this one, so more can be added
+    UInt32 samplesPerSecond;
+    UInt32 durationMilliseconds;
+    UInt32 sampleCount;
+    UInt32 badSampleCount;
+    UInt16 errorCode;
+    UInt16 flags;
+    UInt32 stackCount;
+    UInt32 bucketCount;
+    UInt32 arenaUsed;
+    UInt32 arenaSize;
+    UInt32 usedBucketCount;
+    UInt32 maxChainLength;
+    UInt32 lookupCount;
+    UInt32 probeCount;
+    UInt32 spillCount;
+    UInt32 droppedSampleCount;
+} ProfileFileHeader;
+
+#define kProfileFileMagic 'P68K'
+#define kProfileFileVersion 2
+// The samples were spilled to disk in several chunks as they were recorded
+#define kProfileSpilledFlag 1
+// Set until a spill file is finished, so that the header's numbers can't be trusted
+#define kProfileIncompleteFlag 2
+
+// Timeline mode: as well as the totals in the hashtable, we count how many
+// times each stack was sampled during each time slice. Entries for the current
+// slice are at the end of the buffer, so finding a stack's counter only means
+// searching back through the few entries made since the slice started.
+typedef struct TimelineEntry {
+    UInt32 slice;
+    UInt16 stackId; // index of the stack's entry in the hashtable
+    UInt16 count;
+} TimelineEntry;
+
+#define kTimelineUnknownStack 0xFFFF
+#define kTimelineOverflowedFlag 1
+
+static TimelineEntry *timelineEntries = NULL;
+static UInt32 timelineCapacity = 0;
+static UInt32 timelineUsed = 0;
+static UInt32 timelineSliceStart = 0;
+static UInt32 timelineSlice = 0;
+static UInt16 timelineTicksPerSlice = 0;
+static UInt16 timelineTicksLeft = 0;
+static Boolean timelineOverflowed = false;
+
+// Overhead measurement: how long the timer function takes for each sample,
+// timed with Microseconds. As well as the total and the longest, the times
+// are counted in a histogram with power of two buckets in microseconds: under
+// 2, 2 to 3, 4 to 7, and so on, with the last counting anything over 32 ms.
+#define kOverheadBucketCount 16
+
+static Boolean overheadEnabled = false;
+static UInt32 overheadSampleCount = 0;
+static UInt32 overheadTotalHi = 0;
+static UInt32 overheadTotalLo = 0;
+static UInt32 overheadMax = 0;
+static UInt32 overheadHistogram[kOverheadBucketCount];
+
+// Instrumentation: when the app is built with -finstrument-functions, the
+// compiler calls __cyg_profile_func_enter and __cyg_profile_func_exit around
+// every function, which count each function's calls in an open addressing
+// table, and optionally time them with Microseconds. Each function is recorded
+// by the return address of its call to __cyg_profile_func_enter, which is in
+// the function's own code, so it's symbolicated just like the return addresses
+// in the samples. Timing keeps a stack of the calls in progress so that the
+// time spent in a function's callees can be taken out of its self time.
+#define kMaxCallDepth 64
+#define kCallCountsTimedFlag 1
+
+typedef struct CallCountEntry {
+    UInt32 fn; // the function's address as the compiler passes it, or 0 for an empty slot
+    UInt32 addr; // saved from here on
+    UInt32 calls;
+    UInt32 totalHi;
+    UInt32 totalLo;
+    UInt32 selfHi;
+    UInt32 selfLo;
+} CallCountEntry;
+
+typedef struct CallFrame {
+    UInt32 fn;
+    CallCountEntry *entry; // NULL if the table was full
+    UInt32 startTime;
+    UInt32 childTime;
+} CallFrame;
+
+static CallCountEntry *callEntries = NULL;
+static UInt32 callSlotCount = 0; // must be power of two
+static UInt32 callEntryCount = 0;
+static UInt32 droppedCallCount = 0;
+static Boolean callTimingEnabled = false;
+static CallFrame callFrames[kMaxCallDepth];
+// Can be more than kMaxCallDepth, in which case the innermost calls aren't timed
+static UInt16 callDepth = 0;
+
+#ifdef __GNUC__
+#define NO_INSTRUMENT __attribute__((no_instrument_function))
+#else
+#define NO_INSTRUMENT
+#endif
 
 void ProfilerFindPCOffset();
 void ProfilerTimerFunctionShim();
 void ProfilerStackCrawl(UInt32 *buffer, UInt16 *outEntriesCount, UInt32 *endOfBuffer, UInt16 *error);
+OSErr FinishProfilerSpilling();
 
 static void PrependPString(const Str255 src, Str255 dst)
 {
@@ -63,25 +208,68 @@ static void AppendPString(Str255 dst, const Str255 src)
     dst[0] = srcLen + dstLen;
 }
 
-void ProfilerTimerFunction(UInt8 *stackPointer)
+static void AddTimelineSample(UInt32 stackIndex)
 {
-    UInt16 callStackSize = 0;
-    UInt32 callStack[50], *sampleHits;
-    HashtableStatus hashError;
+    UInt16 stackId;
+    UInt32 i;
     
-    if (!timerEnabled) {
+    if (timelineOverflowed) {
         return;
     }
     
-    callStack[0] = *(UInt32 *)(stackPointer + profilerPCOffset);
+    stackId = (stackIndex < kTimelineUnknownStack) ? stackIndex : kTimelineUnknownStack;
     
-    if (callStack[0] >= profilerAppHeapStart) {
-        ProfilerStackCrawl((UInt32 *)(callStack + 1), &callStackSize, (UInt32 *)(callStack + 50), &errorCode);
-        callStackSize++;
-    } else {
-        errorCode = 3;
+    for(i = timelineSliceStart; i < timelineUsed; ++i) {
+        if (timelineEntries[i].stackId == stackId) {
+            if (timelineEntries[i].count < 0xFFFF) {
+                timelineEntries[i].count++;
+            }
+            
+            return;
+        }
+    }
+    
+    if (timelineUsed >= timelineCapacity) {
+        // Out of memory, so the timeline ends here but profiling carries on
+        timelineOverflowed = true;
+        return;
+    }
+    
+    timelineEntries[timelineUsed].slice = timelineSlice;
+    timelineEntries[timelineUsed].stackId = stackId;
+    timelineEntries[timelineUsed].count = 1;
+    timelineUsed++;
+}
+
+static void AddOverheadMeasurement(UInt32 microseconds)
+{
+    UInt32 bucket = 0, n = microseconds;
+    
+    overheadSampleCount++;
+    overheadTotalLo += microseconds;
+    
+    if (overheadTotalLo < microseconds) {
+        overheadTotalHi++;
+    }
+    
+    if (microseconds > overheadMax) {
+        overheadMax = microseconds;
     }
     
+    while(n >= 2 && bucket < kOverheadBucketCount - 1) {
+        n >>= 1;
+        bucket++;
+    }
+    
+    overheadHistogram[bucket]++;
+}
+
+static void RecordCallStack(UInt32 *callStack, UInt16 callStackSize)
+{
+    UInt32 *sampleHits, stackIndex;
+    HashtableStatus hashError;
+    HashTable *spareTable;
+    
     if (errorCode != 0) {
         if (errorCode == 1) {
             // Ran out of buffer for samples, don't continue the timer
@@ -101,7 +289,27 @@ void ProfilerTimerFunction(UInt8 *stackPointer)
         return;
     }
     
-    hashError = hashtableInsertOrLookup(&samples, (UInt8 *)callStack, callStackSize * sizeof(UInt32), &sampleHits);
+    hashError = hashtableInsertOrLookup(samples, (UInt8 *)callStack, callStackSize * sizeof(UInt32), &sampleHits,
+                                        &stackIndex);
+    
+    if (hashError < 0 && spillFile) {
+        spareTable = (samples == &sampleTables[0]) ? &sampleTables[1] : &sampleTables[0];
+        
+        if (spareTableReady) {
+            samples = spareTable;
+            spareTableReady = false;
+            hashError = hashtableInsertOrLookup(samples, (UInt8 *)callStack, callStackSize * sizeof(UInt32),
+                                                &sampleHits, &stackIndex);
+        }
+        
+        if (hashError < 0) {
+            // Both tables are full, so this sample is lost, but there'll be
+            // room again once ProfilerIdle has written one of them out
+            ++droppedSampleCount;
+            PrimeTime((QElemPtr)&profilerTimerTask, -timerUSec);
+            return;
+        }
+    }
     
     if (hashError < 0) {
         // Ran out of buffer for samples, don't continue the timer
@@ -112,9 +320,65 @@ void ProfilerTimerFunction(UInt8 *stackPointer)
     (*sampleHits)++;
     sampleCount++;
     
+    if (timelineEntries) {
+        AddTimelineSample(stackIndex);
+    }
+    
     PrimeTime((QElemPtr)&profilerTimerTask, -timerUSec);
 }
 
+// The stack crawl starts from the A6 frame this was called with, so it has to
+// be done here rather than in a function this calls
+void ProfilerTimerFunction(UInt8 *stackPointer)
+{
+    UInt16 callStackSize = 0, i;
+    UInt32 callStack[50 + kMaxRegionDepth];
+    UnsignedWide startTime, endTime;
+    
+    if (!timerEnabled) {
+        return;
+    }
+    
+    if (overheadEnabled) {
+        Microseconds(&startTime);
+    }
+    
+    // Every timer tick counts towards the time slice, including bad samples,
+    // so that slices line up with real time
+    if (timelineEntries) {
+        if (timelineTicksLeft == 0) {
+            timelineSlice++;
+            timelineSliceStart = timelineUsed;
+            timelineTicksLeft = timelineTicksPerSlice;
+        }
+        
+        timelineTicksLeft--;
+    }
+    
+    callStack[0] = *(UInt32 *)(stackPointer + profilerPCOffset);
+    
+    if (callStack[0] >= profilerAppHeapStart) {
+        ProfilerStackCrawl((UInt32 *)(callStack + 1), &callStackSize, (UInt32 *)(callStack + 50), &errorCode);
+        callStackSize++;
+    } else {
+        errorCode = 3;
+    }
+    
+    for(i = (regionDepth < kMaxRegionDepth) ? regionDepth : kMaxRegionDepth; i > 0; --i) {
+        if (regionStack[i - 1] != 0) {
+            callStack[callStackSize++] = ((UInt32)regionStack[i - 1] << 1) | 1;
+        }
+    }
+    
+    RecordCallStack(callStack, callStackSize);
+    
+    if (overheadEnabled) {
+        Microseconds(&endTime);
+        // The low words are enough, as no sample takes over an hour
+        AddOverheadMeasurement(endTime.lo - startTime.lo);
+    }
+}
+
 static Boolean CalculatePCOffset()
 {
     UInt32 loopAddr;
@@ -168,6 +432,25 @@ static Boolean CalculatePCOffset()
     return true;
 }
 
+// Aims for a load factor of about 1 once the sample buffer is full, guessing
+// that each stack takes up around 64 bytes of it. The bucket count is rounded
+// down to a power of two, so the buckets use at most 1/16th of the buffer.
+static UInt32 BucketCountForSize(UInt32 sizeBytes)
+{
+    UInt32 bucketCount = 128;
+    
+    while(bucketCount * 2 <= sizeBytes / 64 && bucketCount < 65536) {
+        bucketCount *= 2;
+    }
+    
+    return bucketCount;
+}
+
+void SetProfilerBucketCount(UInt32 bucketCount)
+{
+    requestedBucketCount = bucketCount;
+}
+
 #ifdef __GNUC__
 __attribute__((optimize("no-omit-frame-pointer")))
 __attribute__ ((noinline))
@@ -175,6 +458,7 @@ __attribute__ ((noinline))
 OSErr InitProfiler(int sizeBytes, long samplesPerSecond)
 {
     THz applZone;
+    UInt32 bucketCount;
     
     // This should be the address of the function above main, which we don't
     // want to crawl into when doing a stack crawl. If InitProfiler() is not
@@ -200,6 +484,11 @@ OSErr InitProfiler(int sizeBytes, long samplesPerSecond)
         return 30001;
     }
     
+    if (spillFile) {
+        printLog("Error: InitProfiler called while spilling to disk, call FinishProfilerSpilling first");
+        return paramErr;
+    }
+    
     sampleData = NewPtr(sizeBytes);
     
     if (!sampleData) {
@@ -207,10 +496,31 @@ OSErr InitProfiler(int sizeBytes, long samplesPerSecond)
         return MemError();
     }
     
-    hashtableInit(&samples, sampleData, sizeBytes, 128);
+    bucketCount = requestedBucketCount ? requestedBucketCount : BucketCountForSize(sizeBytes);
     
+    samples = &sampleTables[0];
+    
+    if (hashtableInit(samples, sampleData, sizeBytes, bucketCount) != kHashtableNoErr) {
+        printLog("Error: bucket count %d isn't a power of two or doesn't fit in the sample buffer", bucketCount);
+        DisposePtr(sampleData);
+        sampleData = NULL;
+        return paramErr;
+    }
+    
+    sampleDataSize = sizeBytes;
+    sampleCount = 0;
     badSampleCount = 0;
+    droppedSampleCount = 0;
     errorCode = 0;
+    overheadSampleCount = 0;
+    overheadTotalHi = 0;
+    overheadTotalLo = 0;
+    overheadMax = 0;
+    memset(overheadHistogram, 0, sizeof(overheadHistogram));
+    regionCount = 0;
+    regionDepth = 0;
+    profilingTicks = 0;
+    samplingRate = samplesPerSecond;
     
     memset(&profilerTimerTask, 0, sizeof(profilerTimerTask));
     timerUPP = NewTimerProc(ProfilerTimerFunctionShim);
@@ -221,13 +531,256 @@ OSErr InitProfiler(int sizeBytes, long samplesPerSecond)
     return noErr;
 }
 
+OSErr EnableProfilerTimeline(int sizeBytes, long sliceMilliseconds)
+{
+    long ticksPerSlice = (sliceMilliseconds * 1000L) / timerUSec;
+    
+    // Stacks in the timeline refer to entries in the hashtable, which get
+    // thrown away when spilling
+    if (spillFile) {
+        printLog("Error: the profiler timeline can't be used while spilling to disk");
+        return paramErr;
+    }
+    
+    if (timelineEntries) {
+        DisposePtr((Ptr)timelineEntries);
+    }
+    
+    timelineEntries = (TimelineEntry *)NewPtr(sizeBytes);
+    
+    if (!timelineEntries) {
+        printLog("Error: failed to allocate profiler timeline buffer");
+        return MemError();
+    }
+    
+    if (ticksPerSlice < 1) {
+        ticksPerSlice = 1;
+    } else if (ticksPerSlice > 0xFFFF) {
+        ticksPerSlice = 0xFFFF;
+    }
+    
+    timelineCapacity = sizeBytes / sizeof(TimelineEntry);
+    timelineUsed = 0;
+    timelineSliceStart = 0;
+    timelineSlice = 0;
+    timelineTicksPerSlice = ticksPerSlice;
+    timelineTicksLeft = ticksPerSlice;
+    timelineOverflowed = false;
+    
+    return noErr;
+}
+
+void EnableProfilerOverheadMeasurement()
+{
+    overheadEnabled = true;
+}
+
+void ProfilerPushRegion(const char *name)
+{
+    UInt16 i;
+    UInt8 regionId = 0;
+    
+    for(i = 0; i < regionCount; ++i) {
+        if (strncmp(regionNames[i], name, kMaxRegionNameLength) == 0) {
+            regionId = i + 1;
+            break;
+        }
+    }
+    
+    if (regionId == 0) {
+        if (regionCount < kMaxRegionCount) {
+            strncpy(regionNames[regionCount], name, kMaxRegionNameLength);
+            regionNames[regionCount][kMaxRegionNameLength] = 0;
+            regionId = ++regionCount;
+        } else {
+            printLog("Warning: too many profiler regions, samples in region %s won't be told apart", name);
+        }
+    }
+    
+    // The region has to be in place before the timer can see it
+    if (regionDepth < kMaxRegionDepth) {
+        regionStack[regionDepth] = regionId;
+    }
+    
+    regionDepth++;
+}
+
+void ProfilerPopRegion()
+{
+    if (regionDepth > 0) {
+        regionDepth--;
+    }
+}
+
+NO_INSTRUMENT static CallCountEntry *FindCallCountEntry(UInt32 fn, UInt32 addr)
+{
+    UInt32 slot = ((fn >> 1) * 2654435761UL) & (callSlotCount - 1);
+    CallCountEntry *entry;
+    
+    while(callEntries[slot].fn != fn && callEntries[slot].fn != 0) {
+        slot = (slot + 1) & (callSlotCount - 1);
+    }
+    
+    entry = &callEntries[slot];
+    
+    if (entry->fn == fn) {
+        return entry;
+    }
+    
+    // Keep a quarter of the slots free so that probing stays short
+    if (callEntryCount >= callSlotCount - callSlotCount / 4) {
+        return NULL;
+    }
+    
+    entry->fn = fn;
+    entry->addr = addr;
+    callEntryCount++;
+    
+    return entry;
+}
+
+NO_INSTRUMENT static UInt32 CallTimeNow()
+{
+    UnsignedWide now;
+    
+    Microseconds(&now);
+    return now.lo;
+}
+
+NO_INSTRUMENT static void AddCallTime(UInt32 *hi, UInt32 *lo, UInt32 microseconds)
+{
+    *lo += microseconds;
+    
+    if (*lo < microseconds) {
+        (*hi)++;
+    }
+}
+
+OSErr EnableProfilerInstrumentation(int sizeBytes, Boolean timeCalls)
+{
+    UInt32 slotCount = 1;
+    
+    while(slotCount * 2 <= sizeBytes / sizeof(CallCountEntry)) {
+        slotCount *= 2;
+    }
+    
+    if (slotCount < 4) {
+        printLog("Error: not enough memory given for profiler instrumentation");
+        return paramErr;
+    }
+    
+    if (callEntries) {
+        DisposePtr((Ptr)callEntries);
+    }
+    
+    callEntries = (CallCountEntry *)NewPtr(slotCount * sizeof(CallCountEntry));
+    
+    if (!callEntries) {
+        printLog("Error: failed to allocate profiler instrumentation buffer");
+        return MemError();
+    }
+    
+    memset(callEntries, 0, slotCount * sizeof(CallCountEntry));
+    callSlotCount = slotCount;
+    callEntryCount = 0;
+    droppedCallCount = 0;
+    callTimingEnabled = timeCalls;
+    callDepth = 0;
+    
+    return noErr;
+}
+
+// Calls are only counted while the profiler is running
+NO_INSTRUMENT void __cyg_profile_func_enter(void *thisFn, void *callSite)
+{
+    CallCountEntry *entry;
+    CallFrame *frame;
+    
+    if (!timerEnabled || !callEntries) {
+        return;
+    }
+    
+    entry = FindCallCountEntry((UInt32)thisFn, (UInt32)__builtin_return_address(0));
+    
+    if (entry) {
+        entry->calls++;
+    } else {
+        droppedCallCount++;
+    }
+    
+    if (callTimingEnabled) {
+        if (callDepth < kMaxCallDepth) {
+            frame = &callFrames[callDepth];
+            frame->fn = (UInt32)thisFn;
+            frame->entry = entry;
+            frame->childTime = 0;
+            frame->startTime = CallTimeNow();
+        }
+        
+        callDepth++;
+    }
+}
+
+NO_INSTRUMENT void __cyg_profile_func_exit(void *thisFn, void *callSite)
+{
+    UInt32 elapsed;
+    CallFrame *frame;
+    
+    if (!timerEnabled || !callEntries || !callTimingEnabled || callDepth == 0) {
+        return;
+    }
+    
+    callDepth--;
+    
+    if (callDepth >= kMaxCallDepth) {
+        return;
+    }
+    
+    frame = &callFrames[callDepth];
+    
+    // Calls that were unwound without returning (i.e. by longjmp) never
+    // exit, so the stack can't be trusted anymore. Start it again from here.
+    if (frame->fn != (UInt32)thisFn) {
+        callDepth = 0;
+        return;
+    }
+    
+    elapsed = CallTimeNow() - frame->startTime;
+    
+    if (frame->entry) {
+        AddCallTime(&frame->entry->totalHi, &frame->entry->totalLo, elapsed);
+        AddCallTime(&frame->entry->selfHi, &frame->entry->selfLo,
+                    elapsed > frame->childTime ? elapsed - frame->childTime : 0);
+    }
+    
+    if (callDepth > 0) {
+        callFrames[callDepth - 1].childTime += elapsed;
+    }
+}
+
 void DisposeProfiler()
 {
+    if (spillFile) {
+        FinishProfilerSpilling();
+    }
+    
     if (sampleData) {
         DisposePtr((Ptr)sampleData);
         sampleData = NULL;
     }
     
+    if (timelineEntries) {
+        DisposePtr((Ptr)timelineEntries);
+        timelineEntries = NULL;
+    }
+    
+    if (callEntries) {
+        DisposePtr((Ptr)callEntries);
+        callEntries = NULL;
+    }
+    
+    overheadEnabled = false;
+    
     if (profilerTimerTask.tmAddr) {
         RmvTime((QElemPtr)&profilerTimerTask);
     }
@@ -239,13 +792,21 @@ void DisposeProfiler()
 
 void StartProfiler()
 {
+    // Any calls in progress from the last time the profiler ran won't be seen exiting
+    callDepth = 0;
     timerEnabled = true;
+    startTicks = TickCount();
     PrimeTime((QElemPtr)&profilerTimerTask, -timerUSec);
 }
 
 void StopProfiler()
 {
     profilerTimerTask.tmAddr = NULL;
+    
+    if (timerEnabled) {
+        profilingTicks += TickCount() - startTicks;
+    }
+    
     timerEnabled = false;
     
     switch(errorCode) {
@@ -257,9 +818,178 @@ void StopProfiler()
             printLog("(# of bad samples: %d)", badSampleCount);
             break;
     }
+    
+    if (samples->usedBucketCount > 0) {
+        printLog("Hashtable: %d stacks in %d buckets (load factor %0.2f), longest chain %d, average chain %0.2f, "
+                 "%0.2f entries compared per sample",
+                 samples->entryCount, samples->bucketCount, (float)samples->entryCount / samples->bucketCount,
+                 samples->maxChainLength, (float)samples->entryCount / samples->usedBucketCount,
+                 (float)samples->probeCount / samples->lookupCount);
+    }
+    
+    if (droppedSampleCount > 0) {
+        printLog("Warning: %d samples were lost because ProfilerIdle wasn't called often enough while spilling",
+                 droppedSampleCount);
+    }
+    
+    if (overheadSampleCount > 0) {
+        printLog("Sampling took %0.1f microseconds per sample on average, longest %d microseconds",
+                 ((float)overheadTotalHi * 4294967296.0f + overheadTotalLo) / overheadSampleCount, overheadMax);
+    }
+    
+    if (callEntries) {
+        printLog("Counted calls to %d functions", callEntryCount);
+        
+        if (droppedCallCount > 0) {
+            printLog("Warning: %d calls weren't counted because the profiler instrumentation buffer was full",
+                     droppedCallCount);
+        }
+    }
+    
+    if (timelineOverflowed) {
+        printLog("Warning: profiler timeline data was filled up after %d time slices.", timelineSlice);
+    }
 }
 
-OSErr SaveProfilingData_(FILE *f)
+static void WriteChunkHeader(FILE *f, OSType tag, UInt32 length)
+{
+    fwrite(&tag, sizeof(OSType), 1, f);
+    fwrite(&length, sizeof(UInt32), 1, f);
+}
+
+// Extra data goes after the samples in tagged chunks, with a zero length
+// sample marking where the samples end. Profiles without any extra data end
+// after the samples, just like before chunks were added.
+static void SaveTimeline(FILE *f)
+{
+    UInt32 sliceUSec = timelineTicksPerSlice * timerUSec;
+    UInt32 sliceCount = timelineSlice + 1;
+    UInt16 flags = timelineOverflowed ? kTimelineOverflowedFlag : 0;
+    UInt16 reserved = 0;
+    
+    WriteChunkHeader(f, 'TIME', 12 + timelineUsed * sizeof(TimelineEntry));
+    fwrite(&sliceUSec, sizeof(UInt32), 1, f);
+    fwrite(&sliceCount, sizeof(UInt32), 1, f);
+    fwrite(&flags, sizeof(UInt16), 1, f);
+    fwrite(&reserved, sizeof(UInt16), 1, f);
+    fwrite(timelineEntries, sizeof(TimelineEntry), timelineUsed, f);
+}
+
+// The number of samples timed, how long they took in all as a 64 bit number of
+// microseconds, the longest any one took, and the histogram of their times
+static void SaveOverhead(FILE *f)
+{
+    UInt16 bucketCount = kOverheadBucketCount;
+    UInt16 reserved = 0;
+    
+    WriteChunkHeader(f, 'OVHD', 20 + sizeof(overheadHistogram));
+    fwrite(&overheadSampleCount, sizeof(UInt32), 1, f);
+    fwrite(&overheadTotalHi, sizeof(UInt32), 1, f);
+    fwrite(&overheadTotalLo, sizeof(UInt32), 1, f);
+    fwrite(&overheadMax, sizeof(UInt32), 1, f);
+    fwrite(&bucketCount, sizeof(UInt16), 1, f);
+    fwrite(&reserved, sizeof(UInt16), 1, f);
+    fwrite(overheadHistogram, sizeof(UInt32), kOverheadBucketCount, f);
+}
+
+// The number of regions, then each one's name as a Pascal string, in order of id
+static void SaveRegionNames(FILE *f)
+{
+    UInt32 chunkLength = sizeof(UInt16);
+    UInt16 i;
+    unsigned char nameLength;
+    
+    for(i = 0; i < regionCount; ++i) {
+        chunkLength += 1 + strlen(regionNames[i]);
+    }
+    
+    WriteChunkHeader(f, 'RGNS', chunkLength);
+    fwrite(&regionCount, sizeof(UInt16), 1, f);
+    
+    for(i = 0; i < regionCount; ++i) {
+        nameLength = strlen(regionNames[i]);
+        fwrite(&nameLength, 1, 1, f);
+        fwrite(regionNames[i], 1, nameLength, f);
+    }
+}
+
+// The number of functions, flags, the number of calls that weren't counted,
+// and then each function's address, calls, and total and self time as 64 bit
+// numbers of microseconds, which are zero unless the calls were timed
+static void SaveCallCounts(FILE *f)
+{
+    UInt16 flags = callTimingEnabled ? kCallCountsTimedFlag : 0;
+    UInt16 reserved = 0;
+    UInt32 i;
+    
+    WriteChunkHeader(f, 'CALL', 12 + callEntryCount * 24);
+    fwrite(&callEntryCount, sizeof(UInt32), 1, f);
+    fwrite(&flags, sizeof(UInt16), 1, f);
+    fwrite(&reserved, sizeof(UInt16), 1, f);
+    fwrite(&droppedCallCount, sizeof(UInt32), 1, f);
+    
+    for(i = 0; i < callSlotCount; ++i) {
+        if (callEntries[i].fn != 0) {
+            fwrite(&callEntries[i].addr, sizeof(UInt32), 6, f);
+        }
+    }
+}
+
+// Writes the chunks that go after the samples
+static void SaveExtraChunks(FILE *f)
+{
+    if (timelineEntries) {
+        SaveTimeline(f);
+    }
+    
+    if (overheadEnabled) {
+        SaveOverhead(f);
+    }
+    
+    if (regionCount > 0) {
+        SaveRegionNames(f);
+    }
+    
+    if (callEntries) {
+        SaveCallCounts(f);
+    }
+}
+
+// stats is the table whose stats go in the header
+static void SaveFileHeader(FILE *f, const HashTable *stats, UInt16 flags)
+{
+    ProfileFileHeader header;
+    UInt32 ticks = profilingTicks;
+    
+    if (timerEnabled) {
+        ticks += TickCount() - startTicks;
+    }
+    
+    memset(&header, 0, sizeof(header));
+    header.magic = kProfileFileMagic;
+    header.version = kProfileFileVersion;
+    header.headerSize = sizeof(header) - 8;
+    header.samplesPerSecond = samplingRate;
+    header.durationMilliseconds = (ticks * 1000 + 30) / 60;
+    header.sampleCount = sampleCount;
+    header.badSampleCount = badSampleCount;
+    header.errorCode = errorCode;
+    header.flags = flags;
+    header.stackCount = stats->entryCount;
+    header.bucketCount = stats->bucketCount;
+    header.arenaUsed = stats->arenaUsed;
+    header.arenaSize = stats->arenaSize;
+    header.usedBucketCount = stats->usedBucketCount;
+    header.maxChainLength = stats->maxChainLength;
+    header.lookupCount = stats->lookupCount;
+    header.probeCount = stats->probeCount;
+    header.spillCount = spillCount;
+    header.droppedSampleCount = droppedSampleCount;
+    
+    fwrite(&header, sizeof(header), 1, f);
+}
+
+static OSErr SaveSystemInfo(FILE *f)
 {
     OSErr err;
     short realCount, outCount, index, id;
@@ -324,22 +1054,242 @@ OSErr SaveProfilingData_(FILE *f)
         fwrite(&endAddr, sizeof(UInt32), 1, f);
     }
     
-    {
-        HashtableIterator it;
-        const UInt8 *sample;
-        UInt16 sampleLength;
-        UInt32 *count;
+    return noErr;
+}
+
+// Version 1 stores each stack as its length in bytes, followed by its return
+// addresses and the number of times it was sampled
+static void SaveSamples(FILE *f, HashTable *table)
+{
+    HashtableIterator it;
+    const UInt8 *sample;
+    UInt16 sampleLength;
+    UInt32 *count;
+    
+    hashtableIterInit(&it);
+    
+    while(hashtableIterNext(table, &it, &sample, &sampleLength, &count)) {
+        fwrite(&sampleLength, sizeof(UInt16), 1, f);
+        fwrite(sample, 1, sampleLength, f);
+        fwrite(count, sizeof(UInt32), 1, f);
+    }
+}
+
+// Version 2 stores every return address once, in a table of frames, so that
+// stacks can refer to them by index. While saving, the frames are kept in an
+// open addressing table of addresses and their indices, at 8 bytes a frame,
+// since memory is often tight by the time the profile is saved.
+typedef struct FrameIndexEntry {
+    UInt32 addr;
+    UInt32 index; // index in the frame table plus one (0 = empty slot)
+} FrameIndexEntry;
+
+typedef struct FrameIndex {
+    FrameIndexEntry *entries;
+    UInt32 slotCount; // must be power of two
+    UInt32 frameCount;
+} FrameIndex;
+
+// Returns the slot addr is in, or the empty one it would go in
+static FrameIndexEntry *FindFrameIndexEntry(FrameIndex *frames, UInt32 addr)
+{
+    UInt32 slot = ((addr >> 1) * 2654435761UL) & (frames->slotCount - 1);
+    
+    while(frames->entries[slot].index != 0 && frames->entries[slot].addr != addr) {
+        slot = (slot + 1) & (frames->slotCount - 1);
+    }
+    
+    return &frames->entries[slot];
+}
+
+// Adds every return address in the table's stacks to the frame index, then
+// numbers them in the order of their slots, which is the order they're saved
+// in. Returns false if the index fills up.
+static Boolean FillFrameIndex(FrameIndex *frames, HashTable *table)
+{
+    HashtableIterator it;
+    const UInt8 *sample;
+    UInt16 sampleLength, i;
+    UInt32 *count, slot;
+    FrameIndexEntry *entry;
+    
+    hashtableIterInit(&it);
+    
+    while(hashtableIterNext(table, &it, &sample, &sampleLength, &count)) {
+        for(i = 0; i < sampleLength; i += sizeof(UInt32)) {
+            entry = FindFrameIndexEntry(frames, *(const UInt32 *)(sample + i));
+            
+            if (entry->index != 0) {
+                continue;
+            }
+            
+            // Keep a quarter of the slots free so that probing stays short
+            if (frames->frameCount >= frames->slotCount - frames->slotCount / 4) {
+                return false;
+            }
+            
+            entry->addr = *(const UInt32 *)(sample + i);
+            entry->index = 1;
+            frames->frameCount++;
+        }
+    }
+    
+    frames->frameCount = 0;
+    
+    for(slot = 0; slot < frames->slotCount; ++slot) {
+        if (frames->entries[slot].index != 0) {
+            frames->entries[slot].index = ++frames->frameCount;
+        }
+    }
+    
+    return true;
+}
+
+// Builds the frame index for a table's stacks, returning the memory it's in,
+// or NULL if there isn't enough memory for it.
+static Ptr BuildFrameTable(HashTable *table, FrameIndex *frames)
+{
+    HashtableIterator it;
+    const UInt8 *sample;
+    UInt16 sampleLength;
+    UInt32 *count, frameCount = 0, slotCount = 64;
+    Ptr mem;
+    
+    hashtableIterInit(&it);
+    
+    while(hashtableIterNext(table, &it, &sample, &sampleLength, &count)) {
+        frameCount += sampleLength / sizeof(UInt32);
+    }
+    
+    // Stacks mostly share their frames, so rather than making room for every
+    // frame the index starts out with room for about one new frame per stack,
+    // and is only made bigger if that isn't enough
+    if (frameCount > table->entryCount) {
+        frameCount = table->entryCount;
+    }
+    
+    while(slotCount - slotCount / 4 < frameCount) {
+        slotCount *= 2;
+    }
+    
+    while((mem = NewPtr(slotCount * sizeof(FrameIndexEntry))) != NULL) {
+        memset(mem, 0, slotCount * sizeof(FrameIndexEntry));
+        frames->entries = (FrameIndexEntry *)mem;
+        frames->slotCount = slotCount;
+        frames->frameCount = 0;
         
-        hashtableIterInit(&it);
+        if (FillFrameIndex(frames, table)) {
+            return mem;
+        }
         
-        while(hashtableIterNext(&samples, &it, &sample, &sampleLength, &count)) {
-            fwrite(&sampleLength, sizeof(UInt16), 1, f);
-            fwrite(sample, 1, sampleLength, f);
-            fwrite(count, sizeof(UInt32), 1, f);
+        DisposePtr(mem);
+        slotCount *= 2;
+    }
+    
+    return NULL;
+}
+
+static UInt8 *PutVarint(UInt8 *p, UInt32 value)
+{
+    while(value >= 0x80) {
+        *p++ = (value & 0x7F) | 0x80;
+        value >>= 7;
+    }
+    
+    *p++ = value;
+    
+    return p;
+}
+
+static void SaveFrameTable(FILE *f, FrameIndex *frames)
+{
+    UInt32 slot;
+    
+    WriteChunkHeader(f, 'FRMS', sizeof(UInt32) + frames->frameCount * sizeof(UInt32));
+    fwrite(&frames->frameCount, sizeof(UInt32), 1, f);
+    
+    for(slot = 0; slot < frames->slotCount; ++slot) {
+        if (frames->entries[slot].index != 0) {
+            fwrite(&frames->entries[slot].addr, sizeof(UInt32), 1, f);
         }
     }
+}
+
+// Each stack is written as varints: its number of frames, the index of each
+// frame in the frame table, and the number of times it was sampled
+static void SaveCompactStacks(FILE *f, HashTable *table, FrameIndex *frames)
+{
+    HashtableIterator it;
+    const UInt8 *sample;
+    UInt16 sampleLength, i;
+    UInt32 *count, chunkLength = sizeof(UInt32);
+    UInt8 buffer[(50 + kMaxRegionDepth + 2) * 5], *p;
+    long chunkStart, chunkEnd;
     
-    return noErr;
+    // The chunk's length isn't known until it's been written, so it's filled in after
+    WriteChunkHeader(f, 'STKS', 0);
+    chunkStart = ftell(f);
+    fwrite(&table->entryCount, sizeof(UInt32), 1, f);
+    hashtableIterInit(&it);
+    
+    while(hashtableIterNext(table, &it, &sample, &sampleLength, &count)) {
+        p = PutVarint(buffer, sampleLength / sizeof(UInt32));
+        
+        for(i = 0; i < sampleLength; i += sizeof(UInt32)) {
+            p = PutVarint(p, FindFrameIndexEntry(frames, *(const UInt32 *)(sample + i))->index - 1);
+        }
+        
+        p = PutVarint(p, *count);
+        fwrite(buffer, 1, p - buffer, f);
+        chunkLength += p - buffer;
+    }
+    
+    chunkEnd = ftell(f);
+    fseek(f, chunkStart - sizeof(UInt32), SEEK_SET);
+    fwrite(&chunkLength, sizeof(UInt32), 1, f);
+    fseek(f, chunkEnd, SEEK_SET);
+}
+
+OSErr SaveProfilingData_(FILE *f)
+{
+    OSErr err;
+    FrameIndex frames;
+    Ptr framesData;
+    
+    // If there isn't enough memory to build the frame table then the profile
+    // is saved in the old format instead, which analyze.py can still read
+    framesData = BuildFrameTable(samples, &frames);
+    
+    if (framesData) {
+        SaveFileHeader(f, samples, 0);
+    } else {
+        printLog("Warning: not enough memory to save profile in the compact format");
+    }
+    
+    err = SaveSystemInfo(f);
+    
+    if (err == noErr) {
+        if (framesData) {
+            SaveFrameTable(f, &frames);
+            SaveCompactStacks(f, samples, &frames);
+        } else {
+            SaveSamples(f, samples);
+            
+            if (timelineEntries || overheadEnabled || regionCount > 0 || callEntries) {
+                UInt16 endOfSamples = 0;
+                
+                fwrite(&endOfSamples, sizeof(UInt16), 1, f);
+            }
+        }
+        
+        SaveExtraChunks(f);
+    }
+    
+    if (framesData) {
+        DisposePtr(framesData);
+    }
+    
+    return err;
 }
 
 // Makes it so you can pass &pstr[1] into places that expect a C string. Limits
@@ -359,6 +1309,12 @@ OSErr SaveProfilingData(Str255 path)
     FILE *f;
     OSErr err;
     
+    if (spillFile) {
+        // The samples are already in the spill file, so that's the profile
+        printLog("Profile was spilled to disk, finishing the spill file instead of writing a new one");
+        return FinishProfilerSpilling();
+    }
+    
     MakeCStringCompatible(path);
     f = fopen((const char *)&path[1], "wb");
     
@@ -431,3 +1387,174 @@ OSErr SaveProfilingDataToDesktop(StringPtr fileName)
     
     return noErr;
 }
+
+static HashTable *SpareTable()
+{
+    return (samples == &sampleTables[0]) ? &sampleTables[1] : &sampleTables[0];
+}
+
+// Appends a table's samples to the spill file, in the same chunks as a version
+// 2 profile, then empties it. If there isn't enough memory for the frame table
+// they're written as version 1 sample records in a RECS chunk instead.
+static void SpillTable(HashTable *table)
+{
+    FrameIndex frames;
+    HashtableIterator it;
+    const UInt8 *sample;
+    UInt16 sampleLength, endOfSamples = 0;
+    UInt32 *count, chunkLength = sizeof(UInt16);
+    Ptr framesData;
+    
+    if (table->entryCount == 0) {
+        return;
+    }
+    
+    framesData = BuildFrameTable(table, &frames);
+    
+    if (framesData) {
+        SaveFrameTable(spillFile, &frames);
+        SaveCompactStacks(spillFile, table, &frames);
+        DisposePtr(framesData);
+    } else {
+        hashtableIterInit(&it);
+        
+        while(hashtableIterNext(table, &it, &sample, &sampleLength, &count)) {
+            chunkLength += sizeof(UInt16) + sampleLength + sizeof(UInt32);
+        }
+        
+        WriteChunkHeader(spillFile, 'RECS', chunkLength);
+        SaveSamples(spillFile, table);
+        fwrite(&endOfSamples, sizeof(UInt16), 1, spillFile);
+    }
+    
+    // So that what's been spilled so far can be read even if the app crashes
+    fflush(spillFile);
+    
+    spillTotals.entryCount += table->entryCount;
+    spillTotals.bucketCount = table->bucketCount;
+    spillTotals.arenaSize = table->arenaSize;
+    spillTotals.usedBucketCount += table->usedBucketCount;
+    spillTotals.lookupCount += table->lookupCount;
+    spillTotals.probeCount += table->probeCount;
+    
+    if (table->arenaUsed > spillTotals.arenaUsed) {
+        spillTotals.arenaUsed = table->arenaUsed;
+    }
+    
+    if (table->maxChainLength > spillTotals.maxChainLength) {
+        spillTotals.maxChainLength = table->maxChainLength;
+    }
+    
+    spillCount++;
+    hashtableInit(table, table->buckets, table->bucketCount * sizeof(UInt32) + table->arenaSize, table->bucketCount);
+}
+
+OSErr EnableProfilerSpilling(Str255 path)
+{
+    UInt32 tableSize, bucketCount;
+    OSErr err;
+    
+    if (!sampleData || spillFile || timelineEntries || timerEnabled || sampleCount > 0) {
+        printLog("Error: EnableProfilerSpilling must be called once, after InitProfiler and before StartProfiler, "
+                 "and can't be used with the profiler timeline");
+        return paramErr;
+    }
+    
+    // Each table gets half of the sample buffer, keeping them word aligned
+    tableSize = (sampleDataSize / 2) & ~3UL;
+    bucketCount = requestedBucketCount ? requestedBucketCount : BucketCountForSize(tableSize);
+    
+    if (bucketCount * sizeof(UInt32) >= tableSize) {
+        printLog("Error: bucket count %d doesn't fit in half of the sample buffer", bucketCount);
+        return paramErr;
+    }
+    
+    MakeCStringCompatible(path);
+    spillFile = fopen((const char *)&path[1], "wb");
+    
+    if (!spillFile) {
+        printLog("Error: failed to open spill file: %s", &path[1]);
+        return fnOpnErr;
+    }
+    
+    // The header is filled in properly by FinishProfilerSpilling
+    memset(&spillTotals, 0, sizeof(spillTotals));
+    spillCount = 0;
+    SaveFileHeader(spillFile, &spillTotals, kProfileSpilledFlag | kProfileIncompleteFlag);
+    err = SaveSystemInfo(spillFile);
+    
+    if (err != noErr) {
+        fclose(spillFile);
+        spillFile = NULL;
+        return err;
+    }
+    
+    fflush(spillFile);
+    hashtableInit(&sampleTables[0], sampleData, tableSize, bucketCount);
+    hashtableInit(&sampleTables[1], sampleData + tableSize, tableSize, bucketCount);
+    samples = &sampleTables[0];
+    spareTableReady = true;
+    
+    return noErr;
+}
+
+void ProfilerIdle()
+{
+    HashTable *fullTable;
+    
+    if (!spillFile) {
+        return;
+    }
+    
+    // Switching tables before the one being recorded in fills up means there's
+    // always one ready to take over. samples is changed first so that the
+    // timer always has a table with room in it.
+    if (spareTableReady && samples->arenaUsed > samples->arenaSize / 2) {
+        fullTable = samples;
+        samples = (fullTable == &sampleTables[0]) ? &sampleTables[1] : &sampleTables[0];
+        spareTableReady = false;
+    }
+    
+    // The timer can't switch tables while neither is ready, so the one it
+    // isn't using can be written out safely
+    if (!spareTableReady) {
+        SpillTable(SpareTable());
+        spareTableReady = true;
+    }
+}
+
+OSErr FinishProfilerSpilling()
+{
+    OSErr err;
+    
+    if (!spillFile) {
+        return noErr;
+    }
+    
+    if (timerEnabled) {
+        StopProfiler();
+    }
+    
+    if (!spareTableReady) {
+        SpillTable(SpareTable());
+        spareTableReady = true;
+    }
+    
+    SpillTable(samples);
+    // There's never a timeline when spilling
+    SaveExtraChunks(spillFile);
+    
+    fseek(spillFile, 0, SEEK_SET);
+    SaveFileHeader(spillFile, &spillTotals, kProfileSpilledFlag);
+    err = ferror(spillFile) ? ioErr : noErr;
+    fclose(spillFile);
+    spillFile = NULL;
+    
+    if (err != noErr) {
+        printLog("Error: failed to write spill file");
+    } else {
+        printLog("Profiler spilled %d samples to disk in %d chunks", sampleCount, spillCount);
+    }
+    
+    return err;
+}
@@ -6,7 +6,39 @@
 // Custom failure code for InitProfiler:
 #define kPCOffsetNotFound 30001
 
+// Optional, call before InitProfiler: sets the number of buckets in the
+// profiler's hashtable, which must be a power of two. By default it's worked out
+// from the size of the sample buffer.
+void SetProfilerBucketCount(UInt32 bucketCount);
 OSErr InitProfiler(int maxSamples, long samplesPerSecond);
+// Optional, call after InitProfiler: also records how often each stack was
+// sampled in every sliceMilliseconds long slice of time, using up to sizeBytes
+// of memory (8 bytes per stack per slice)
+OSErr EnableProfilerTimeline(int sizeBytes, long sliceMilliseconds);
+// Optional, call after InitProfiler and before StartProfiler: for long runs,
+// splits the sample buffer in two and appends each half to the file at path
+// as it fills up, so profiling never has to stop. Call ProfilerIdle regularly
+// (e.g. from the event loop) to do the writing, and FinishProfilerSpilling (or
+// SaveProfilingData) at the end. Can't be used with the timeline.
+OSErr EnableProfilerSpilling(Str255 path);
+void ProfilerIdle();
+OSErr FinishProfilerSpilling();
+// Optional, call after InitProfiler: times how long the profiler takes to
+// record each sample, so analyze.py can report how much of the CPU sampling
+// used. Timing samples adds a little overhead of its own.
+void EnableProfilerOverheadMeasurement();
+// Optional, call after InitProfiler: for apps built with -finstrument-functions,
+// counts every call made to each function while the profiler is running, so
+// analyze.py can show call counts next to sample counts. Uses up to sizeBytes
+// of memory (28 bytes per function, with a quarter kept free). If timeCalls is
+// true, each call is also timed with Microseconds, which is much slower.
+OSErr EnableProfilerInstrumentation(int sizeBytes, Boolean timeCalls);
+// Samples taken between ProfilerPushRegion and the matching ProfilerPopRegion
+// are marked as being in the named region, so analyze.py can report on them
+// separately (see --region). Regions can be nested, up to 8 deep, and there
+// can be up to 64 differently named ones, with names up to 31 characters.
+void ProfilerPushRegion(const char *name);
+void ProfilerPopRegion();
 void DisposeProfiler();
 void StartProfiler();
 void StopProfiler();